@@ -0,0 +1,157 @@
+import yaml
+import argparse
+import os
+import sys
+import logging
+import threading
+import time
+
+from utils.utils import run_command
+from utils.jobs import JobStore, read_manifest
+
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+fh = logging.FileHandler('batch.log')
+logger = logging.getLogger()
+logger.addHandler(fh)
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def make_job_config(base_config, job, worker):
+    """Make the run config for a job from the base config. Each worker has its
+    own scratch and config folders and each job its own output folder so jobs
+    running at the same time do not share files.
+
+    Args:
+        base_config (dict): the base run config
+        job (dict): the job. See JobStore.claim
+        worker (int): index of the worker running the job
+
+    Returns:
+        dict: run config for the job
+    """
+    job_config = dict(base_config)
+    job_config.update(job['overrides'])
+    job_config['scenes'] = [job['scene']]
+    job_config['burst_ids'] = job['burst_ids']
+    job_config['COMPASS_scratch_folder'] = os.path.join(base_config['COMPASS_scratch_folder'], f'worker{worker}')
+    job_config['COMPASS_config_folder'] = os.path.join(base_config['COMPASS_config_folder'], f'worker{worker}')
+    job_config['COMPASS_output_folder'] = os.path.join(base_config['COMPASS_output_folder'], job['job_id'])
+    for folder in ['COMPASS_scratch_folder', 'COMPASS_config_folder', 'COMPASS_output_folder']:
+        os.makedirs(job_config[folder], exist_ok=True)
+    return job_config
+
+def run_job(base_config, job, worker, store, job_folder, max_attempts=3, backoff=60):
+    """Run a job with main.py and record the result in the store. Failed jobs
+    are retried after a backoff.
+
+    Args:
+        base_config (dict): the base run config
+        job (dict): the job. See JobStore.claim
+        worker (int): index of the worker running the job
+        store (JobStore): the job store
+        job_folder (str): folder to save the job configs
+        max_attempts (int, optional): number of times a job is run. Defaults to 3.
+        backoff (float, optional): seconds before the first retry. Defaults to 60.
+    """
+    job_id = job['job_id']
+    logging.info(f'worker {worker} running job {job_id} (attempt {job["attempts"]})')
+    job_config_path = os.path.join(job_folder, f'{job_id}.yaml')
+    with open(job_config_path, 'w', encoding='utf8') as f:
+        yaml.safe_dump(make_job_config(base_config, job, worker), f)
+    # each job logs to its own file
+    job_log_path = os.path.join(job_folder, f'{job_id}.log')
+    command = (f'{sys.executable} {MAIN_PATH} --config {job_config_path} --job-store {store.db_path} '
+               f'--job-id {job_id} --log-file {job_log_path}')
+    try:
+        # main.py logs every level to stderr
+        return_code = run_command(command, prefix=f'[{job_id}] ', stderr_level=logging.INFO)
+    except Exception as e:
+        return_code = None
+        logging.error(f'job {job_id} could not be run : {e}')
+    if return_code == 0:
+        # the final state, also reached when results are not pushed to s3
+        store.set_state(job_id, 'uploaded')
+        logging.info(f'job {job_id} complete')
+    else:
+        state = store.retry_or_fail(
+            job_id, f'return code {return_code}', max_attempts=max_attempts, backoff=backoff)
+        logging.error(f'job {job_id} failed with return code {return_code}, {state}')
+
+def run_batch(config, manifest, workers=1, db_path='jobs.db', max_attempts=3, backoff=60, poll=10):
+    """Run every job in the manifest with a number of workers. The state of each
+    job is kept in the job store, so a batch that is stopped can be restarted with
+    the same arguments and only the jobs that have not finished are run. Only one
+    driver should use a job store at a time.
+
+    Args:
+        config (str): path to the base config file
+        manifest (str): path to the manifest of jobs. See read_manifest
+        workers (int, optional): number of jobs run at once. Defaults to 1.
+        db_path (str, optional): path to the job store. Defaults to 'jobs.db'.
+        max_attempts (int, optional): number of times a job is run. Defaults to 3.
+        backoff (float, optional): seconds before the first retry of a failed job,
+            doubled for each retry after. Defaults to 60.
+        poll (float, optional): seconds between checks for jobs that are due
+            to be retried. Defaults to 10.
+
+    Returns:
+        dict: number of jobs in each state
+    """
+    with open(config, 'r', encoding='utf8') as fin:
+        base_config = yaml.safe_load(fin.read())
+
+    store = JobStore(db_path)
+    new_jobs = store.add_jobs(read_manifest(manifest))
+    interrupted = store.reset_interrupted()
+    logging.info(f'{new_jobs} new jobs added, {interrupted} interrupted jobs queued again')
+    logging.info(f'job states : {store.counts()}')
+
+    job_folder = os.path.join(base_config['COMPASS_config_folder'], 'jobs')
+    os.makedirs(job_folder, exist_ok=True)
+
+    def worker(i):
+        while True:
+            job = store.claim()
+            if job is None:
+                # wait for retries of running or failed jobs
+                if store.pending() == 0:
+                    return
+                time.sleep(poll)
+                continue
+            run_job(base_config, job, i, store, job_folder, max_attempts=max_attempts, backoff=backoff)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    counts = store.counts()
+    logging.info(f'Batch complete : {counts}')
+    return counts
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", "-c", help="path to the base config.yml", required=True, type=str)
+    parser.add_argument("--manifest", "-m", help="path to the yaml manifest of jobs", required=True, type=str)
+    parser.add_argument("--workers", "-w", help="number of jobs run at once", default=1, type=int)
+    parser.add_argument("--job-store", help="path to the sqlite job store", default='jobs.db', type=str)
+    parser.add_argument("--max-attempts", help="number of times a job is run", default=3, type=int)
+    parser.add_argument("--backoff", help="seconds before the first retry of a failed job", default=60, type=float)
+    args = parser.parse_args()
+
+    counts = run_batch(
+        args.config,
+        args.manifest,
+        workers=args.workers,
+        db_path=args.job_store,
+        max_attempts=args.max_attempts,
+        backoff=args.backoff)
+    sys.exit(1 if counts['failed'] else 0)
@@ -1,20 +1,25 @@
 import yaml
 import argparse
 import os
+import sys
 import asf_search as asf
-from eof.download import download_eofs
 import logging
-import zipfile
 from shapely.geometry import Polygon
+from shapely.ops import unary_union
 import time
-from dem_stitcher import stitch_dem
-import subprocess
-import shutil
+import json
 
-from utils.utils import update_timing_file
 #from utils.etad import *
 from utils.raster import *
-from utils.aws import upload_file,upload_files_in_folder
+from utils.aws import upload_file,upload_files_in_folder,OutputStreamer,configure_s3_client
+from utils.download import search_scenes, SceneAcquirer
+from utils.cache import ArtifactCache
+from utils.jobs import JobStore
+from utils.checkpoint import Checkpoint, file_hash
+from utils.telemetry import telemetry
+from utils.sampler import ResourceSampler
+from utils.dem import get_DEM_from_scene_bounds, get_burst_polygon
+from utils.compass import write_runconfig, get_scene_burst_ids, shard_bursts, get_compass_workers, run_compass, run_compass_shards
 
 
 logging.basicConfig(
@@ -22,20 +27,26 @@ logging.basicConfig(
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
-fh = logging.FileHandler('run.log')
 logger = logging.getLogger()
-logger.addHandler(fh)
 
 
-def run_process(config):
+def run_process(config, on_stage=None):
     """main process to download data and produce CSLC's
-    based on a list of products.
+    based on a list of products. The scenes are processed as a stack
+    sharing a single DEM.
 
     Args:
         config (str): path to the config file
+        on_stage (callable, optional): called with the name of each stage as
+            it starts (downloading, processing, uploaded). Used to track the state
+            of batch jobs. Defaults to None.
+
+    Returns:
+        tuple: (dict of successful scenes, dict of failed scenes)
     """
 
     t_start = time.time()
+    on_stage = on_stage or (lambda stage: None)
     # define success / failure tracker
     success = {'COMPASS-ISCE3' : []}
     failed = {'COMPASS-ISCE3' : []}
@@ -52,145 +63,132 @@ def run_process(config):
         for k in aws_cfg.keys():
             logging.info(f'setting {k}')
             os.environ[k] = aws_cfg[k]
+    # one s3 client with a pool sized for the uploads is shared by the run
+    configure_s3_client(main_config.get('s3_upload_workers', 8))
 
+    # cache of downloaded scenes, orbits, ETAD and DEMs shared between runs
+    # the orbit and ETAD archives are indexed and kept between runs
+    cache = ArtifactCache(
+        main_config.get('cache_index_file'),
+        max_size_gb=main_config.get('cache_max_size_gb', 100),
+        keep_folders=[main_config['precise_orbit_folder'], main_config['restituted_orbit_folder'],
+                      main_config.get('ETAD_folder')])
 
-    # make the timing file
-    timing = {}
-    t0 = time.time()
-    TIMING_FILE = main_config['scenes'][0] + '_timing.json'
-    TIMING_FILE_PATH = os.path.join(main_config['COMPASS_output_folder'],TIMING_FILE)
-
-    # make lists to track downloaded files
-    CONFIG_SAFE_FILE_PATH = []
-    CONFIG_ORBIT_FILE_PATH = []
-    asf_results_list = []
+    OUT_FOLDER = main_config['COMPASS_output_folder']
 
     logging.info(f'PROCESS 1: Download Scene and Orbits')
-    # loop through the list of scenes
-    # download the scene and orbit files
-    for i, scene in enumerate(main_config['scenes']):
-        
-        # add the scene name to the out folder
-        OUT_FOLDER = main_config['COMPASS_output_folder']
-        SCENE_OUT_FOLDER = os.path.join(OUT_FOLDER,scene)
-        os.makedirs(SCENE_OUT_FOLDER, exist_ok=True)
-
-        logging.info(f'downloading scene {i+1} of {len(main_config["scenes"])} : {scene}')
-        # search for the scene in asf
-        logging.info(f'searching asf for scene...')
-        asf.constants.CMR_TIMEOUT = 45
-        logging.debug(f'CMR will timeout in {asf.constants.CMR_TIMEOUT}s')
-        asf_results = asf.granule_search([scene], asf.ASFSearchOptions(processingLevel='SLC'))
-        
-        if len(asf_results) > 0:
-            logging.info(f'scene found')
-            asf_result = asf_results[0]
-            asf_results_list.append(asf_result)
-        else:
-            logging.error(f'scene not found : {scene}')
-            run_success = False
-            failed['COMPASS-rtc'].append(scene)
-            continue
-        
-        # read in credentials to download from ASF
-        logging.info(f'setting earthdata credentials from: {main_config["earthdata_credentials"]}')
-        with open(main_config['earthdata_credentials'], "r", encoding='utf8') as f:
-            earthdata_cfg = yaml.safe_load(f.read())
-            earthdata_uid = earthdata_cfg['login']
-            earthdata_pswd = earthdata_cfg['password']
-        
-        # download scene
-        logging.info(f'downloading scene')
-        session = asf.ASFSession()
-        session.auth_with_creds(earthdata_uid,earthdata_pswd)
-        SCENE_NAME = asf_result.__dict__['umm']['GranuleUR'].split('-')[0]
-        POLARIZATION = asf_result.properties['polarization']
-        BEAMMODE = asf_result.properties['beamModeType']
-        POLARIZATION_TYPE = 'dual-pol' if len(POLARIZATION) > 2 else 'co-pol' # string for template value
-        scene_zip = os.path.join(main_config['scene_folder'], SCENE_NAME + '.zip')
-        asf_result.download(path=main_config['scene_folder'], session=session)
-            
-        # unzip scene
-        ORIGINAL_SAFE_PATH = scene_zip.replace(".zip",".SAFE")
-        if (main_config['unzip_scene'] or main_config['apply_ETAD']) and not os.path.exists(ORIGINAL_SAFE_PATH): 
-            logging.info(f'unzipping scene to {ORIGINAL_SAFE_PATH}')     
-            with zipfile.ZipFile(scene_zip, 'r') as zip_ref:
-                zip_ref.extractall(main_config['scene_folder'])
-
-        # apply the ETAD corrections to the SLC
-        if main_config['apply_ETAD']:
-            logging.info('Applying ETAD corrections')
-            logging.info(f'loading copernicus credentials from: {main_config["copernicus_credentials"]}')
-            with open(main_config['copernicus_credentials'], "r", encoding='utf8') as f:
-                copernicus_cfg = yaml.safe_load(f.read())
-                copernicus_uid = copernicus_cfg['login']
-                copernicus_pswd = copernicus_cfg['password']
-            etad_path = download_scene_etad(
-                SCENE_NAME, 
-                copernicus_uid, 
-                copernicus_pswd, etad_dir=main_config['ETAD_folder'])
-            ETAD_SCENE_FOLDER = f'{main_config["scene_folder"]}_ETAD'
-            logging.info(f'making new directory for etad corrected slc : {ETAD_SCENE_FOLDER}')
-            ETAD_SAFE_PATH = apply_etad_correction(
-                ORIGINAL_SAFE_PATH, 
-                etad_path, 
-                out_dir=ETAD_SCENE_FOLDER,
-                nthreads=main_config['gdal_threads'])
-        
-        # set as the safe file for processing
-        SAFE_PATH = ORIGINAL_SAFE_PATH if not main_config['apply_ETAD'] else ETAD_SAFE_PATH
-        CONFIG_SAFE_FILE_PATH.append(SAFE_PATH)
-
-        # download orbits
-        logging.info(f'downloading orbit files for scene')
-        prec_orb_files = download_eofs(sentinel_file=scene_zip, 
-                      save_dir=main_config['precise_orbit_folder'], 
-                      orbit_type='precise')
-        if len(prec_orb_files) > 0:
-            ORBIT_PATH = str(prec_orb_files[0])
-            logging.info(f'using precise orbits: {ORBIT_PATH}')
-        else:
-            #download restituted orbits
-            res_orb_files = download_eofs(sentinel_file=scene_zip, 
-                          save_dir=main_config['restituted_orbit_folder'], 
-                          orbit_type='restituted',
-                          asf_user=earthdata_uid,
-                          asf_password=earthdata_pswd,
-                          )  
-            ORBIT_PATH = str(res_orb_files[0])
-            logging.info(f'using restituted orbits: {ORBIT_PATH}')
-        
-        CONFIG_ORBIT_FILE_PATH.append(ORBIT_PATH)
-        
-    print(f'Downloaded {len(CONFIG_SAFE_FILE_PATH)} of {len(main_config['scenes'])} scenes')
-    t1 = time.time()
-    update_timing_file('Download Scene', t1 - t0, TIMING_FILE_PATH)
+    on_stage('downloading')
+    asf.constants.CMR_TIMEOUT = 45
+    logging.debug(f'CMR will timeout in {asf.constants.CMR_TIMEOUT}s')
+
+    # read in credentials to download from ASF
+    logging.info(f'setting earthdata credentials from: {main_config["earthdata_credentials"]}')
+    with open(main_config['earthdata_credentials'], "r", encoding='utf8') as f:
+        earthdata_cfg = yaml.safe_load(f.read())
+        earthdata_uid = earthdata_cfg['login']
+        earthdata_pswd = earthdata_cfg['password']
+
+    copernicus_creds = None
+    if main_config['apply_ETAD']:
+        logging.info(f'loading copernicus credentials from: {main_config["copernicus_credentials"]}')
+        with open(main_config['copernicus_credentials'], "r", encoding='utf8') as f:
+            copernicus_cfg = yaml.safe_load(f.read())
+            copernicus_creds = (copernicus_cfg['login'], copernicus_cfg['password'])
+
+    # make the output folder for each scene
+    for scene in main_config['scenes']:
+        os.makedirs(os.path.join(OUT_FOLDER,scene), exist_ok=True)
+
+    # find all of the scenes before downloading anything
+    scene_lookup, missing_scenes = search_scenes(
+        main_config['scenes'],
+        burst_ids=main_config['burst_ids'])
+    failed['COMPASS-ISCE3'].extend(missing_scenes)
+    if not scene_lookup:
+        logging.error(f'No scenes to process')
+        return success, failed
+
+    # stages completed by a previous run of this config are skipped
+    checkpoint = Checkpoint(
+        os.path.join(OUT_FOLDER, main_config['scenes'][0] + '_checkpoint.json')
+        if main_config.get('checkpoint', True) else None)
+    # settings that change the acquired SAFE and the products
+    acquire_checkpoint_inputs = {k : main_config.get(k) for k in
+                                 ['burst_ids', 'apply_ETAD', 'ETAD_subset', 'unzip_scene', 'unzip_subset']}
+    uploaded_scenes = [scene for scene in scene_lookup
+                       if checkpoint.verify(f'upload:{scene}', inputs=acquire_checkpoint_inputs)]
+    acquired_scenes = {}
+    for scene in scene_lookup:
+        if scene not in uploaded_scenes:
+            record = checkpoint.verify(f'acquire:{scene}', inputs=acquire_checkpoint_inputs)
+            if record is not None:
+                acquired_scenes[scene] = record['data']
+    acquire_lookup = {scene : asf_result for scene, asf_result in scene_lookup.items()
+                      if scene not in uploaded_scenes and scene not in acquired_scenes}
+
+    # download the scenes and orbit files in the background. Scenes later in
+    # the stack download while the DEM is made and earlier scenes are processed
+    logging.info(f'downloading {len(acquire_lookup)} scenes '
+                 f'with {main_config.get("download_workers", 4)} workers')
+    acquirer = SceneAcquirer(
+        acquire_lookup,
+        main_config,
+        earthdata_creds=(earthdata_uid, earthdata_pswd),
+        copernicus_creds=copernicus_creds,
+        max_workers=main_config.get('download_workers', 4),
+        service_limits=main_config.get('service_limits'),
+        cache=cache,
+        prefetch=main_config.get('stack_prefetch'))
 
     # download the DEM
-    # TODO make antimeridian and Antarctic compatible 
-    # NOTE - Assume ALL the files in the config are covered by the same DEM
-    # Get the bounds of the first DEM
+    # one DEM covering the union of the footprints of all the scenes
+    # is made and shared by the stack
     logging.info(f'PROCESS 2: Download DEM')
-    scene_geom = asf_results_list[0].geometry
-    scene_polygon = Polygon(scene_geom['coordinates'][0])
+    t1 = time.time()
+    scene_polygon = unary_union([Polygon(r.geometry['coordinates'][0]) for r in scene_lookup.values()])
+    if scene_polygon.geom_type != 'Polygon':
+        # scenes in the stack do not overlap
+        scene_polygon = scene_polygon.convex_hull
     scene_bounds = scene_polygon.bounds
+    buffer = 0.3
 
+    # the DEM only needs to cover the bursts being processed. the burst
+    # footprints are buffered in metres and correct at high latitudes
+    burst_polygon = None
+    if main_config['burst_ids'] and main_config.get('dem_burst_bounds', True):
+        burst_polygon = get_burst_polygon(
+            main_config['burst_ids'],
+            main_config['COMPASS_burst_database_file'],
+            buffer_m=main_config.get('dem_burst_buffer_m', 5000))
+
+    # scenes crossing the antimeridian are split into bounds either side of it
+    # when the DEM is made, so the bounds are not adjusted or buffered here
+    antimeridian_crossing = check_s1_bounds_cross_antimeridian(scene_bounds)
+    if burst_polygon is not None:
+        logging.info(f'Using the burst footprints for the DEM : {burst_polygon.bounds}')
+        scene_polygon = burst_polygon
+        scene_bounds = scene_bounds_buf = burst_polygon.bounds
+        # already buffered
+        buffer = 0
+    elif antimeridian_crossing:
+        logging.info(f'Scene crosses the antimeridian : {scene_bounds}')
+        scene_bounds_buf = scene_bounds
     # if we are at high latitudes we need to correct the bounds due to the skewed box shape
-    if (scene_bounds[1] < -50) or (scene_bounds[3] < -50):
+    elif (scene_bounds[1] < -50) or (scene_bounds[3] < -50):
         # Southern Hemisphere
         logging.info(f'Adjusting scene bounds due to warping at high latitude')
         scene_polygon = adjust_scene_poly_at_extreme_lat(scene_bounds, 4326, 3031)
         scene_bounds = scene_polygon.bounds 
         logging.info(f'Adjusted scene bounds : {scene_bounds}')
-    if (scene_bounds[1] > 50) or (scene_bounds[3] > 50):
+    elif (scene_bounds[1] > 50) or (scene_bounds[3] > 50):
         # Northern Hemisphere
         logging.info(f'Adjusting scene bounds due to warping at high latitude')
         scene_polygon = adjust_scene_poly_at_extreme_lat(scene_bounds, 4326, 3995)
         scene_bounds = scene_polygon.bounds 
         logging.info(f'Adjusted scene bounds : {scene_bounds}')
 
-    buffer = 0.3
-    scene_bounds_buf = scene_polygon.buffer(buffer).bounds #buffered
+    if not antimeridian_crossing and burst_polygon is None:
+        scene_bounds_buf = scene_polygon.buffer(buffer).bounds #buffered
 
     if main_config['dem_path'] is not None:
         # set the dem to be the one specified if supplied
@@ -200,177 +198,371 @@ def run_process(config):
         else:
             DEM_PATH = main_config['dem_path']
             dem_filename = os.path.basename(DEM_PATH)
+            cached_dem = None
             main_config['dem_folder'] = os.path.dirname(DEM_PATH) # set the dem folder
             main_config['overwrite_dem'] = False # do not overwrite dem
     else:
         # make folders and set filenames
+        # name the DEM after the first scene in the stack
         dem_dl_folder = os.path.join(main_config['dem_folder'],main_config['dem_type'])
         os.makedirs(dem_dl_folder, exist_ok=True)
-        dem_filename = SCENE_NAME + '_dem.tif'
+        stack_name = list(scene_lookup.keys())[0]
+        if len(scene_lookup) > 1:
+            stack_name += f'_stack{len(scene_lookup)}'
+        dem_cache_parts = (main_config['dem_type'], [round(b, 6) for b in scene_bounds_buf])
+        # the bounds depend on the bursts, so runs of the same scene for different
+        # bursts make different DEMs
+        dem_filename = f'{stack_name}_{ArtifactCache.make_key("dem", *dem_cache_parts)[:8]}_dem.tif'
         DEM_PATH = os.path.join(dem_dl_folder,dem_filename)
+        # use a DEM made for the same bounds and type in a previous run
+        cached_dem = cache.get('dem', *dem_cache_parts) if not main_config['overwrite_dem'] else None
+        # or the DEM made by a previous run of this config
+        dem_checkpoint_inputs = {'dem_type' : main_config['dem_type'], 'bounds' : dem_cache_parts[1]}
+        if cached_dem is None and not main_config['overwrite_dem']:
+            record = checkpoint.verify('dem', inputs=dem_checkpoint_inputs)
+            cached_dem = record['outputs']['dem']['path'] if record is not None else None
+        if cached_dem is not None:
+            DEM_PATH = cached_dem
+            dem_filename = os.path.basename(DEM_PATH)
     
-    if (main_config['overwrite_dem']) or (not os.path.exists(DEM_PATH)) or (main_config['dem_path'] is None):
+    # tiling, compression and overviews of the saved DEM
+    dem_write_kwargs = {
+        'compress' : main_config.get('dem_compress', 'DEFLATE'),
+        'blocksize' : main_config.get('dem_blocksize', 512),
+        'overviews' : main_config.get('dem_overviews', True),
+        'cog' : main_config.get('dem_cog', False),
+    }
+
+    if (main_config['overwrite_dem']) or (not os.path.exists(DEM_PATH)) or (main_config['dem_path'] is None and cached_dem is None):
         logging.info(f'Downloding DEM for  bounds : {scene_bounds_buf}')
         logging.info(f'type of DEM being downloaded : {main_config["dem_type"]}')
-        if 'REMA' not in str(main_config['dem_type']).upper():
-            # get the DEM and geometry information
-            dem_data, dem_meta = stitch_dem(scene_bounds_buf,
-                            dem_name=main_config['dem_type'],
-                            dst_ellipsoidal_height=True,
-                            dst_area_or_point='Point',
-                            merge_nodata_value=0
-                            )
-            logging.info(f'DEM downloaded : {DEM_PATH}')
-            # save with rasterio
-            logging.info(f'saving dem to {DEM_PATH}')
-            with rasterio.open(DEM_PATH, 'w', **dem_meta) as ds:
-                ds.write(dem_data, 1)
-                ds.update_tags(AREA_OR_POINT='Point')
-            del dem_data
+        # tiles shared with previous runs are used if dem_tile_cache is set
+        tile_folder = os.path.join(dem_dl_folder, 'tiles') if main_config.get('dem_tile_cache', False) else None
+        get_DEM_from_scene_bounds(
+            scene_bounds_buf,
+            main_config['dem_type'],
+            DEM_PATH,
+            scene_polygon=scene_polygon,
+            buffer=buffer,
+            tile_folder=tile_folder,
+            tile_size=main_config.get('dem_tile_size', 1),
+            cache=cache,
+            write_kwargs=dem_write_kwargs,
+            rema_index_folder=main_config.get('REMA_index_folder', os.path.join(main_config['dem_folder'], 'REMA_index')),
+            rema_tile_folder=os.path.join(dem_dl_folder, 'tiles'),
+            workers=main_config.get('dem_download_workers', 4))
+        cache.put('dem', DEM_PATH, *dem_cache_parts)
+        checkpoint.complete('dem', outputs={'dem' : DEM_PATH}, inputs=dem_checkpoint_inputs)
 
     t2 = time.time()
-    update_timing_file('Download DEM', t2 - t1, TIMING_FILE_PATH)
-
-    # now we have downloaded all the necessary data, we can create a
-    # config for the scene we want to process
-    with open(main_config['COMPASS_template'], 'r') as f:
-        template_text = f.read()
-    # search for the strings we want to replaces
-    template_text = template_text.replace('CONFIG_SAFE_FILE_PATH',
-                                          str(CONFIG_SAFE_FILE_PATH[0]))
-    template_text = template_text.replace('CONFIG_ORBIT_FILE_PATH',
-                                          str(CONFIG_ORBIT_FILE_PATH[0]))
-    template_text = template_text.replace('CONFIG_BURST_ID',
-                                          str(main_config['burst_ids']))
-    template_text = template_text.replace('CONFIG_DEM_FILE',
-                                          DEM_PATH)
-    #template_text = template_text.replace('SCENE_NAME',SCENE_NAME)
-    template_text = template_text.replace('CONFIG_SCRATCH_PATH',
-                                            main_config['COMPASS_scratch_folder'])
-    template_text = template_text.replace('CONFIG_PRODUCT_PATH',
-                                            SCENE_OUT_FOLDER)
-    template_text = template_text.replace('CONFIG_POLARISATION',
-                                            POLARIZATION_TYPE)
-    template_text = template_text.replace('CONFIG_BURST_DATABASE_FILE',
-                                          main_config['COMPASS_burst_database_file'])
-
-    # name config after first scene
-    COMPASS_config_name = main_config['scenes'][0] + '.yaml'
-    COMPASS_config_path = os.path.join(main_config['COMPASS_config_folder'], COMPASS_config_name)
-    with open(COMPASS_config_path, 'w') as f:
-        f.write(template_text)
-
-    # read in the config template for the RTC runs
-    with open(COMPASS_config_path, 'r', encoding='utf8') as fin:
-        COMPASS_rtc_cfg = yaml.safe_load(fin.read())
-
-    logging.info(f'PROCESS 3: Generate CLSC with Compass')
-    command = f"s1_cslc.py --grid geo {COMPASS_config_path}"
-    if not main_config['skip_COMPASS']:
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        # Print stdout and stderr as it runs
-        while True:
-            # Read a line from stdout
-            output = process.stdout.readline()
-            if output:
-                logging.info(output.strip())  # Print the output
-
-            # Check if the process has finished
-            return_code = process.poll()
-            if return_code is not None:
-                # Process any remaining stdout after process has finished
-                for output in process.stdout.readlines():
-                    logging.info(output.strip())
-                # Process any remaining stderr
-                for err in process.stderr.readlines():
-                    logging.error(err.strip())
-                break
-    else:
-        logging.info(f'PROCESS 3: Skipping COMPASS ("skip_COMPASS"==True)')
-    
-    # check if the final products exist, indicating success 
-    t3 = time.time()
-    update_timing_file('RTC Processing', t3 - t2, TIMING_FILE_PATH)
-            
-    # push to S3
-    if main_config['push_to_s3']:
-        logging.info(f'PROCESS 3: Push results to S3 bucket')
-        # see if any prefix or additional bucket path is needed
-        SCENE_PREFIX = '' if main_config["scene_prefix"] == None else main_config["scene_prefix"]
-        S3_BUCKET_FOLDER = '' if main_config["s3_bucket_folder"] == None else main_config["s3_bucket_folder"]
+    dem_time = t2 - t1
+    telemetry.add('Download DEM', t1, dem_time, dem_type=main_config['dem_type'])
+
+    # see if any prefix or additional bucket path is needed
+    SCENE_PREFIX = '' if main_config["scene_prefix"] == None else main_config["scene_prefix"]
+    S3_BUCKET_FOLDER = '' if main_config["s3_bucket_folder"] == None else main_config["s3_bucket_folder"]
+    # only upload files that are not already in the bucket
+    S3_SYNC = main_config.get('s3_sync', False)
+    # the DEM is kept until every scene in the stack is uploaded
+    keep_dem = False
+
+    # process the scenes in order as they are downloaded
+    acquired = iter(acquirer)
+    for scene in scene_lookup:
+        if scene in uploaded_scenes:
+            success['COMPASS-ISCE3'].append(scene)
+            continue
+        if scene in acquired_scenes:
+            result = acquired_scenes[scene]
+        else:
+            _, result = next(acquired)
+            if result is not None:
+                checkpoint.complete(
+                    f'acquire:{scene}',
+                    outputs={k : result[k] for k in ['scene_zip', 'SAFE_PATH', 'ORBIT_PATH'] if result[k] and os.path.exists(result[k])},
+                    inputs=acquire_checkpoint_inputs,
+                    data={k : v for k, v in result.items() if k != 'asf_result'})
+        if result is None:
+            failed['COMPASS-ISCE3'].append(scene)
+            continue
+
+        logging.info(f'Processing scene : {scene}')
+        t2 = time.time()
+        SCENE_OUT_FOLDER = os.path.join(OUT_FOLDER,scene)
+        SCENE_NAME = result['SCENE_NAME']
+        POLARIZATION_TYPE = result['POLARIZATION_TYPE']
+        SAFE_PATH = result['SAFE_PATH']
+        ORBIT_PATH = result['ORBIT_PATH']
+
+        # the timing file for the scene
+        TIMING_FILE = scene + '_timing.json'
+        TIMING_FILE_PATH = os.path.join(OUT_FOLDER,TIMING_FILE)
+        # time series of the COMPASS resource use, saved next to the timing file
+        RESOURCE_FILE = scene + '_resources.csv'
+        RESOURCE_FILE_PATH = os.path.join(OUT_FOLDER,RESOURCE_FILE)
+        resources = None
+
+        # now we have downloaded all the necessary data, we can create a
+        # config for the scene we want to process
+        COMPASS_config_name = scene + '.yaml'
+        COMPASS_config_path = os.path.join(main_config['COMPASS_config_folder'], COMPASS_config_name)
+        write_runconfig(
+            main_config['COMPASS_template'],
+            COMPASS_config_path,
+            SAFE_PATH,
+            ORBIT_PATH,
+            main_config['burst_ids'],
+            DEM_PATH,
+            main_config['COMPASS_scratch_folder'],
+            SCENE_OUT_FOLDER,
+            POLARIZATION_TYPE,
+            main_config['COMPASS_burst_database_file'])
+
+        # split the bursts over several COMPASS runs, each with its own runconfig
+        # and scratch folder. The products are all saved to SCENE_OUT_FOLDER
+        COMPASS_workers = main_config.get('COMPASS_workers', 1)
+        COMPASS_shards = []
+        if COMPASS_workers != 1:
+            burst_ids = main_config['burst_ids']
+            if not burst_ids:
+                burst_ids = get_scene_burst_ids(SAFE_PATH, ORBIT_PATH)
+            for i, shard_burst_ids in enumerate(shard_bursts(burst_ids, main_config.get('COMPASS_bursts_per_shard', 1))):
+                shard_config_path = os.path.join(
+                    main_config['COMPASS_config_folder'], f"{scene}_shard{i}.yaml")
+                shard_scratch = os.path.join(main_config['COMPASS_scratch_folder'], f'shard{i}')
+                os.makedirs(shard_scratch, exist_ok=True)
+                write_runconfig(
+                    main_config['COMPASS_template'],
+                    shard_config_path,
+                    SAFE_PATH,
+                    ORBIT_PATH,
+                    shard_burst_ids,
+                    DEM_PATH,
+                    shard_scratch,
+                    SCENE_OUT_FOLDER,
+                    POLARIZATION_TYPE,
+                    main_config['COMPASS_burst_database_file'])
+                COMPASS_shards.append((shard_config_path, shard_burst_ids))
+            COMPASS_workers = get_compass_workers(
+                len(COMPASS_shards),
+                memory_per_worker_gb=main_config.get('COMPASS_memory_per_worker_gb', 8),
+                max_workers=None if COMPASS_workers == 'auto' else COMPASS_workers)
+
         bucket_folder = os.path.join(
             S3_BUCKET_FOLDER,
             main_config["software"],
             main_config['dem_type'],
             f'CRS',
             f'{SCENE_PREFIX}{SCENE_NAME}')
-        # upload output files
-        upload_files_in_folder(
-            SCENE_OUT_FOLDER,
-            main_config['s3_bucket'],
-            bucket_folder,
-        )
-        # upload DEM
-        if main_config['upload_dem']:
-            bucket_path = os.path.join(bucket_folder,dem_filename)
-            logging.info(f'Uploading file: {DEM_PATH}')
-            upload_file(DEM_PATH, 
-                        bucket=main_config['s3_bucket'], 
-                        object_name=bucket_path)
-        # upload yaml
-        bucket_path = os.path.join(bucket_folder,dem_filename)
-        logging.info(f'Uploading file: {DEM_PATH}')
-        upload_file(COMPASS_config_path, 
-                    bucket=main_config['s3_bucket'], 
-                    object_name=bucket_path)
-                
-        t4 = time.time()
-        update_timing_file('S3 Upload', t4 - t3, TIMING_FILE_PATH)
-
-        if main_config['delete_local_files']:
-            logging.info(f'PROCESS 4: Clear files locally')
-            #clear downloads
-            for file_ in [scene_zip,
-                        DEM_PATH,
-                        ORBIT_PATH,
-                        COMPASS_config_path,
-                        ]:
-                logging.info(f'Deleteing {file_}')
-                os.remove(file_)
-            logging.info(f'Clearing SAFE directory: {ORIGINAL_SAFE_PATH}')
-            shutil.rmtree(ORIGINAL_SAFE_PATH)
-            if main_config['apply_ETAD']:
-                logging.info(f'Clearing ETAD corrected SAFE directory: {ETAD_SAFE_PATH}')
-                shutil.rmtree(ETAD_SAFE_PATH)
-                logging.info(f'Clearing directory: {ETAD_SAFE_PATH}')
-
-            shutil.rmtree(SCENE_OUT_FOLDER)
-            shutil.rmtree(main_config['COMPASS_scratch_folder'])
-            # remake the scratch folder
-            os.makedirs(main_config['COMPASS_scratch_folder'])
+
+        logging.info(f'PROCESS 3: Generate CLSC with Compass')
+        on_stage('processing')
+        streamer = None
+        # COMPASS is complete if the products of a run with the same runconfig are unchanged
+        compass_checkpoint_inputs = {'runconfig' : file_hash(COMPASS_config_path),
+                                     'shards' : [shard[1] for shard in COMPASS_shards]}
+        if checkpoint.verify(f'compass:{scene}', inputs=compass_checkpoint_inputs):
+            success['COMPASS-ISCE3'].append(scene)
+        elif not main_config['skip_COMPASS']:
+            if main_config['push_to_s3'] and main_config.get('stream_to_s3', False):
+                # upload each burst as soon as COMPASS has finished it
+                logging.info(f'Streaming finished bursts to s3 : {main_config["s3_bucket"]}/{bucket_folder}')
+                streamer = OutputStreamer(
+                    SCENE_OUT_FOLDER,
+                    main_config['s3_bucket'],
+                    bucket_folder,
+                    interval=main_config.get('stream_interval', 30),
+                    delete=main_config.get('stream_delete_local', False),
+                    sync=S3_SYNC,
+                    max_workers=main_config.get('s3_upload_workers', 8))
+                streamer.start()
+            # sample the cpu, memory and io of the COMPASS processes only, not the
+            # downloads and extraction prefetched for the next scenes
+            sampler, on_start = None, None
+            if main_config.get('resource_sample_interval'):
+                sampler = ResourceSampler(interval=main_config['resource_sample_interval'])
+                sampler.start()
+                on_start = sampler.track
+            # finished bursts are uploaded straight away when streaming
+            on_burst_done = streamer.mark_complete if streamer is not None else None
+            if COMPASS_shards:
+                def on_shard_done(burst_ids):
+                    if streamer is not None:
+                        for burst_id in burst_ids:
+                            streamer.mark_complete(burst_id)
+                return_codes = run_compass_shards(
+                    COMPASS_shards,
+                    COMPASS_workers,
+                    on_done=on_shard_done,
+                    timeout=main_config.get('COMPASS_timeout'),
+                    burst_timeout=main_config.get('COMPASS_burst_timeout'),
+                    on_burst_done=on_burst_done,
+                    on_start=on_start)
+                return_code = max(return_codes, key=abs, default=0)
+            else:
+                return_code = run_compass(
+                    COMPASS_config_path,
+                    timeout=main_config.get('COMPASS_timeout'),
+                    burst_timeout=main_config.get('COMPASS_burst_timeout'),
+                    on_burst_done=on_burst_done,
+                    on_start=on_start)
+            if sampler is not None:
+                resources = sampler.stop()
+                sampler.save(RESOURCE_FILE_PATH)
+                logging.info(f'COMPASS resource peaks : {resources}')
+            if return_code != 0:
+                logging.error(f'COMPASS failed with return code {return_code} : {scene}')
+                failed['COMPASS-ISCE3'].append(scene)
+            else:
+                success['COMPASS-ISCE3'].append(scene)
+                checkpoint.complete(
+                    f'compass:{scene}',
+                    outputs={'products' : SCENE_OUT_FOLDER},
+                    inputs=compass_checkpoint_inputs)
+            if streamer is not None:
+                streamed_report = streamer.finish()
+        else:
+            logging.info(f'PROCESS 3: Skipping COMPASS ("skip_COMPASS"==True)')
         
-        t5 = time.time()
-        update_timing_file('Delete Files', t5 - t4, TIMING_FILE_PATH)
+        # check if the final products exist, indicating success 
+        t3 = time.time()
+        telemetry.add('COMPASS Processing', t2, t3 - t2, scene=scene, resources=resources)
+                
+        # push to S3
+        if main_config['push_to_s3']:
+            logging.info(f'PROCESS 3: Push results to S3 bucket')
+            # upload output files, unless streamed during the run
+            if streamer is not None:
+                upload_report = streamed_report
+            else:
+                upload_report = upload_files_in_folder(
+                    SCENE_OUT_FOLDER,
+                    main_config['s3_bucket'],
+                    bucket_folder,
+                    max_workers=main_config.get('s3_upload_workers', 8),
+                    sync=S3_SYNC,
+                )
+            upload_failed = list(upload_report['failed'])
+            # upload DEM
+            if main_config['upload_dem']:
+                bucket_path = os.path.join(bucket_folder,dem_filename)
+                logging.info(f'Uploading file: {DEM_PATH}')
+                if not upload_file(DEM_PATH, 
+                                   bucket=main_config['s3_bucket'], 
+                                   object_name=bucket_path,
+                                   sync=S3_SYNC):
+                    upload_failed.append(DEM_PATH)
+            # upload yaml
+            bucket_path = os.path.join(bucket_folder,COMPASS_config_name)
+            logging.info(f'Uploading file: {COMPASS_config_path}')
+            if not upload_file(COMPASS_config_path, 
+                               bucket=main_config['s3_bucket'], 
+                               object_name=bucket_path,
+                               sync=S3_SYNC):
+                upload_failed.append(COMPASS_config_path)
+            if upload_failed:
+                logging.error(f'{len(upload_failed)} files failed to upload : {upload_failed}')
+                if scene not in failed['COMPASS-ISCE3']:
+                    failed['COMPASS-ISCE3'].append(scene)
+            elif scene not in failed['COMPASS-ISCE3']:
+                on_stage('uploaded')
+                checkpoint.complete(f'upload:{scene}', inputs=acquire_checkpoint_inputs,
+                                    data={'bucket_folder' : bucket_folder})
+                    
+            t4 = time.time()
+            telemetry.add('S3 Upload', t3, t4 - t3, scene=scene,
+                          bytes=upload_report['bytes'], files=upload_report['files'])
+
+            if main_config['delete_local_files'] and upload_failed:
+                logging.warning(f'PROCESS 4: Keeping local files as uploads failed')
+                keep_dem = True
+            elif main_config['delete_local_files']:
+                logging.info(f'PROCESS 4: Clear files locally')
+                # clear downloads. cached files are kept until evicted
+                for file_ in [result['scene_zip'],
+                              result['ORBIT_PATH'],
+                              result['ORIGINAL_SAFE_PATH'],
+                              result['ETAD_SAFE_PATH'],
+                              COMPASS_config_path,
+                              *[shard[0] for shard in COMPASS_shards],
+                              SCENE_OUT_FOLDER,
+                              main_config['COMPASS_scratch_folder'],
+                              ]:
+                    cache.discard(file_)
+                cache.evict()
+                # remake the scratch folder
+                os.makedirs(main_config['COMPASS_scratch_folder'])
+            
+            t5 = time.time()
+            telemetry.add('Delete Files', t4, t5 - t4, scene=scene)
+            
+            # TODO push a logs file
+
+        # save the time of each step for the scene, written once from the telemetry
+        timing = telemetry.summary(scene=scene)
+        # the DEM is shared by the stack so the time to make it is recorded for every scene
+        timing['Download DEM'] = dem_time
+        if resources:
+            timing['COMPASS Resources'] = resources
+        with open(TIMING_FILE_PATH, 'w') as fp:
+            json.dump(timing, fp)
 
         # push timings
         if main_config['push_to_s3']:
-            bucket_path = os.path.join(bucket_folder, TIMING_FILE)
-            logging.info(f'Uploading file: {TIMING_FILE_PATH}')
-            logging.info(f'Destination: {bucket_path}')
-            upload_file(file_name=TIMING_FILE_PATH, 
-                        bucket=main_config['s3_bucket'], 
-                        object_name=bucket_path)
-            os.remove(TIMING_FILE_PATH)
-        
-        # TODO push a logs file
+            for file_, file_path in [(TIMING_FILE, TIMING_FILE_PATH), (RESOURCE_FILE, RESOURCE_FILE_PATH)]:
+                if not os.path.exists(file_path):
+                    continue
+                bucket_path = os.path.join(bucket_folder, file_)
+                logging.info(f'Uploading file: {file_path}')
+                logging.info(f'Destination: {bucket_path}')
+                upload_file(file_name=file_path, 
+                            bucket=main_config['s3_bucket'], 
+                            object_name=bucket_path)
+                os.remove(file_path)
+
+    # the stack DEM is cleared once every scene is done
+    if main_config['push_to_s3'] and main_config['delete_local_files'] and not keep_dem:
+        cache.discard(DEM_PATH)
+        cache.evict()
+
+    # save the spans of every step in the run
+    telemetry_format = main_config.get('telemetry_format', 'jsonl')
+    TELEMETRY_FILE = main_config['scenes'][0] + ('_trace.json' if telemetry_format == 'chrome' else '_telemetry.jsonl')
+    TELEMETRY_FILE_PATH = os.path.join(OUT_FOLDER, TELEMETRY_FILE)
+    telemetry.flush(TELEMETRY_FILE_PATH, format=telemetry_format)
+    if main_config['push_to_s3']:
+        bucket_path = os.path.join(
+            S3_BUCKET_FOLDER,
+            main_config["software"],
+            main_config['dem_type'],
+            f'CRS',
+            'telemetry',
+            TELEMETRY_FILE)
+        logging.info(f'Uploading file: {TELEMETRY_FILE_PATH}')
+        upload_file(file_name=TELEMETRY_FILE_PATH,
+                    bucket=main_config['s3_bucket'],
+                    object_name=bucket_path)
     
-    logging.info(f'Run complete, {len(main_config["scenes"])} scenes processed')
+    logging.info(f'Run complete, {len(success["COMPASS-ISCE3"])} of {len(main_config["scenes"])} scenes processed')
+    if failed['COMPASS-ISCE3']:
+        logging.error(f'{len(failed["COMPASS-ISCE3"])} scenes failed : {failed["COMPASS-ISCE3"]}')
     logging.info(f'Elapsed time:  {((time.time() - t_start)/60)} minutes')
+    return success, failed
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", "-c", help="path to config.yml", required=True, type=str)
+    parser.add_argument("--job-store", help="sqlite job store to record the state of a batch job in", default=None, type=str)
+    parser.add_argument("--job-id", help="id of the batch job in the job store", default=None, type=str)
+    parser.add_argument("--log-file", help="file to save the log to", default='run.log', type=str)
     args = parser.parse_args()
+    logger.addHandler(logging.FileHandler(args.log_file))
+
+    on_stage = None
+    if args.job_store is not None:
+        store = JobStore(args.job_store)
+        on_stage = lambda stage: store.set_state(args.job_id, stage)
 
-    run_process(args.config)
\ No newline at end of file
+    success, failed = run_process(args.config, on_stage=on_stage)
+    sys.exit(1 if failed['COMPASS-ISCE3'] else 0)
\ No newline at end of file
@@ -0,0 +1,46 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.cache import ArtifactCache
+
+def write_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return path
+
+def test_evict_keeps_files_in_keep_folders(tmp_path):
+    orbit_folder = tmp_path / 'POEORB'
+    orbit = write_file(str(orbit_folder / 'S1A_OPER_AUX_POEORB_OPOD_20190805T120708_V20190715T225942_20190717T005942.EOF'), 1000)
+    scene = write_file(str(tmp_path / 'scenes' / 'scene.zip'), 1000)
+    cache = ArtifactCache(str(tmp_path / 'cache.sqlite'), max_size_gb=1500 / 1024**3, keep_folders=[str(orbit_folder)])
+
+    cache.put('orbit', orbit, 'orbit', label='S1A_POEORB', start='20190715T225942', stop='20190717T005942')
+    cache.release(orbit)
+    # over budget, the released orbit is the least recently used
+    cache.put('scene', scene, 'scene')
+
+    assert os.path.exists(orbit)
+    assert os.path.exists(scene)
+    # the orbit is no longer in the cache
+    assert cache.get_covering('orbit', 'S1A_POEORB', '20190716T000000', '20190716T000100') is None
+
+def test_evict_deletes_released_files(tmp_path):
+    first = write_file(str(tmp_path / 'a.zip'), 1000)
+    second = write_file(str(tmp_path / 'b.zip'), 1000)
+    cache = ArtifactCache(str(tmp_path / 'cache.sqlite'), max_size_gb=1500 / 1024**3)
+
+    cache.put('scene', first, 'a')
+    cache.discard(first)
+    cache.put('scene', second, 'b')
+
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+
+def test_discard_keeps_files_in_keep_folders(tmp_path):
+    orbit = write_file(str(tmp_path / 'POEORB' / 'orbit.EOF'), 10)
+    cache = ArtifactCache(keep_folders=[str(tmp_path / 'POEORB')])
+    cache.discard(orbit)
+    assert os.path.exists(orbit)
@@ -0,0 +1,39 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.checkpoint
+from utils.checkpoint import fingerprint, check_fingerprint
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def test_large_files_are_not_read_in_full(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.checkpoint, 'MAX_FULL_HASH_SIZE', 1024)
+    def no_full_hash(path, chunk_size=None):
+        raise AssertionError('large file hashed in full')
+    monkeypatch.setattr(utils.checkpoint, 'file_hash', no_full_hash)
+    scene = write_file(str(tmp_path / 'scene.zip'), os.urandom(4*1024*1024))
+    record = fingerprint(scene)
+    assert record['hash_type'] == 'sample'
+
+    # touched but unchanged
+    os.utime(scene, ns=(record['mtime_ns'] + 10**9, record['mtime_ns'] + 10**9))
+    assert check_fingerprint(record)
+    # the end of the file rewritten
+    with open(scene, 'r+b') as f:
+        f.seek(-10, os.SEEK_END)
+        f.write(b'0123456789')
+    os.utime(scene, ns=(record['mtime_ns'] + 2*10**9, record['mtime_ns'] + 2*10**9))
+    assert not check_fingerprint(record)
+
+def test_small_files_are_hashed_in_full(tmp_path):
+    config = write_file(str(tmp_path / 'runconfig.yaml'), b'a: 1\n')
+    record = fingerprint(config)
+    assert record['hash_type'] == 'full'
+    write_file(config, b'a: 2\n')
+    os.utime(config, ns=(record['mtime_ns'] + 10**9, record['mtime_ns'] + 10**9))
+    assert not check_fingerprint(record)
@@ -0,0 +1,26 @@
+import os
+import sys
+import time
+import signal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.compass
+from utils.compass import run_compass_shards
+
+def test_shards_share_the_scene_timeout(monkeypatch):
+    timeouts = []
+    def fake_run_compass(runconfig_path, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        time.sleep(0.6)
+        return 0
+    monkeypatch.setattr(utils.compass, 'run_compass', fake_run_compass)
+
+    shards = [(f'shard{i}.yaml', [f't071_15121{i}_iw2']) for i in range(3)]
+    return_codes = run_compass_shards(shards, workers=1, timeout=1)
+
+    # the second shard gets the time left, the third is not started
+    assert len(timeouts) == 2
+    assert timeouts[0] <= 1
+    assert 0 < timeouts[1] < 0.5
+    assert return_codes == [0, 0, -signal.SIGTERM]
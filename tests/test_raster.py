@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+rasterio = pytest.importorskip('rasterio')
+import numpy as np
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.raster import reproject_raster
+
+def write_dem(path, nodata=-9999):
+    # smooth heights with a nodata hole, on a 4326 grid like a stitched DEM
+    rows, cols = np.mgrid[0:600, 0:800]
+    data = (1000 + 300*np.sin(rows/40) + 200*np.cos(cols/25)).astype('float32')
+    data[200:260, 300:420] = nodata
+    profile = {'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'width': 800, 'height': 600,
+               'crs': 'EPSG:4326', 'transform': from_origin(146.0, -34.0, 0.001, 0.001), 'nodata': nodata}
+    with rasterio.open(path, 'w', **profile) as ds:
+        ds.write(data, 1)
+    return path
+
+@pytest.mark.parametrize('resampling', ['nearest', 'bilinear'])
+@pytest.mark.parametrize('dst_res', [None, 200])
+def test_tiled_reproject_matches_single_warp(tmp_path, resampling, dst_res):
+    dem = write_dem(str(tmp_path / 'dem.tif'))
+    kwargs = {'resampling' : resampling, 'blocksize' : 128, 'dst_res' : dst_res}
+    single = reproject_raster(dem, str(tmp_path / 'single.tif'), 32755, **kwargs)
+    tiled = reproject_raster(dem, str(tmp_path / 'tiled.tif'), 32755, workers=4, **kwargs)
+    with rasterio.open(single) as a, rasterio.open(tiled) as b:
+        assert a.profile == b.profile
+        np.testing.assert_array_equal(a.read(1), b.read(1))
@@ -0,0 +1,35 @@
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.safe import safe_polarizations
+
+SAFE_NAME = 'S1A_IW_SLC__1SDV_20190716T135159_20190716T135226_028143_032DC3_512B.SAFE'
+MANIFEST = '''<?xml version="1.0" encoding="UTF-8"?>
+<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1" xmlns:s1sarl1="http://www.esa.int/safe/sentinel-1.0/sentinel-1/sar/level-1">
+  <metadataSection>
+    <metadataObject ID="generalProductInformation">
+      <metadataWrap><xmlData><s1sarl1:standAloneProductInformation>
+        <s1sarl1:transmitterReceiverPolarisation>VV</s1sarl1:transmitterReceiverPolarisation>
+        <s1sarl1:transmitterReceiverPolarisation>VH</s1sarl1:transmitterReceiverPolarisation>
+      </s1sarl1:standAloneProductInformation></xmlData></metadataWrap>
+    </metadataObject>
+  </metadataSection>
+</xfdu:XFDU>
+'''
+
+@pytest.mark.parametrize('zipped', [False, True])
+def test_safe_polarizations(tmp_path, zipped):
+    safe_path = tmp_path / SAFE_NAME
+    safe_path.mkdir()
+    (safe_path / 'manifest.safe').write_text(MANIFEST)
+    if zipped:
+        zip_path = str(tmp_path / SAFE_NAME.replace('.SAFE', '.zip'))
+        with zipfile.ZipFile(zip_path, 'w') as zip_ref:
+            zip_ref.write(safe_path / 'manifest.safe', f'{SAFE_NAME}/manifest.safe')
+        safe_path = zip_path
+    assert safe_polarizations(str(safe_path)) == ['vv', 'vh']
@@ -0,0 +1,27 @@
+import os
+import sys
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.sampler import ResourceSampler
+from utils.utils import run_command
+
+def test_sampler_only_counts_tracked_processes():
+    sampler = ResourceSampler()
+    # e.g. a download for the next scene running next to COMPASS
+    other = subprocess.Popen(['sleep', '30'])
+    samples = []
+    try:
+        def on_start(process):
+            sampler.track(process)
+            samples.append(sampler.sample())
+        return_code = run_command('sleep 1 & wait', on_start=on_start)
+    finally:
+        other.kill()
+        other.wait()
+    assert return_code == 0
+    # the shell and its sleep, not the other process
+    assert 1 <= samples[0]['processes'] <= 2
+    # finished processes are no longer sampled
+    assert sampler.sample()['processes'] == 0
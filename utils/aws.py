@@ -1,14 +1,90 @@
 import os
-import sys
 import threading
 import logging
 import boto3
 from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import os
 import time
+import hashlib
+import subprocess
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.telemetry import telemetry
 
 logger = logging.getLogger(__name__)
 
+# S3 allows a maximum of 10,000 parts in a multipart upload
+MAX_PARTS = 10000
+MIN_PART_SIZE = 8*1024**2
+
+# the client shared by every upload, see get_s3_client
+_s3_client = None
+_s3_pool_connections = 50
+_s3_lock = threading.Lock()
+
+def configure_s3_client(upload_workers=8, max_concurrency=10):
+    """Size the connection pool of the shared S3 client for the number of files
+    uploaded at once and the parts of each uploaded at once. Call before the
+    first upload.
+
+    Args:
+        upload_workers (int, optional): number of files uploaded at once. Defaults to 8.
+        max_concurrency (int, optional): number of parts of a file uploaded at once. Defaults to 10.
+    """
+    global _s3_client, _s3_pool_connections
+    with _s3_lock:
+        _s3_pool_connections = max(50, int(upload_workers) * max_concurrency)
+        _s3_client = None
+
+def get_s3_client():
+    """Get the shared S3 client. boto3 clients are thread safe so one client
+    and its connection pool is reused for every upload. See configure_s3_client
+
+    Returns:
+        boto3.client: s3 client
+    """
+    global _s3_client
+    with _s3_lock:
+        if _s3_client is None:
+            config = Config(
+                max_pool_connections=_s3_pool_connections,
+                retries={'max_attempts' : 10, 'mode' : 'adaptive'})
+            _s3_client = boto3.client('s3', config=config)
+        return _s3_client
+
+def get_part_size(file_size):
+    """Part size for a multipart upload. At least 8 MB and large enough
+    to keep the upload within the S3 part limit.
+
+    Args:
+        file_size (int): size of the file in bytes
+
+    Returns:
+        int: part size in bytes
+    """
+    return max(MIN_PART_SIZE, -(-file_size // MAX_PARTS))
+
+def get_transfer_config(file_size, max_concurrency=10):
+    """Get the transfer config for a file. Parts are at least 8 MB and large
+    enough to keep the upload within the S3 part limit.
+
+    Args:
+        file_size (int): size of the file in bytes
+        max_concurrency (int, optional): number of parts uploaded at once. Defaults to 10.
+
+    Returns:
+        TransferConfig: transfer config for the upload
+    """
+    part_size = get_part_size(file_size)
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=max_concurrency,
+        use_threads=True)
+
 def find_files(folder, contains):
     paths = []
     for root, dirs, files in os.walk(folder):
@@ -18,81 +94,214 @@ def find_files(folder, contains):
                 paths.append(filename)
     return paths
 
-class ProgressPercentage(object):
+def local_etag(file_name, part_size):
+    """Calculate the ETag S3 gives a file uploaded with parts of part_size.
+    Files smaller than part_size are uploaded in one part and the ETag is the md5.
 
-    def __init__(self, filename):
-        self._filename = filename
-        self._size = float(os.path.getsize(filename))
-        self._seen_so_far = 0
-        self._lock = threading.Lock()
+    Args:
+        file_name (str): path to the file
+        part_size (int): part size of the upload in bytes
 
-    def __call__(self, bytes_amount):
-        # To simplify, assume this is hooked up to a single filename
-        with self._lock:
-            self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stdout.write(
-                "\r%s  %s / %s  (%.2f%%)" % (
-                    self._filename, self._seen_so_far, self._size,
-                    percentage))
-            sys.stdout.flush()
+    Returns:
+        str: the ETag
+    """
+    md5s = []
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(part_size), b''):
+            md5s.append(hashlib.md5(chunk))
+    if os.path.getsize(file_name) < part_size:
+        return md5s[0].hexdigest() if md5s else hashlib.md5(b'').hexdigest()
+    return hashlib.md5(b''.join(m.digest() for m in md5s)).hexdigest() + f'-{len(md5s)}'
+
+def list_remote_objects(bucket, prefix=''):
+    """List the objects under a prefix in an S3 bucket
+
+    Args:
+        bucket (str): s3 bucket
+        prefix (str, optional): prefix in the bucket. Defaults to ''.
+
+    Returns:
+        dict: key -> {'size', 'etag'}
+    """
+    objects = {}
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = {'size' : obj['Size'], 'etag' : obj['ETag'].strip('"')}
+    return objects
+
+def is_uploaded(file_name, remote):
+    """Check if a local file matches an object in s3 by size and ETag
+
+    Args:
+        file_name (str): path to the file
+        remote (dict): {'size', 'etag'} of the object. None if it does not exist
+
+    Returns:
+        bool: True if the object is the same as the local file
+    """
+    if remote is None:
+        return False
+    size = os.path.getsize(file_name)
+    if size != remote['size']:
+        return False
+    return local_etag(file_name, get_part_size(size)) == remote['etag']
+
+def upload_multipart(file_name, bucket, object_name, max_concurrency=10):
+    """Multipart upload that can be resumed. If an unfinished upload of the same
+    object exists it is continued and parts already in s3 are not uploaded again.
+
+    Args:
+        file_name (str): File to upload
+        bucket (str): Bucket to upload to
+        object_name (str): S3 object name
+        max_concurrency (int, optional): number of parts uploaded at once. Defaults to 10.
+    """
+    s3_client = get_s3_client()
+    size = os.path.getsize(file_name)
+    part_size = get_part_size(size)
+    n_parts = -(-size // part_size)
+
+    # find an interrupted upload of the same object
+    uploaded_parts = {}
+    uploads = s3_client.list_multipart_uploads(Bucket=bucket, Prefix=object_name).get('Uploads', [])
+    uploads = sorted([u for u in uploads if u['Key'] == object_name], key=lambda u: u['Initiated'])
+    if uploads:
+        upload_id = uploads[-1]['UploadId']
+        paginator = s3_client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=bucket, Key=object_name, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                uploaded_parts[part['PartNumber']] = part['ETag']
+        logger.info(f'Resuming upload of {object_name}, {len(uploaded_parts)} of {n_parts} parts uploaded')
+    else:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=object_name)['UploadId']
 
+    def _upload_part(part_number):
+        with open(file_name, 'rb') as f:
+            f.seek((part_number - 1) * part_size)
+            data = f.read(part_size)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        if uploaded_parts.get(part_number) != etag:
+            etag = s3_client.upload_part(
+                Bucket=bucket, Key=object_name, UploadId=upload_id,
+                PartNumber=part_number, Body=data)['ETag']
+        return {'PartNumber' : part_number, 'ETag' : etag}
 
-def upload_file(file_name, bucket, object_name=None):
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        parts = list(executor.map(_upload_part, range(1, n_parts + 1)))
+    s3_client.complete_multipart_upload(
+        Bucket=bucket, Key=object_name, UploadId=upload_id,
+        MultipartUpload={'Parts' : parts})
+
+def sync_file(file_name, bucket, object_name, remote=None):
+    """Upload a file only if it is not already in s3. Large files are uploaded
+    with a resumable multipart upload.
+
+    Args:
+        file_name (str): File to upload
+        bucket (str): Bucket to upload to
+        object_name (str): S3 object name
+        remote (dict, optional): {'size', 'etag'} of the object from list_remote_objects.
+            Defaults to None and the object is looked up.
+
+    Returns:
+        bool: True if the file was uploaded, False if it was already in s3
+    """
+    if remote is None:
+        try:
+            head = get_s3_client().head_object(Bucket=bucket, Key=object_name)
+            remote = {'size' : head['ContentLength'], 'etag' : head['ETag'].strip('"')}
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+    if is_uploaded(file_name, remote):
+        logger.info(f'Already uploaded, skipping: s3://{bucket}/{object_name}')
+        return False
+    size = os.path.getsize(file_name)
+    if size >= get_part_size(size):
+        upload_multipart(file_name, bucket, object_name)
+    else:
+        get_s3_client().upload_file(file_name, bucket, object_name, Config=get_transfer_config(size))
+    logger.info(f"Uploaded {file_name} to s3://{bucket}/{object_name}")
+    return True
+
+def upload_file(file_name, bucket, object_name=None, sync=False):
     """Upload a file to an S3 bucket
 
     :param file_name: File to upload
     :param bucket: Bucket to upload to
     :param object_name: S3 object name. If not specified then file_name is used
-    :return: True if file was uploaded, else False
+    :param sync: Only upload if the object in s3 is different. Interrupted uploads are resumed
+    :return: True if file was uploaded (or already in s3 with sync), else False
     """
 
     # If S3 object_name was not specified, use file_name
     if object_name is None:
         object_name = os.path.basename(file_name)
 
-    # edit config to stop timeout on large files
-    config = TransferConfig(multipart_threshold=1024*25, max_concurrency=10,
-                        multipart_chunksize=1024*25, use_threads=True)
+    if sync:
+        try:
+            sync_file(file_name, bucket, object_name)
+            return True
+        except Exception as e:
+            logging.error(f'Upload failed: {file_name}')
+            logging.error(e)
+            return False
+
+    # part size scaled to the file to stop timeout on large files
+    config = get_transfer_config(os.path.getsize(file_name))
 
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
     try:
-        response = s3_client.upload_file(
-            file_name, 
-            bucket, 
-            object_name, 
-            Callback=ProgressPercentage(file_name),
-            Config = config,
-            )
+        with telemetry.span('upload', file=object_name, bytes=os.path.getsize(file_name)):
+            response = s3_client.upload_file(
+                file_name, 
+                bucket, 
+                object_name, 
+                Config = config,
+                )
+        return True
     except Exception as e:
         logging.warning(e)
-        try:
-            time.sleep(10)
-            logging.info('boto3.client("s3").upload_file failed')
-            logging.info('attempting upload with aws cli')
-            command = f'aws s3 cp {file_name} s3://{bucket}/{object_name}'
-            logging.info(command)
-            os.system(command)
-        except Exception as e:
-            logging.info('aws cli cp failed')
-            logging.error(e)
-            raise e
+        time.sleep(10)
+        logging.info('boto3.client("s3").upload_file failed')
+        logging.info('attempting upload with aws cli')
+        command = ['aws', 's3', 'cp', file_name, f's3://{bucket}/{object_name}']
+        logging.info(' '.join(command))
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            logging.error('aws cli cp failed')
+            logging.error(result.stderr)
+            return False
+        return True
 
 def upload_files_in_folder( 
     local_folder, 
     s3_bucket, 
     s3_prefix='', 
-    exclude_ext = []):
-    """_summary_
+    exclude_ext = [],
+    max_workers=8,
+    sync=False,
+    exclude_dirs=False):
+    """Upload all files in a folder to s3. Files are uploaded concurrently with
+    a shared client and the parts of large files are uploaded in parallel.
+    With sync, files already in s3 with the same size and ETag are skipped
+    and interrupted multipart uploads are resumed.
 
     Args:
-        s3_client (boto3.client): instance of boto3 client with required credentials
         local_folder (str): local folder to be uploaded
         s3_bucket (str): s3 bucket to upload to
         s3_prefix (str, optional): prefix in the s3 bucket. Defaults to ''.
         excluse_ext (str, optional) : list of file extensions to exclude from upload
+        max_workers (int, optional): number of files uploaded at once. Defaults to 8.
+        sync (bool, optional): only upload files that are different in s3. Defaults to False.
+        exclude_dirs (bool, optional): only upload files at the top of the folder. Defaults to False.
+
+    Returns:
+        dict: upload report with the number of files and bytes uploaded, seconds, MB/s
+            and lists of the uploaded, skipped and failed files
     """
-    s3_client = boto3.client('s3')
+    uploads = []
     for root, dirs, files in os.walk(local_folder):
         for file in files:
             if exclude_ext:
@@ -102,5 +311,178 @@ def upload_files_in_folder(
             local_path = os.path.join(root, file)
             relative_path = os.path.relpath(local_path, local_folder)
             s3_key = os.path.join(s3_prefix, relative_path).replace("\\", "/")
-            s3_client.upload_file(local_path, s3_bucket, s3_key)
-            print(f"Uploaded {local_path} to s3://{s3_bucket}/{s3_key}")
\ No newline at end of file
+            uploads.append((local_path, s3_key))
+        if exclude_dirs:
+            break
+
+    s3_client = get_s3_client()
+    remote_objects = list_remote_objects(s3_bucket, s3_prefix) if sync else {}
+    def _upload(local_path, s3_key):
+        try:
+            with telemetry.span('upload', file=s3_key) as span:
+                if sync:
+                    if not sync_file(local_path, s3_bucket, s3_key, remote=remote_objects.get(s3_key)):
+                        span['skipped'] = True
+                        return 'skipped', 0
+                else:
+                    s3_client.upload_file(local_path, s3_bucket, s3_key,
+                                          Config=get_transfer_config(os.path.getsize(local_path)))
+                    logger.info(f"Uploaded {local_path} to s3://{s3_bucket}/{s3_key}")
+                span['bytes'] = os.path.getsize(local_path)
+            return 'uploaded', span['bytes']
+        except Exception as e:
+            logger.error(f'Upload failed: {local_path}')
+            logger.error(e)
+            return 'failed', 0
+
+    t_start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda u: _upload(*u), uploads))
+    seconds = time.time() - t_start
+    uploaded_bytes = sum(size for _, size in results)
+    report = {
+        'files' : sum(1 for status, _ in results if status == 'uploaded'),
+        'bytes' : uploaded_bytes,
+        'seconds' : seconds,
+        'MB/s' : (uploaded_bytes / 1024**2) / seconds if seconds > 0 else 0,
+    }
+    for status in ['uploaded', 'skipped', 'failed']:
+        report[status] = [u[0] for u, r in zip(uploads, results) if r[0] == status]
+    logger.info(f"Uploaded {report['files']} files, {report['bytes']/1024**2:.1f} MB "
+                f"in {report['seconds']:.1f}s ({report['MB/s']:.1f} MB/s), "
+                f"{len(report['skipped'])} skipped, {len(report['failed'])} failed")
+    return report
+
+class OutputStreamer(threading.Thread):
+    """Upload the burst products of a COMPASS run while it is running.
+    COMPASS writes each burst to its own folder in the product path, but makes
+    every folder before the first burst is processed, so a folder existing does
+    not mean it is finished. Only folders marked as finished with mark_complete
+    (e.g. by BurstProgress or when a shard ends) are uploaded (and optionally
+    deleted) during the run. When finish is called after the run every folder is
+    checked again and any that are new or have changed since they were uploaded
+    are uploaded.
+
+    Args:
+        local_folder (str): COMPASS product path
+        s3_bucket (str): s3 bucket to upload to
+        s3_prefix (str, optional): prefix in the s3 bucket. Defaults to ''.
+        interval (int, optional): seconds between checks for finished bursts. Defaults to 30.
+        delete (bool, optional): delete burst folders once uploaded. Defaults to False.
+        sync (bool, optional): only upload files that are different in s3. Defaults to False.
+        max_workers (int, optional): number of files uploaded at once. Defaults to 8.
+    """
+
+    def __init__(self, local_folder, s3_bucket, s3_prefix='', interval=30, delete=False, sync=False, max_workers=8):
+        super().__init__(daemon=True)
+        self.local_folder = local_folder
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self.interval = interval
+        self.delete = delete
+        self.sync = sync
+        self.max_workers = max_workers
+        self.reports = []
+        # folder -> state of its files when it was uploaded
+        self._uploaded = {}
+        self._complete = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def mark_complete(self, name):
+        """Mark a burst folder as finished so it is uploaded on the next check
+
+        Args:
+            name (str): name of the burst folder. e.g. t071_151218_iw2
+        """
+        with self._lock:
+            self._complete.add(name)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.upload_finished()
+
+    @staticmethod
+    def folder_state(path):
+        """Relative path, size and modification time of every file in a folder
+
+        Args:
+            path (str): path to the folder
+
+        Returns:
+            tuple: sorted (path, size, mtime_ns) of each file
+        """
+        state = []
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                state.append((os.path.relpath(os.path.join(root, name), path), stat.st_size, stat.st_mtime_ns))
+        return tuple(sorted(state))
+
+    def upload_finished(self, final=False):
+        """Upload the burst folders marked as finished that have not been uploaded
+
+        Args:
+            final (bool, optional): the run is over. Every folder that is new or has
+                changed since it was uploaded is uploaded. Defaults to False.
+        """
+        if not os.path.isdir(self.local_folder):
+            return
+        folders = sorted(f for f in os.listdir(self.local_folder) if os.path.isdir(os.path.join(self.local_folder, f)))
+        with self._lock:
+            candidates = folders if final else [f for f in folders if f in self._complete]
+            uploaded = dict(self._uploaded)
+        for folder in candidates:
+            local_path = os.path.join(self.local_folder, folder)
+            state = self.folder_state(local_path)
+            if not state or uploaded.get(folder) == state:
+                # empty or unchanged since it was uploaded
+                continue
+            logger.info(f'Streaming finished burst to s3 : {local_path}')
+            report = upload_files_in_folder(
+                local_path,
+                self.s3_bucket,
+                os.path.join(self.s3_prefix, folder),
+                max_workers=self.max_workers,
+                # files already uploaded are skipped if the folder changed
+                sync=self.sync or folder in uploaded)
+            self.reports.append(report)
+            if report['failed']:
+                # retried on the next check
+                continue
+            with self._lock:
+                self._uploaded[folder] = state
+            if self.delete:
+                logger.info(f'Deleting uploaded burst : {local_path}')
+                shutil.rmtree(local_path)
+
+    def finish(self):
+        """Stop checking, upload everything that is left and return a combined report
+
+        Returns:
+            dict: upload report. See upload_files_in_folder
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.upload_finished(final=True)
+        # files outside of the burst folders
+        self.reports.append(upload_files_in_folder(
+            self.local_folder,
+            self.s3_bucket,
+            self.s3_prefix,
+            max_workers=self.max_workers,
+            sync=self.sync,
+            exclude_dirs=True))
+        report = {
+            'files' : sum(r['files'] for r in self.reports),
+            'bytes' : sum(r['bytes'] for r in self.reports),
+            'seconds' : sum(r['seconds'] for r in self.reports),
+        }
+        report['MB/s'] = (report['bytes'] / 1024**2) / report['seconds'] if report['seconds'] > 0 else 0
+        for status in ['uploaded', 'skipped']:
+            report[status] = [p for r in self.reports for p in r[status]]
+        # failed bursts are retried, so only files that never uploaded have failed
+        done = set(report['uploaded'] + report['skipped'])
+        report['failed'] = sorted(set(p for r in self.reports for p in r['failed'] if p not in done))
+        return report
@@ -0,0 +1,292 @@
+import os
+import re
+import time
+import json
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import closing, contextmanager
+
+logger = logging.getLogger(__name__)
+
+def path_size(path):
+    """Size of a file or directory in bytes
+
+    Args:
+        path (str): file or directory
+
+    Returns:
+        int: size in bytes
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+def remove_path(path):
+    """Remove a file or directory if it exists
+
+    Args:
+        path (str): file or directory
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def orbit_validity(orbit_path):
+    """Get the mission and validity window from an orbit file name.
+    e.g. S1A_OPER_AUX_POEORB_OPOD_20190805T120708_V20190715T225942_20190717T005942.EOF
+
+    Args:
+        orbit_path (str): path to the orbit file
+
+    Returns:
+        tuple: (mission, orbit type, validity start, validity stop)
+    """
+    name = os.path.basename(orbit_path)
+    start, stop = re.search(r'_V(\d{8}T\d{6})_(\d{8}T\d{6})', name).groups()
+    return name[:3], name.split('_')[3], start, stop
+
+class ArtifactCache(object):
+    """Persistent cache of downloaded artifacts (scene zips, orbits, ETAD
+    products and DEMs). Artifacts stay where they are downloaded and are recorded
+    in a sqlite index under a key made from a hash of what was requested
+    (e.g. the scene name or DEM bounds and type). When the total size of the
+    cached artifacts is over max_size_gb the least recently used are deleted.
+
+    If index_path is None the cache is disabled. Nothing is found and
+    discard deletes paths immediately.
+
+    Files in keep_folders (e.g. the local orbit and ETAD archives) are never
+    deleted by discard or evict. Evicting one only removes it from the cache.
+
+    Artifacts that are found or added are pinned in the index with the process id
+    until they are discarded, so processes sharing the index do not evict each
+    other's artifacts. Pins of processes that have ended or are older than
+    pin_lease_hours are ignored.
+    """
+
+    def __init__(self, index_path=None, max_size_gb=100, keep_folders=None, pin_lease_hours=24):
+        self.index_path = index_path
+        self.max_size = int(float(max_size_gb)*1024**3)
+        self.keep_folders = [os.path.abspath(f) for f in (keep_folders or []) if f]
+        self.pin_lease = float(pin_lease_hours) * 3600
+        self._lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+            with self._connect() as con:
+                con.execute(
+                    'CREATE TABLE IF NOT EXISTS artifacts ('
+                    'key TEXT PRIMARY KEY, kind TEXT, path TEXT, size INTEGER, '
+                    'last_used REAL, label TEXT, start TEXT, stop TEXT, parts TEXT)')
+                con.execute('CREATE INDEX IF NOT EXISTS idx_kind ON artifacts (kind, label, start, stop)')
+                # artifacts in use by a run are never evicted, by this or any other
+                # process sharing the index (e.g. batch workers)
+                con.execute(
+                    'CREATE TABLE IF NOT EXISTS pins ('
+                    'key TEXT, pid INTEGER, expires REAL, PRIMARY KEY (key, pid))')
+
+    @property
+    def enabled(self):
+        return self.index_path is not None
+
+    @contextmanager
+    def _connect(self):
+        # commit on success and always close, a sqlite3 connection used as a
+        # context manager only commits
+        with closing(sqlite3.connect(self.index_path, timeout=60)) as con, con:
+            yield con
+
+    def is_kept(self, path):
+        """Check if a path is in one of the keep_folders
+
+        Args:
+            path (str): file or directory
+
+        Returns:
+            bool: True if the path is never deleted by the cache
+        """
+        return any(os.path.abspath(path).startswith(folder + os.sep) for folder in self.keep_folders)
+
+    @staticmethod
+    def make_key(kind, *parts):
+        """Make the cache key for an artifact
+
+        Args:
+            kind (str): type of artifact e.g. scene, orbit, etad, dem
+            parts : values that identify the artifact. e.g. scene name
+
+        Returns:
+            str: sha1 hex digest of the kind and parts
+        """
+        return hashlib.sha1(json.dumps([kind, *parts], default=str).encode()).hexdigest()
+
+    def _pin(self, con, key):
+        con.execute('INSERT OR REPLACE INTO pins VALUES (?,?,?)', (key, os.getpid(), time.time() + self.pin_lease))
+
+    @staticmethod
+    def _pinned(con):
+        # keys pinned by a running process with a lease that has not expired
+        pinned = set()
+        for key, pid, expires in con.execute('SELECT key, pid, expires FROM pins').fetchall():
+            try:
+                os.kill(pid, 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                # running as another user
+                alive = True
+            if alive and expires > time.time():
+                pinned.add(key)
+            else:
+                con.execute('DELETE FROM pins WHERE key=? AND pid=?', (key, pid))
+        return pinned
+
+    def _use(self, con, key, path):
+        # returns the path if it still exists and marks it as used, else forgets it
+        if not os.path.exists(path):
+            con.execute('DELETE FROM artifacts WHERE key=?', (key,))
+            return None
+        con.execute('UPDATE artifacts SET last_used=? WHERE key=?', (time.time(), key))
+        self._pin(con, key)
+        return path
+
+    def get(self, kind, *parts):
+        """Get the path of a cached artifact
+
+        Args:
+            kind (str): type of artifact
+            parts : values that identify the artifact
+
+        Returns:
+            str: path to the artifact. None if not cached
+        """
+        if not self.enabled:
+            return None
+        key = self.make_key(kind, *parts)
+        with self._lock, self._connect() as con:
+            row = con.execute('SELECT path FROM artifacts WHERE key=?', (key,)).fetchone()
+            path = self._use(con, key, row[0]) if row else None
+        if path:
+            logger.info(f'found {kind} in cache : {path}')
+        return path
+
+    def get_covering(self, kind, label, start, stop):
+        """Get a cached artifact whose time window covers start to stop.
+        Used for orbit files that are valid for many scenes.
+
+        Args:
+            kind (str): type of artifact
+            label (str): label the artifact was stored with. e.g. S1A_POEORB
+            start (str): start time. e.g. 20190716T135159
+            stop (str): stop time. e.g. 20190716T135226
+
+        Returns:
+            str: path to the artifact. None if not cached
+        """
+        if not self.enabled:
+            return None
+        with self._lock, self._connect() as con:
+            rows = con.execute(
+                'SELECT key, path FROM artifacts WHERE kind=? AND label=? AND start<=? AND stop>=? '
+                'ORDER BY last_used DESC', (kind, label, start, stop)).fetchall()
+            for key, path in rows:
+                if self._use(con, key, path):
+                    logger.info(f'found {kind} in cache : {path}')
+                    return path
+        return None
+
+    def put(self, kind, path, *parts, label=None, start=None, stop=None):
+        """Add an artifact to the cache and evict old artifacts if over budget.
+
+        Args:
+            kind (str): type of artifact
+            path (str): path to the artifact file or directory
+            parts : values that identify the artifact
+            label (str, optional): label for time window lookups. Defaults to None.
+            start (str, optional): start of the artifact time window. Defaults to None.
+            stop (str, optional): stop of the artifact time window. Defaults to None.
+
+        Returns:
+            str: path to the artifact
+        """
+        if not self.enabled:
+            return path
+        key = self.make_key(kind, *parts)
+        with self._lock, self._connect() as con:
+            con.execute(
+                'INSERT OR REPLACE INTO artifacts VALUES (?,?,?,?,?,?,?,?,?)',
+                (key, kind, os.path.abspath(path), path_size(path), time.time(),
+                 label, start, stop, json.dumps(parts, default=str)))
+            self._pin(con, key)
+        self.evict()
+        return path
+
+    def evict(self):
+        """Delete the least recently used artifacts until the cache is within
+        budget. Artifacts pinned by any running process sharing the index are kept.
+        """
+        if not self.enabled:
+            return
+        with self._lock, self._connect() as con:
+            # no other process can pin an artifact while the pins are checked
+            con.execute('BEGIN IMMEDIATE')
+            rows = con.execute('SELECT key, path, size FROM artifacts ORDER BY last_used ASC').fetchall()
+            pinned = self._pinned(con)
+            total = sum(r[2] for r in rows)
+            for key, path, size in rows:
+                if total <= self.max_size:
+                    break
+                if key in pinned:
+                    continue
+                if self.is_kept(path):
+                    # archived files only leave the cache
+                    logger.info(f'removing archived file from cache : {path}')
+                else:
+                    logger.info(f'evicting from cache : {path}')
+                    remove_path(path)
+                con.execute('DELETE FROM artifacts WHERE key=?', (key,))
+                total -= size
+
+    def release(self, path):
+        """Unpin a cached artifact so it can be evicted. The path is never deleted.
+
+        Args:
+            path (str): file or directory
+
+        Returns:
+            bool: True if the path is in the cache
+        """
+        if path is None or not self.enabled:
+            return False
+        with self._lock, self._connect() as con:
+            row = con.execute(
+                'SELECT key FROM artifacts WHERE path=?', (os.path.abspath(path),)).fetchone()
+            if row:
+                con.execute('DELETE FROM pins WHERE key=? AND pid=?', (row[0], os.getpid()))
+        return row is not None
+
+    def discard(self, path):
+        """Finished with a path. Cached artifacts are released and kept until
+        evicted, anything else is deleted.
+
+        Args:
+            path (str): file or directory
+        """
+        if path is None:
+            return
+        if self.is_kept(path):
+            logger.info(f'keeping archived file : {path}')
+            return
+        if self.release(path):
+            logger.info(f'keeping in cache : {path}')
+        else:
+            logger.info(f'Deleting {path}')
+            remove_path(path)
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+def file_hash(path, chunk_size=8*1024*1024):
+    """sha256 of the contents of a file
+
+    Args:
+        path (str): path to the file
+        chunk_size (int, optional): bytes read at a time. Defaults to 8MB.
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def sample_hash(path, sample_size=1024*1024):
+    """sha256 of the size and the first and last sample_size bytes of a file. Large
+    files such as the scene zips are not read in full, a change of their contents
+    also changes their size or modification time.
+
+    Args:
+        path (str): path to the file
+        sample_size (int, optional): bytes read from each end. Defaults to 1MB.
+
+    Returns:
+        str: hex digest
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha256(f'{size}\n'.encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            h.update(f.read(sample_size))
+    return h.hexdigest()
+
+def tree_hash(path):
+    """sha256 of the relative path, size and modification time of every file in a
+    directory. Directories such as the unzipped SAFE are too large to read every
+    time they are checked.
+
+    Args:
+        path (str): path to the directory
+
+    Returns:
+        tuple: (hex digest, total size in bytes)
+    """
+    h = hashlib.sha256()
+    total = 0
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            total += stat.st_size
+            h.update(f'{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return h.hexdigest(), total
+
+# files larger than this are fingerprinted with sample_hash instead of file_hash
+MAX_FULL_HASH_SIZE = 64*1024*1024
+
+def _content_hash(path, hash_type):
+    return sample_hash(path) if hash_type == 'sample' else file_hash(path)
+
+def fingerprint(path):
+    """Record of a stage output used to check it has not changed. Small files such
+    as configs are hashed in full, large files with sample_hash.
+
+    Args:
+        path (str): path to a file or directory
+
+    Returns:
+        dict: path, size, modification time and content hash
+    """
+    if os.path.isdir(path):
+        digest, size = tree_hash(path)
+        return {'path' : os.path.abspath(path), 'type' : 'dir', 'size' : size, 'hash' : digest}
+    stat = os.stat(path)
+    hash_type = 'sample' if stat.st_size > MAX_FULL_HASH_SIZE else 'full'
+    return {'path' : os.path.abspath(path), 'type' : 'file', 'size' : stat.st_size,
+            'mtime_ns' : stat.st_mtime_ns, 'hash_type' : hash_type, 'hash' : _content_hash(path, hash_type)}
+
+def check_fingerprint(record):
+    """Check a stage output matches its fingerprint. Files with the same size and
+    modification time are not hashed again.
+
+    Args:
+        record (dict): fingerprint of the output. See fingerprint
+
+    Returns:
+        bool: True if the output is unchanged
+    """
+    path = record['path']
+    if record['type'] == 'dir':
+        return os.path.isdir(path) and tree_hash(path)[0] == record['hash']
+    if not os.path.isfile(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != record['size']:
+        return False
+    if stat.st_mtime_ns == record['mtime_ns']:
+        return True
+    return _content_hash(path, record.get('hash_type', 'full')) == record['hash']
+
+def normalise(value):
+    # values are compared as they are stored in the json manifest
+    return json.loads(json.dumps(value, default=str))
+
+class Checkpoint(object):
+    """Manifest of the completed stages of a run, saved as json. Each stage is
+    recorded with the inputs it was run with and a fingerprint of each output.
+    A stage is complete on a re-run if the inputs are the same and every output
+    is unchanged, otherwise it is run again.
+
+    If path is None checkpointing is disabled and no stage is complete.
+
+    Args:
+        path (str, optional): path to the manifest. Defaults to None.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.stages = {}
+        if self.enabled and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.stages = json.load(f).get('stages', {})
+            logger.info(f'loaded checkpoint with {len(self.stages)} stages : {path}')
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'stages' : self.stages}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def complete(self, stage, outputs=None, inputs=None, data=None):
+        """Record a stage as complete
+
+        Args:
+            stage (str): name of the stage. e.g. dem, compass:<scene>
+            outputs (dict, optional): output name -> path. None paths are skipped. Defaults to None.
+            inputs (dict, optional): values the stage was run with. Defaults to None.
+            data (dict, optional): values needed to skip the stage on a re-run. Defaults to None.
+        """
+        if not self.enabled:
+            return
+        record = {
+            'inputs' : normalise(inputs or {}),
+            'outputs' : {k : fingerprint(p) for k, p in (outputs or {}).items() if p is not None},
+            'data' : normalise(data or {}),
+            'time' : time.time(),
+        }
+        with self._lock:
+            self.stages[stage] = record
+            self._save()
+
+    def verify(self, stage, inputs=None):
+        """Check if a stage is complete
+
+        Args:
+            stage (str): name of the stage
+            inputs (dict, optional): values the stage would be run with. Defaults to None.
+
+        Returns:
+            dict: the stage record if complete, else None
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            record = self.stages.get(stage)
+        if record is None:
+            return None
+        if record['inputs'] != normalise(inputs or {}):
+            logger.info(f'checkpoint inputs changed, rerunning stage : {stage}')
+            return None
+        for name, output in record['outputs'].items():
+            if not check_fingerprint(output):
+                logger.info(f'checkpoint output {name} changed, rerunning stage : {stage}')
+                return None
+        logger.info(f'stage complete in checkpoint, skipping : {stage}')
+        return record
@@ -0,0 +1,269 @@
+import os
+import re
+import time
+import signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.utils import run_command
+from utils.telemetry import telemetry
+from utils.safe import safe_polarizations
+
+logger = logging.getLogger(__name__)
+
+# COMPASS logs this line as it starts each burst
+# e.g. Starting geocoding of t071_151218_iw2 for 20190716
+BURST_START_PATTERN = re.compile(r'Starting geocoding of (t\d{3}_\d{6}_iw[1-3])', re.IGNORECASE)
+
+class BurstProgress(object):
+    """Follow the progress of a COMPASS run from its output. COMPASS processes the
+    bursts one after another, so a burst is finished when the next one starts or
+    the run ends successfully. Pass the instance as on_line and its check method as
+    the watchdog of run_command.
+
+    Args:
+        burst_timeout (float, optional): seconds a burst can take before the run is
+            stopped. Defaults to None.
+        on_burst_done (callable, optional): called with the id of each finished burst.
+            Defaults to None.
+    """
+
+    def __init__(self, burst_timeout=None, on_burst_done=None):
+        self.burst_timeout = burst_timeout
+        self.on_burst_done = on_burst_done
+        self.events = []
+        self.current = None
+        self.started = None
+        self._lock = threading.Lock()
+
+    def _event(self, event, burst_id, elapsed=None):
+        record = {'event' : event, 'burst_id' : burst_id, 'time' : time.time(), 'elapsed' : elapsed}
+        self.events.append(record)
+        logger.info(f'burst {event} : {burst_id}' + (f' in {elapsed:.1f}s' if elapsed is not None else ''))
+        return record
+
+    def _finish(self, event='finished'):
+        if self.current is None:
+            return
+        burst_id, started = self.current, self.started
+        elapsed = time.time() - started
+        self.current, self.started = None, None
+        self._event(event, burst_id, elapsed)
+        telemetry.add('burst', started, elapsed, burst_id=burst_id, status=event)
+        if event == 'finished' and self.on_burst_done is not None:
+            self.on_burst_done(burst_id)
+
+    def __call__(self, stream, line):
+        match = BURST_START_PATTERN.search(line)
+        if match:
+            with self._lock:
+                self._finish()
+                self.current, self.started = match.group(1).lower(), time.time()
+                self._event('started', self.current)
+
+    def check(self):
+        """Check the burst being processed has not timed out
+
+        Returns:
+            str: reason to stop the run. None if the burst is within the timeout
+        """
+        with self._lock:
+            if self.burst_timeout and self.current is not None and time.time() - self.started > self.burst_timeout:
+                return f'burst {self.current} took longer than {self.burst_timeout}s'
+        return None
+
+    def close(self, return_code):
+        """Finish the last burst when the run ends
+
+        Args:
+            return_code (int): return code of the run
+        """
+        with self._lock:
+            self._finish('finished' if return_code == 0 else 'failed')
+
+def write_runconfig(template_path, out_path, safe_path, orbit_path, burst_ids, dem_path,
+                    scratch_path, product_path, polarization_type, burst_database_file):
+    """Write a COMPASS runconfig from the template by replacing the CONFIG_ values
+
+    Args:
+        template_path (str): path to the runconfig template. e.g. configs/s1_cslc_geo.yaml
+        out_path (str): path to save the runconfig
+        safe_path (str): path to the SAFE file
+        orbit_path (str): path to the orbit file
+        burst_ids (list): burst ids to process. Empty to process all bursts
+        dem_path (str): path to the DEM
+        scratch_path (str): scratch folder for COMPASS
+        product_path (str): folder COMPASS saves the products to
+        polarization_type (str): co-pol or dual-pol
+        burst_database_file (str): path to the burst database
+
+    Returns:
+        str: path to the runconfig
+    """
+    with open(template_path, 'r') as f:
+        template_text = f.read()
+    # search for the strings we want to replaces
+    template_text = template_text.replace('CONFIG_SAFE_FILE_PATH',
+                                          str(safe_path))
+    template_text = template_text.replace('CONFIG_ORBIT_FILE_PATH',
+                                          str(orbit_path))
+    template_text = template_text.replace('CONFIG_BURST_ID',
+                                          str(burst_ids))
+    template_text = template_text.replace('CONFIG_DEM_FILE',
+                                          dem_path)
+    template_text = template_text.replace('CONFIG_SCRATCH_PATH',
+                                            scratch_path)
+    template_text = template_text.replace('CONFIG_PRODUCT_PATH',
+                                            product_path)
+    template_text = template_text.replace('CONFIG_POLARISATION',
+                                            polarization_type)
+    template_text = template_text.replace('CONFIG_BURST_DATABASE_FILE',
+                                          burst_database_file)
+    with open(out_path, 'w') as f:
+        f.write(template_text)
+    return out_path
+
+def get_scene_burst_ids(safe_path, orbit_path):
+    """Get the ids of all bursts in a scene
+
+    Args:
+        safe_path (str): path to the SAFE file or zip
+        orbit_path (str): path to the orbit file
+
+    Returns:
+        list: burst ids. e.g. [t071_151218_iw2, ...]
+    """
+    # s1reader is installed with COMPASS
+    import s1reader
+    # co-pol of the scene e.g. vv, s1reader expects lower case
+    pol = next(p for p in safe_polarizations(safe_path) if p[0] == p[1])
+    burst_ids = []
+    for swath in [1, 2, 3]:
+        bursts = s1reader.load_bursts(safe_path, orbit_path, swath, pol)
+        burst_ids += [str(burst.burst_id) for burst in bursts]
+    return burst_ids
+
+def shard_bursts(burst_ids, bursts_per_shard=1):
+    """Split burst ids into groups that are processed by separate COMPASS runs
+
+    Args:
+        burst_ids (list): burst ids
+        bursts_per_shard (int, optional): number of bursts in each group. Defaults to 1.
+
+    Returns:
+        list(list): groups of burst ids
+    """
+    bursts_per_shard = max(1, int(bursts_per_shard))
+    return [burst_ids[i:i + bursts_per_shard] for i in range(0, len(burst_ids), bursts_per_shard)]
+
+def get_available_memory_gb():
+    """Get the available memory from /proc/meminfo
+
+    Returns:
+        float: available memory in GB. None if it can not be read
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable'):
+                    return int(line.split()[1]) / 1024**2
+    except OSError:
+        return None
+
+def get_compass_workers(n_shards, memory_per_worker_gb=8, max_workers=None):
+    """Number of COMPASS runs to do at once, limited by cores and memory
+
+    Args:
+        n_shards (int): number of runs
+        memory_per_worker_gb (float, optional): memory needed by each run. Defaults to 8.
+        max_workers (int, optional): upper limit of runs at once. Defaults to None.
+
+    Returns:
+        int: number of runs at once
+    """
+    workers = os.cpu_count() or 1
+    memory_gb = get_available_memory_gb()
+    if memory_gb is not None:
+        workers = min(workers, int(memory_gb // memory_per_worker_gb))
+    if max_workers:
+        workers = min(workers, int(max_workers))
+    return max(1, min(workers, n_shards))
+
+def run_compass(runconfig_path, threads=None, prefix='', burst_ids=None, timeout=None,
+                burst_timeout=None, on_burst_done=None, on_start=None):
+    """Run COMPASS geocoded CSLC processing for a runconfig
+
+    Args:
+        runconfig_path (str): path to the runconfig
+        threads (int, optional): number of threads COMPASS can use. Defaults to None (all).
+        prefix (str, optional): prefix added to each logged line. Defaults to ''.
+        burst_ids (list, optional): bursts in the runconfig, recorded in the telemetry. Defaults to None.
+        timeout (float, optional): seconds before the run is stopped. Defaults to None.
+        burst_timeout (float, optional): seconds a single burst can take before the run
+            is stopped. Defaults to None.
+        on_burst_done (callable, optional): called with the id of each finished burst. Defaults to None.
+        on_start (callable, optional): called with the subprocess.Popen of COMPASS. Defaults to None.
+
+    Returns:
+        int: return code of COMPASS
+    """
+    command = f"s1_cslc.py --grid geo {runconfig_path}"
+    env = None
+    if threads is not None:
+        env = {**os.environ, 'OMP_NUM_THREADS' : str(threads)}
+    with telemetry.span('compass', runconfig=os.path.basename(runconfig_path),
+                        bursts=burst_ids, threads=threads) as span:
+        progress = BurstProgress(burst_timeout=burst_timeout, on_burst_done=on_burst_done)
+        span['return_code'] = run_command(
+            command, env=env, prefix=prefix, on_line=progress, timeout=timeout, watchdog=progress.check,
+            on_start=on_start)
+        progress.close(span['return_code'])
+        span['bursts_finished'] = sum(1 for e in progress.events if e['event'] == 'finished')
+    return span['return_code']
+
+def run_compass_shards(shards, workers, on_done=None, timeout=None, burst_timeout=None, on_burst_done=None,
+                       on_start=None):
+    """Run COMPASS for several runconfigs at once. The cores are split
+    evenly between the runs.
+
+    Args:
+        shards (list(tuple)): (runconfig path, burst ids) for each run
+        workers (int): number of runs at once
+        on_done (callable, optional): called with the burst ids of each run
+            when it finishes successfully. Defaults to None.
+        timeout (float, optional): seconds before the runs are stopped. The time is for
+            all the runs together, each run is given the time left when it starts. Defaults to None.
+        burst_timeout (float, optional): seconds a single burst can take. Defaults to None.
+        on_burst_done (callable, optional): called with the id of each finished burst. Defaults to None.
+        on_start (callable, optional): called with the subprocess.Popen of each run. Defaults to None.
+
+    Returns:
+        list: return code of each run
+    """
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    logger.info(f'Running {len(shards)} COMPASS shards, {workers} at once with {threads} threads each')
+
+    # one deadline for the scene, not for each shard
+    deadline = time.time() + timeout if timeout is not None else None
+
+    def _run(i, runconfig_path, burst_ids):
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.error(f'Shard {i+1} not started, timed out after {timeout}s : {burst_ids}')
+                return -signal.SIGTERM
+        logger.info(f'Starting shard {i+1} of {len(shards)} : {burst_ids}')
+        return_code = run_compass(
+            runconfig_path, threads=threads, prefix=f'[shard {i+1}] ', burst_ids=burst_ids,
+            timeout=remaining, burst_timeout=burst_timeout, on_burst_done=on_burst_done, on_start=on_start)
+        if return_code != 0:
+            logger.error(f'Shard {i+1} failed with return code {return_code} : {burst_ids}')
+        elif on_done is not None:
+            on_done(burst_ids)
+        return return_code
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run, i, path, burst_ids) for i, (path, burst_ids) in enumerate(shards)]
+        return [future.result() for future in futures]
@@ -1,10 +1,507 @@
+import os
+import math
+import logging
+import sqlite3
+from contextlib import closing
+import tarfile
+import rasterio
+import geopandas as gpd
+from urllib.request import urlretrieve
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rasterio.warp import calculate_default_transform, reproject, Resampling
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
+from dem_stitcher import stitch_dem
 
+from utils.raster import (tiled_profile, build_vrt, copy_raster_blocks, add_overviews, to_cog,
+                          reproject_raster, densify_bounds, densify_and_transform_bounds, transform_coords, transform_polygon,
+                          check_s1_bounds_cross_antimeridian, split_am_crossing, get_REMA_index_file)
+from utils.telemetry import telemetry
 
+logger = logging.getLogger(__name__)
 
-# def get_DEM_from_scene_bounds(scene_bounds, dem_type):
+def write_dem(in_path, out_path, compress='DEFLATE', blocksize=512, overviews=True, cog=False, fill=None):
+    """Write a DEM (e.g. a VRT mosaic) block by block as a tiled and compressed
+    GeoTIFF with a floating point predictor and internal overviews, or as a COG.
 
+    Args:
+        in_path (str): path of the DEM to write. e.g. a VRT
+        out_path (str): path to save the DEM
+        compress (str, optional): compression. e.g. DEFLATE, ZSTD. Defaults to 'DEFLATE'.
+        blocksize (int, optional): size of the internal tiles. Defaults to 512.
+        overviews (bool, optional): build internal overviews. Defaults to True.
+        cog (bool, optional): save as a cloud optimised GeoTIFF. Defaults to False.
+        fill (callable, optional): fills each block before it is written. See
+            copy_raster_blocks. Defaults to None.
 
-# antimeridian_crossing = check_s1_bounds_cross_antimeridian(scene_bounds)
-#     if antimeridian_crossing:
-#         # split into bounds either side of the AM
-#         bounds_left, bounds_right = split_am_crossing(scene_polygon, lat_buff=0.2)
\ No newline at end of file
+    Returns:
+        str: path to the DEM
+    """
+    with rasterio.open(in_path) as src:
+        profile = tiled_profile(src.profile, compress=compress, blocksize=blocksize)
+    tiled_path = out_path.replace('.tif', '_tiled.tif') if cog else out_path
+    logger.info(f'saving dem to {out_path}')
+    with telemetry.span('dem write', path=os.path.basename(out_path)) as span:
+        copy_raster_blocks(in_path, tiled_path, profile, fill=fill)
+        with rasterio.open(tiled_path, 'r+') as ds:
+            ds.update_tags(AREA_OR_POINT='Point')
+        if cog:
+            to_cog(tiled_path, out_path, compress=compress, blocksize=blocksize)
+            os.remove(tiled_path)
+        elif overviews:
+            add_overviews(out_path)
+        span['bytes'] = os.path.getsize(out_path)
+    return out_path
+
+def stitch_dem_to_file(bounds, dem_type, out_path, write_kwargs=None):
+    """Download and stitch a DEM for the bounds with ellipsoidal heights and save it.
+
+    Args:
+        bounds (tuple): (min_x, min_y, max_x, max_y) in 4326
+        dem_type (str): dem type. see https://pypi.org/project/dem-stitcher/
+        out_path (str): path to save the DEM
+        write_kwargs (dict, optional): output options passed to write_dem. Defaults to None.
+
+    Returns:
+        str: path to the DEM
+    """
+    # get the DEM and geometry information
+    with telemetry.span('dem stitch', dem_type=dem_type) as span:
+        dem_data, dem_meta = stitch_dem(bounds,
+                        dem_name=dem_type,
+                        dst_ellipsoidal_height=True,
+                        dst_area_or_point='Point',
+                        merge_nodata_value=0
+                        )
+        span['bytes'] = dem_data.nbytes
+    logger.info(f'DEM downloaded : {out_path}')
+    # save as tiled blocks, the stitcher returns the full array
+    write_kwargs = write_kwargs or {}
+    profile = tiled_profile(
+        dem_meta,
+        compress=write_kwargs.get('compress', 'DEFLATE'),
+        blocksize=write_kwargs.get('blocksize', 512))
+    tiled_path = out_path.replace('.tif', '_tiled.tif')
+    with telemetry.span('dem write', path=os.path.basename(out_path)) as span:
+        with rasterio.open(tiled_path, 'w', **profile) as ds:
+            for _, window in ds.block_windows(1):
+                ds.write(dem_data[window.toslices()], 1, window=window)
+            ds.update_tags(AREA_OR_POINT='Point')
+        del dem_data
+        if write_kwargs.get('cog', False):
+            to_cog(tiled_path, out_path,
+                   compress=write_kwargs.get('compress', 'DEFLATE'),
+                   blocksize=write_kwargs.get('blocksize', 512))
+            os.remove(tiled_path)
+        else:
+            os.replace(tiled_path, out_path)
+            if write_kwargs.get('overviews', True):
+                add_overviews(out_path)
+        span['bytes'] = os.path.getsize(out_path)
+    return out_path
+
+def dem_tile_cells(bounds, tile_size=1):
+    """Get the cells of a regular grid that cover the bounds.
+
+    Args:
+        bounds (tuple): (min_x, min_y, max_x, max_y) in 4326
+        tile_size (int, optional): size of the cells in degrees. Defaults to 1.
+
+    Returns:
+        list(tuple): bounds of each cell
+    """
+    min_x, min_y, max_x, max_y = bounds
+    x0 = math.floor(min_x / tile_size) * tile_size
+    y0 = math.floor(min_y / tile_size) * tile_size
+    cells = []
+    y = y0
+    while y < max_y:
+        x = x0
+        while x < max_x:
+            cells.append((x, y, x + tile_size, y + tile_size))
+            x += tile_size
+        y += tile_size
+    return cells
+
+def dem_tile_name(dem_type, cell):
+    """Name of a cached DEM tile. e.g. glo_30_S35_E148.tif
+
+    Args:
+        dem_type (str): dem type
+        cell (tuple): bounds of the tile cell
+
+    Returns:
+        str: file name of the tile
+    """
+    x, y = cell[0], cell[1]
+    lat = f'{"N" if y >= 0 else "S"}{abs(y):02g}'
+    lon = f'{"E" if x >= 0 else "W"}{abs(x):03g}'
+    return f'{dem_type}_{lat}_{lon}.tif'
+
+def get_dem_from_tile_cache(bounds, dem_type, tile_folder, out_path, tile_size=1, cache=None, write_kwargs=None):
+    """Make a DEM for the bounds from a persistent cache of ellipsoidal height
+    tiles. Only tiles not already in tile_folder are downloaded, so scenes that
+    overlap with previous runs reuse the stitched and converted tiles. If a tile
+    can not be made, e.g. over open ocean, the DEM is stitched for the full bounds.
+
+    Args:
+        bounds (tuple): (min_x, min_y, max_x, max_y) in 4326
+        dem_type (str): dem type. see https://pypi.org/project/dem-stitcher/
+        tile_folder (str): folder where the tiles are stored
+        out_path (str): path to save the DEM
+        tile_size (int, optional): size of the tiles in degrees. Defaults to 1.
+        cache (ArtifactCache, optional): tiles are added to the cache so they
+            are evicted with the other artifacts. Tiles are pinned until the DEM
+            is written. Defaults to None.
+        write_kwargs (dict, optional): output options passed to write_dem. Defaults to None.
+
+    Returns:
+        str: path to the DEM
+    """
+    os.makedirs(tile_folder, exist_ok=True)
+    cells = dem_tile_cells(bounds, tile_size)
+    tile_paths = []
+    for cell in cells:
+        tile_path = os.path.join(tile_folder, dem_tile_name(dem_type, cell))
+        if cache is not None and os.path.exists(tile_path):
+            # marks the tile as used and pins it so the puts below can not evict it
+            if cache.get('dem_tile', dem_type, cell) is None:
+                cache.put('dem_tile', tile_path, dem_type, cell)
+        if not os.path.exists(tile_path):
+            logger.info(f'Downloading DEM tile : {tile_path}')
+            try:
+                stitch_dem_to_file(cell, dem_type, tile_path, write_kwargs={'overviews' : False})
+            except Exception as e:
+                # e.g. no tiles over the ocean. a mosaic without the cell would leave a
+                # nodata hole, so the DEM is stitched over the full bounds instead,
+                # which fills the missing areas with the geoid like the non cache path
+                logger.warning(f'Could not make DEM tile for {cell}, stitching the DEM for the full bounds : {e}')
+                if cache is not None:
+                    for path in tile_paths:
+                        cache.release(path)
+                return stitch_dem_to_file(bounds, dem_type, out_path, write_kwargs=write_kwargs)
+            if cache is not None:
+                cache.put('dem_tile', tile_path, dem_type, cell)
+        tile_paths.append(tile_path)
+    logger.info(f'{len(tile_paths)} DEM tiles cover bounds : {bounds}')
+
+    # mosaic the tiles in a vrt and write the DEM block by block
+    vrt_path = out_path.replace('.tif', '.vrt')
+    build_vrt(tile_paths, vrt_path, bounds=bounds)
+    write_dem(vrt_path, out_path, **(write_kwargs or {}))
+    os.remove(vrt_path)
+    if cache is not None:
+        for tile_path in tile_paths:
+            cache.release(tile_path)
+    return out_path
+
+def get_continuous_crs(bounds):
+    """Get a projected crs that is continuous across the antimeridian for the bounds.
+    Polar stereographic at high latitudes, otherwise UTM zone 60.
+
+    Args:
+        bounds (tuple): (min_x, min_y, max_x, max_y) in 4326
+
+    Returns:
+        int: EPSG code
+    """
+    if bounds[1] < -50 or bounds[3] < -50:
+        return 3031
+    if bounds[1] > 50 or bounds[3] > 50:
+        return 3995
+    return 32760 if (bounds[1] + bounds[3]) / 2 < 0 else 32660
+
+def get_antimeridian_dem(scene_polygon, dem_type, out_path, buffer=0.3, dem_crs=None,
+                         num_threads=4, tile_folder=None, tile_size=1, cache=None, write_kwargs=None):
+    """Make a DEM for a scene that crosses the antimeridian. The scene is split into
+    bounds either side of the antimeridian which are downloaded in parallel, then
+    both are projected onto the same grid in a crs that is continuous across the
+    antimeridian and merged into a single DEM.
+
+    Args:
+        scene_polygon (shapely.polygon): polygon of the scene in 4326
+        dem_type (str): dem type. see https://pypi.org/project/dem-stitcher/
+        out_path (str): path to save the DEM
+        buffer (float, optional): buffer in degrees added around the scene. Defaults to 0.3.
+        dem_crs (int, optional): EPSG of the DEM. Defaults to None and get_continuous_crs is used.
+        num_threads (int, optional): number of GDAL threads used to reproject. Defaults to 4.
+        tile_folder (str, optional): use the DEM tile cache in this folder. Defaults to None.
+        tile_size (int, optional): size of the cached tiles in degrees. Defaults to 1.
+        cache (ArtifactCache, optional): artifact cache for the tiles. Defaults to None.
+        write_kwargs (dict, optional): output options passed to write_dem. Defaults to None.
+
+    Returns:
+        str: path to the DEM
+    """
+    # split into bounds either side of the AM
+    bounds_left, bounds_right = split_am_crossing(scene_polygon, lat_buff=buffer)
+    bounds_left = (bounds_left[0], bounds_left[1], min(bounds_left[2] + buffer, 180), bounds_left[3])
+    bounds_right = (max(bounds_right[0] - buffer, -180), bounds_right[1], bounds_right[2], bounds_right[3])
+    logger.info(f'Scene crosses the antimeridian, DEM bounds : {bounds_left} and {bounds_right}')
+    dem_crs = get_continuous_crs(bounds_left) if dem_crs is None else dem_crs
+    logger.info(f'DEM will be projected to EPSG:{dem_crs}')
+
+    # download both sides at the same time
+    side_paths = [out_path.replace('.tif', f'_{side}.tif') for side in ['left', 'right']]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        if tile_folder is not None:
+            futures = [executor.submit(
+                get_dem_from_tile_cache, bounds, dem_type, tile_folder, path,
+                tile_size=tile_size, cache=cache, write_kwargs={'overviews' : False})
+                for bounds, path in zip([bounds_left, bounds_right], side_paths)]
+        else:
+            futures = [executor.submit(
+                stitch_dem_to_file, bounds, dem_type, path, write_kwargs={'overviews' : False})
+                for bounds, path in zip([bounds_left, bounds_right], side_paths)]
+        for future in futures:
+            future.result()
+
+    # project both sides onto the same grid
+    with rasterio.open(side_paths[0]) as src:
+        transform, _, _ = calculate_default_transform(
+            src.crs, dem_crs, src.width, src.height, *src.bounds)
+    res = transform.a
+    side_bounds = [densify_and_transform_bounds(b, 4326, dem_crs) for b in [bounds_left, bounds_right]]
+    dst_bounds = (
+        min(b[0] for b in side_bounds), min(b[1] for b in side_bounds),
+        max(b[2] for b in side_bounds), max(b[3] for b in side_bounds))
+    proj_paths = [path.replace('.tif', f'_{dem_crs}.tif') for path in side_paths]
+    for path, proj_path in zip(side_paths, proj_paths):
+        logger.info(f'Reprojecting {path} to EPSG:{dem_crs}')
+        reproject_raster(path, proj_path, dem_crs, resampling='bilinear',
+                         num_threads=num_threads, dst_bounds=dst_bounds, dst_res=res)
+        os.remove(path)
+
+    # merge the sides, nodata outside each side is transparent in the vrt
+    vrt_path = out_path.replace('.tif', '.vrt')
+    build_vrt(proj_paths, vrt_path)
+    write_dem(vrt_path, out_path, **(write_kwargs or {}))
+    for path in proj_paths + [vrt_path]:
+        os.remove(path)
+    return out_path
+
+def rema_footprint(scene_polygon, buffer_m=20000):
+    """Get the scene footprint in polar stereographic (3031) buffered in metres.
+    Each point is transformed separately, so scenes crossing the antimeridian
+    make a continuous footprint.
+
+    Args:
+        scene_polygon (shapely.polygon): polygon of the scene in 4326
+        buffer_m (int, optional): buffer in metres. Defaults to 20000.
+
+    Returns:
+        shapely.polygon: buffered footprint in 3031
+    """
+    return transform_polygon(4326, 3031, scene_polygon).buffer(buffer_m)
+
+def download_rema_tile(fileurl, tile_folder):
+    """Download a REMA mosaic tile and extract the DEM from the archive.
+
+    Args:
+        fileurl (str): url of the tile archive from the REMA index.
+            e.g. https://data.pgc.umn.edu/elev/dem/setsm/REMA/mosaic/v2.0/32m/39_17/39_17_32m_v2.0.tar.gz
+        tile_folder (str): folder to save the tile
+
+    Returns:
+        str: path to the tile DEM
+    """
+    archive_name = os.path.basename(fileurl)
+    dem_path = os.path.join(tile_folder, archive_name.replace('.tar.gz', '_dem.tif'))
+    if os.path.exists(dem_path):
+        return dem_path
+    archive_path = os.path.join(tile_folder, archive_name)
+    logger.info(f'Downloading REMA tile : {fileurl}')
+    with telemetry.span('rema tile download', tile=archive_name) as span:
+        urlretrieve(fileurl, archive_path)
+        span['bytes'] = os.path.getsize(archive_path)
+    # only the dem is extracted from the archive
+    with tarfile.open(archive_path, 'r') as tar:
+        member = [m for m in tar.getmembers() if m.name.endswith('_dem.tif')][0]
+        member.name = os.path.basename(dem_path)
+        tar.extract(member, tile_folder)
+    os.remove(archive_path)
+    return dem_path
+
+def geoid_fill(dem_path, geoid_name='egm_08'):
+    """Make a block fill for copy_raster_blocks that sets the nodata pixels of an
+    ellipsoidal DEM to the geoid height, i.e. sea level. The same as the glo DEMs
+    where dem_stitcher merges nodata as 0 before the ellipsoid conversion. isce3
+    does not mask DEM nodata, so nodata left in the DEM would be used as a height.
+
+    Args:
+        dem_path (str): path of the DEM to fill. e.g. a VRT mosaic
+        geoid_name (str, optional): geoid from dem_stitcher. Defaults to 'egm_08'.
+
+    Returns:
+        callable: fill(data, window, dst) that returns the filled block
+    """
+    from dem_stitcher.geoid import read_geoid
+    with rasterio.open(dem_path) as src:
+        nodata = src.nodata
+        bounds = densify_and_transform_bounds(src.bounds, src.crs.to_epsg(), 4326, delta=(src.bounds[2] - src.bounds[0]) / 100)
+        if src.crs.to_epsg() == 3031 and src.bounds[0] < 0 < src.bounds[2] and src.bounds[1] < 0 < src.bounds[3]:
+            # the south pole is inside the DEM
+            bounds = (-180, -90, 180, bounds[3])
+    # the geoid around the DEM, padded by a few of its pixels
+    geoid, geoid_profile = read_geoid(geoid_name, extent=list(bounds), res_buffer=2)
+
+    def fill(data, window, dst):
+        missing = np.isnan(data) if nodata is None or np.isnan(nodata) else (data == nodata) | np.isnan(data)
+        if not missing.any():
+            return data
+        geoid_block = np.zeros(data.shape, dtype='float32')
+        reproject(
+            geoid,
+            geoid_block,
+            src_transform=geoid_profile['transform'],
+            src_crs=geoid_profile['crs'],
+            dst_transform=dst.window_transform(window),
+            dst_crs=dst.crs,
+            resampling=Resampling.bilinear)
+        return np.where(missing, geoid_block, data).astype(data.dtype)
+    return fill
+
+def get_rema_dem(scene_polygon, dem_type, out_path, index_folder, tile_folder, buffer_m=20000,
+                 workers=4, cache=None, write_kwargs=None):
+    """Make a DEM from the REMA mosaic for a scene. The REMA index is downloaded
+    once and queried for the tiles that intersect the buffered polar stereographic
+    footprint of the scene. Missing tiles are downloaded concurrently and mosaicked
+    through a VRT which is written block by block. REMA heights are relative to the
+    WGS84 ellipsoid so no geoid correction is applied. Nodata (ocean and gaps in the
+    mosaic) is filled with the geoid height, see geoid_fill.
+
+    Args:
+        scene_polygon (shapely.polygon): polygon of the scene in 4326
+        dem_type (str): REMA dem type with resolution. e.g. REMA_32
+        out_path (str): path to save the DEM
+        index_folder (str): folder where the REMA index is stored
+        tile_folder (str): folder where the REMA tiles are stored
+        buffer_m (int, optional): buffer around the scene in metres. Defaults to 20000.
+        workers (int, optional): number of tiles downloaded at once. Defaults to 4.
+        cache (ArtifactCache, optional): artifact cache for the tiles. Defaults to None.
+        write_kwargs (dict, optional): output options passed to write_dem. Defaults to None.
+
+    Returns:
+        str: path to the DEM
+    """
+    resolution = int(str(dem_type).split('_')[-1])
+    footprint = rema_footprint(scene_polygon, buffer_m)
+    logger.info(f'REMA footprint bounds (EPSG:3031) : {footprint.bounds}')
+
+    # find the tiles that intersect the footprint
+    index_path = get_REMA_index_file(index_folder)
+    layers = [l for l in gpd.list_layers(index_path)['name'] if l.endswith(f'_{resolution}m')]
+    if len(layers) == 0:
+        raise ValueError(f'No REMA index layer found for resolution {resolution}m in {index_path}')
+    index = gpd.read_file(index_path, layer=layers[0], bbox=footprint.bounds).to_crs(3031)
+    index = index[index.intersects(footprint)]
+    logger.info(f'{len(index)} REMA tiles intersect the scene')
+    if len(index) == 0:
+        raise ValueError(f'No {dem_type} tiles found for scene : {scene_polygon.bounds}')
+
+    # download the tiles
+    os.makedirs(tile_folder, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tile_paths = list(executor.map(
+            lambda url: download_rema_tile(url, tile_folder), index['fileurl']))
+    if cache is not None:
+        for tile_path in tile_paths:
+            cache.put('dem_tile', tile_path, dem_type, os.path.basename(tile_path))
+
+    # mosaic the tiles on the REMA grid and write the DEM block by block
+    left, bottom, right, top = footprint.bounds
+    bounds = (
+        math.floor(left / resolution) * resolution,
+        math.floor(bottom / resolution) * resolution,
+        math.ceil(right / resolution) * resolution,
+        math.ceil(top / resolution) * resolution)
+    vrt_path = out_path.replace('.tif', '.vrt')
+    build_vrt(tile_paths, vrt_path, bounds=bounds, res=(resolution, resolution))
+    write_dem(vrt_path, out_path, fill=geoid_fill(vrt_path), **(write_kwargs or {}))
+    os.remove(vrt_path)
+    return out_path
+
+def get_burst_polygon(burst_ids, burst_database_file, buffer_m=5000, delta_m=1000):
+    """Get the footprint of a set of bursts from the burst database, buffered in
+    metres. Each burst box is buffered in the projected crs it is stored with
+    (UTM or polar stereographic) and transformed to 4326 with points along its
+    sides, so the footprint is correct at high latitudes. Far smaller than the
+    scene footprint when only some of the bursts are processed.
+
+    Args:
+        burst_ids (list): COMPASS burst ids. e.g. ['t071_151218_iw2']
+        burst_database_file (str): path to the opera burst sqlite database
+        buffer_m (float, optional): buffer in metres. Defaults to 5000.
+        delta_m (float, optional): distance between the points along the box sides
+            in metres. Defaults to 1000.
+
+    Returns:
+        shapely.polygon: footprint of the bursts in 4326. None if a burst is not in
+            the database or the bursts cross the antimeridian
+    """
+    burst_ids = [b.lower() for b in burst_ids]
+    with closing(sqlite3.connect(burst_database_file)) as con:
+        rows = con.execute(
+            f'SELECT burst_id_jpl, epsg, xmin, ymin, xmax, ymax FROM burst_id_map '
+            f'WHERE burst_id_jpl IN ({",".join("?" * len(burst_ids))})', burst_ids).fetchall()
+    missing = set(burst_ids) - {row[0] for row in rows}
+    if missing:
+        logger.warning(f'bursts not found in the burst database : {sorted(missing)}')
+        return None
+    polygons = []
+    for burst_id, epsg, xmin, ymin, xmax, ymax in rows:
+        bbox = (xmin - buffer_m, ymin - buffer_m, xmax + buffer_m, ymax + buffer_m)
+        xs, ys = transform_coords(epsg, 4326, *densify_bounds(bbox, delta_m))
+        polygon = Polygon(zip(xs, ys))
+        if check_s1_bounds_cross_antimeridian(polygon.bounds):
+            logger.info(f'burst crosses the antimeridian : {burst_id}')
+            return None
+        polygons.append(polygon)
+    burst_polygon = unary_union(polygons)
+    if burst_polygon.geom_type != 'Polygon':
+        # bursts in different swaths or tracks do not overlap
+        burst_polygon = burst_polygon.convex_hull
+    return burst_polygon
+
+def get_DEM_from_scene_bounds(scene_bounds, dem_type, out_path, scene_polygon=None, buffer=0.3,
+                              tile_folder=None, tile_size=1, cache=None, write_kwargs=None,
+                              rema_index_folder=None, rema_tile_folder=None, workers=4):
+    """Get the DEM for the bounds of a scene. REMA DEMs are made from the REMA
+    mosaic, see get_rema_dem. Scenes that cross the antimeridian are split and
+    merged into a single projected DEM, see get_antimeridian_dem.
+
+    Args:
+        scene_bounds (tuple): (min_x, min_y, max_x, max_y) in 4326. Buffered unless
+            the scene crosses the antimeridian
+        dem_type (str): dem type. see https://pypi.org/project/dem-stitcher/
+        out_path (str): path to save the DEM
+        scene_polygon (shapely.polygon, optional): polygon of the scene in 4326.
+            Required if the scene crosses the antimeridian. Defaults to None.
+        buffer (float, optional): buffer in degrees for antimeridian scenes. Defaults to 0.3.
+        tile_folder (str, optional): use the DEM tile cache in this folder. Defaults to None.
+        tile_size (int, optional): size of the cached tiles in degrees. Defaults to 1.
+        cache (ArtifactCache, optional): artifact cache for the tiles. Defaults to None.
+        write_kwargs (dict, optional): output options passed to write_dem. Defaults to None.
+        rema_index_folder (str, optional): folder for the REMA index. Required for REMA. Defaults to None.
+        rema_tile_folder (str, optional): folder for the REMA tiles. Required for REMA. Defaults to None.
+        workers (int, optional): number of REMA tiles downloaded at once. Defaults to 4.
+
+    Returns:
+        str: path to the DEM
+    """
+    if 'REMA' in str(dem_type).upper():
+        # buffer in degrees of latitude to metres
+        return get_rema_dem(
+            scene_polygon, dem_type, out_path, rema_index_folder, rema_tile_folder,
+            buffer_m=buffer * 111_000, workers=workers, cache=cache, write_kwargs=write_kwargs)
+    if check_s1_bounds_cross_antimeridian(scene_bounds):
+        return get_antimeridian_dem(
+            scene_polygon, dem_type, out_path, buffer=buffer, tile_folder=tile_folder,
+            tile_size=tile_size, cache=cache, write_kwargs=write_kwargs)
+    if tile_folder is not None:
+        # build the DEM from tiles shared with previous runs
+        return get_dem_from_tile_cache(
+            scene_bounds, dem_type, tile_folder, out_path,
+            tile_size=tile_size, cache=cache, write_kwargs=write_kwargs)
+    return stitch_dem_to_file(scene_bounds, dem_type, out_path, write_kwargs=write_kwargs)
@@ -0,0 +1,426 @@
+import os
+import time
+import logging
+import threading
+import zipfile
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import asf_search as asf
+from eof.download import download_eofs
+
+from utils.cache import ArtifactCache, orbit_validity
+from utils.safe import extract_safe
+from utils.product_index import ProductIndex, scene_window
+from utils.telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+# default number of simultaneous requests allowed against each service
+SERVICE_LIMITS = {
+    'asf' : 2, # scene search and download
+    'orbit' : 2, # precise / restituted orbit server
+    'copernicus' : 1, # ETAD search and download
+}
+
+# days after a scene before its precise orbit is published
+PRECISE_ORBIT_DELAY_DAYS = 21
+
+def make_service_limits(limits=None):
+    """Make a semaphore for each remote service so the number of concurrent
+    requests against it is bounded independently of the worker pool size.
+
+    Args:
+        limits (dict, optional): service name -> max concurrent requests.
+            Missing services use the values in SERVICE_LIMITS. Defaults to None.
+
+    Returns:
+        dict: service name -> threading.BoundedSemaphore
+    """
+    limits = {**SERVICE_LIMITS, **(limits or {})}
+    return {k : threading.BoundedSemaphore(int(v)) for k, v in limits.items()}
+
+def download_scene_orbits(scene_zip, precise_orbit_folder, restituted_orbit_folder, asf_user, asf_password, cache=None, index=None):
+    """Download the orbit file for a scene. Precise orbits are used if
+    available, otherwise restituted orbits are downloaded. Local orbit files
+    in the index and orbit files in the cache that cover the scene are used
+    before downloading.
+
+    Args:
+        scene_zip (str): path to the scene zip file
+        precise_orbit_folder (str): directory to save precise orbits
+        restituted_orbit_folder (str): directory to save restituted orbits
+        asf_user (str): earthdata username
+        asf_password (str): earthdata password
+        cache (ArtifactCache, optional): artifact cache. Defaults to None.
+        index (ProductIndex, optional): index of the local orbit files. Defaults to None.
+
+    Returns:
+        str: path to the orbit file
+    """
+    cache = ArtifactCache() if cache is None else cache
+    index = ProductIndex(folders=[precise_orbit_folder, restituted_orbit_folder]) if index is None else index
+    mission, mode, pol, start, stop = scene_window(scene_zip)
+
+    orbit_path = index.find_orbit(scene_zip, 'POEORB') or cache.get_covering('orbit', f'{mission}_POEORB', start, stop)
+    if orbit_path is None:
+        prec_orb_files = download_eofs(sentinel_file=scene_zip,
+                        save_dir=precise_orbit_folder,
+                        orbit_type='precise')
+        if len(prec_orb_files) > 0:
+            orbit_path = cache_orbit(cache, index.add(str(prec_orb_files[0])))
+    if orbit_path is not None:
+        logger.info(f'using precise orbits: {orbit_path}')
+        return orbit_path
+
+    orbit_path = index.find_orbit(scene_zip, 'RESORB') or cache.get_covering('orbit', f'{mission}_RESORB', start, stop)
+    if orbit_path is None:
+        #download restituted orbits
+        res_orb_files = download_eofs(sentinel_file=scene_zip,
+                        save_dir=restituted_orbit_folder,
+                        orbit_type='restituted',
+                        asf_user=asf_user,
+                        asf_password=asf_password,
+                        )
+        orbit_path = cache_orbit(cache, index.add(str(res_orb_files[0])))
+    logger.info(f'using restituted orbits: {orbit_path}')
+    return orbit_path
+
+def cache_orbit(cache, orbit_path):
+    """Add an orbit file to the cache keyed by its validity window
+
+    Args:
+        cache (ArtifactCache): artifact cache
+        orbit_path (str): path to the orbit file
+
+    Returns:
+        str: path to the orbit file
+    """
+    mission, orbit_type, start, stop = orbit_validity(orbit_path)
+    return cache.put('orbit', orbit_path, os.path.basename(orbit_path),
+                     label=f'{mission}_{orbit_type}', start=start, stop=stop)
+
+def prefetch_orbits(scenes, index, precise_orbit_folder, restituted_orbit_folder, asf_user, asf_password):
+    """Download the orbit files missing from the index for a list of scenes in one
+    request for each orbit type. Scenes too recent for a precise orbit get a
+    restituted orbit. Scenes still missing an orbit after the prefetch are
+    downloaded one at a time by download_scene_orbits.
+
+    Args:
+        scenes (list): scene names
+        index (ProductIndex): index of the local orbit files
+        precise_orbit_folder (str): directory to save precise orbits
+        restituted_orbit_folder (str): directory to save restituted orbits
+        asf_user (str): earthdata username
+        asf_password (str): earthdata password
+
+    Returns:
+        list: scenes without a local orbit file after the prefetch
+    """
+    precise_after = datetime.utcnow() - timedelta(days=PRECISE_ORBIT_DELAY_DAYS)
+    missing = [s for s in scenes if index.find_orbit(s, 'POEORB') is None and index.find_orbit(s, 'RESORB') is None]
+    logger.info(f'{len(scenes) - len(missing)} of {len(scenes)} scenes have local orbit files')
+    for orbit_type, label, save_dir in [('precise', 'POEORB', precise_orbit_folder),
+                                        ('restituted', 'RESORB', restituted_orbit_folder)]:
+        if orbit_type == 'precise':
+            batch = [s for s in missing if datetime.strptime(scene_window(s)[3], '%Y%m%dT%H%M%S') < precise_after]
+        else:
+            batch = missing
+        if not batch:
+            continue
+        logger.info(f'downloading {orbit_type} orbits for {len(batch)} scenes')
+        try:
+            with telemetry.span('orbit prefetch', orbit_type=orbit_type, scenes=len(batch)):
+                orbit_files = download_eofs(
+                    orbit_dts=[scene_window(s)[3] for s in batch],
+                    missions=[scene_window(s)[0] for s in batch],
+                    save_dir=save_dir,
+                    orbit_type=orbit_type,
+                    asf_user=asf_user,
+                    asf_password=asf_password)
+        except Exception as e:
+            logger.error(f'{orbit_type} orbit prefetch failed : {e}')
+            continue
+        for orbit_file in orbit_files:
+            index.add(str(orbit_file))
+        missing = [s for s in missing if index.find_orbit(s, label) is None]
+    if missing:
+        logger.warning(f'{len(missing)} scenes without local orbit files after prefetch : {missing}')
+    return missing
+
+def burst_id_to_asf(burst_id):
+    """Convert a COMPASS/OPERA burst id to the ASF full burst id.
+    e.g. t071_151218_iw2 -> 071_151218_IW2
+
+    Args:
+        burst_id (str): COMPASS burst id
+
+    Returns:
+        str: asf full burst id
+    """
+    return burst_id.lower().lstrip('t').upper()
+
+def search_scenes(scenes, burst_ids=None):
+    """Search asf for all scenes in a single batched request. If burst_ids are
+    given the bursts are also searched for in one request and each scene is checked
+    to contain every burst.
+
+    Args:
+        scenes (list): list of scene names
+        burst_ids (list, optional): list of COMPASS burst ids e.g. [t071_151218_iw2].
+            Defaults to None.
+
+    Returns:
+        tuple: (dict of scene name -> asf product, list of missing scenes).
+            Scenes that do not contain the requested bursts are reported as missing
+    """
+    logger.info(f'searching asf for {len(scenes)} scenes...')
+    with telemetry.span('search', scenes=len(scenes)):
+        asf_results = asf.granule_search(list(scenes), asf.ASFSearchOptions(processingLevel='SLC'))
+    found = {}
+    for asf_result in asf_results:
+        name = asf_result.__dict__['umm']['GranuleUR'].split('-')[0]
+        found[name] = asf_result
+    lookup = {scene : found[scene] for scene in scenes if scene in found}
+
+    if burst_ids and lookup:
+        # search the bursts over the time range of the scenes
+        start = min(r.properties['startTime'] for r in lookup.values())
+        end = max(r.properties['stopTime'] for r in lookup.values())
+        full_burst_ids = [burst_id_to_asf(b) for b in burst_ids]
+        logger.info(f'searching asf for {len(full_burst_ids)} bursts...')
+        with telemetry.span('burst search', bursts=len(full_burst_ids)):
+            burst_results = asf.search(
+                fullBurstID=full_burst_ids,
+                processingLevel='BURST',
+                start=start,
+                end=end)
+        for scene, asf_result in list(lookup.items()):
+            scene_start = asf_result.properties['startTime']
+            scene_stop = asf_result.properties['stopTime']
+            scene_bursts = set(
+                b.properties['burst']['fullBurstID'] for b in burst_results
+                if scene_start <= b.properties['startTime'] <= scene_stop
+                and b.properties['platform'] == asf_result.properties['platform'])
+            missing_bursts = [b for b in full_burst_ids if b not in scene_bursts]
+            if missing_bursts:
+                logger.error(f'bursts {missing_bursts} not found in scene : {scene}')
+                del lookup[scene]
+
+    missing = [scene for scene in scenes if scene not in lookup]
+    logger.info(f'{len(lookup)} of {len(scenes)} scenes found')
+    if missing:
+        logger.error(f'{len(missing)} scenes not found : {missing}')
+    return lookup, missing
+
+def acquire_scene(scene, asf_result, main_config, session, earthdata_creds, copernicus_creds, limits, cache, index=None):
+    """Download, unzip, ETAD correct and get the orbits for a single scene. Only the
+    SAFE files of the swaths and polarisations being processed are unzipped unless
+    unzip_subset is False.
+    Calls to remote services are wrapped in the matching semaphore from limits.
+
+    Args:
+        scene (str): scene name
+        asf_result (asf.ASFProduct): search result for the scene. See search_scenes
+        main_config (dict): the run config
+        session (asf.ASFSession): authenticated asf session
+        earthdata_creds (tuple): (username, password) for earthdata
+        copernicus_creds (tuple): (username, password) for copernicus dataspace.
+            Only required if main_config['apply_ETAD'] is set
+        limits (dict): service name -> semaphore. See make_service_limits
+        cache (ArtifactCache): artifact cache checked before downloading
+        index (ProductIndex, optional): index of the local orbit and ETAD files
+            checked before downloading. Defaults to None.
+
+    Returns:
+        dict: paths and properties of the acquired scene
+    """
+    SCENE_NAME = asf_result.__dict__['umm']['GranuleUR'].split('-')[0]
+    if index is None:
+        index = ProductIndex(folders=[main_config['precise_orbit_folder'], main_config['restituted_orbit_folder'],
+                                      main_config.get('ETAD_folder')])
+    POLARIZATION = asf_result.properties['polarization']
+    POLARIZATION_TYPE = 'dual-pol' if len(POLARIZATION) > 2 else 'co-pol' # string for template value
+    scene_zip = os.path.join(main_config['scene_folder'], SCENE_NAME + '.zip')
+
+    # download scene
+    cached_zip = cache.get('scene', SCENE_NAME)
+    if cached_zip is not None:
+        scene_zip = cached_zip
+    elif os.path.exists(scene_zip) and zipfile.is_zipfile(scene_zip):
+        # complete zip from a previous run. partial downloads fail the zip check
+        logger.info(f'scene already downloaded : {scene_zip}')
+        cache.put('scene', scene_zip, SCENE_NAME)
+    else:
+        logger.info(f'downloading scene : {SCENE_NAME}')
+        with limits['asf'], telemetry.span('scene download', scene=scene) as span:
+            asf_result.download(path=main_config['scene_folder'], session=session)
+            span['bytes'] = os.path.getsize(scene_zip)
+        cache.put('scene', scene_zip, SCENE_NAME)
+
+    # the swaths and polarisations COMPASS will process
+    swaths = sorted({b.split('_')[-1] for b in main_config['burst_ids'] or []}) or None
+    polarizations = [POLARIZATION[:2]] if POLARIZATION_TYPE == 'co-pol' else None
+
+    # unzip scene. without an unzip COMPASS reads the zip directly
+    ORIGINAL_SAFE_PATH = scene_zip.replace(".zip",".SAFE")
+    if main_config['unzip_scene'] or main_config['apply_ETAD']:
+        # the full ETAD correction needs every swath
+        subset = main_config.get('unzip_subset', True) and (
+            not main_config['apply_ETAD'] or main_config.get('ETAD_subset', True))
+        with telemetry.span('unzip', scene=scene):
+            ORIGINAL_SAFE_PATH = extract_safe(
+                scene_zip,
+                os.path.dirname(scene_zip),
+                swaths=swaths if subset else None,
+                polarizations=polarizations if subset else None,
+                workers=main_config.get('unzip_workers', 4))
+
+    # apply the ETAD corrections to the SLC
+    ETAD_SAFE_PATH = None
+    if main_config['apply_ETAD']:
+        # s1etad is installed separately to the other requirements
+        from utils.etad import download_scene_etad, apply_etad_correction, apply_etad_correction_subset
+        logger.info(f'Applying ETAD corrections : {SCENE_NAME}')
+        etad_path = cache.get('etad', SCENE_NAME) or index.find_etad(SCENE_NAME)
+        if etad_path is None:
+            with limits['copernicus'], telemetry.span('etad download', scene=scene):
+                etad_path = download_scene_etad(
+                    SCENE_NAME,
+                    *copernicus_creds,
+                    etad_dir=main_config['ETAD_folder'])
+            cache.put('etad', index.add(etad_path), SCENE_NAME)
+        # a SAFE with only some channels corrected is kept apart from a fully corrected one
+        ETAD_SCENE_FOLDER = f'{main_config["scene_folder"]}_ETAD'
+        if main_config.get('ETAD_subset', True):
+            ETAD_SCENE_FOLDER += '_subset'
+        logger.info(f'making new directory for etad corrected slc : {ETAD_SCENE_FOLDER}')
+        with telemetry.span('etad correction', scene=scene):
+            if main_config.get('ETAD_subset', True):
+                # only correct the swaths and polarisations COMPASS will process
+                ETAD_SAFE_PATH = apply_etad_correction_subset(
+                    ORIGINAL_SAFE_PATH,
+                    etad_path,
+                    out_dir=ETAD_SCENE_FOLDER,
+                    nthreads=main_config['gdal_threads'],
+                    swaths=swaths,
+                    polarizations=polarizations,
+                    workers=main_config.get('ETAD_workers', 1))
+            else:
+                ETAD_SAFE_PATH = apply_etad_correction(
+                    ORIGINAL_SAFE_PATH,
+                    etad_path,
+                    out_dir=ETAD_SCENE_FOLDER,
+                    nthreads=main_config['gdal_threads'])
+
+    # download orbits
+    logger.info(f'downloading orbit files for scene : {SCENE_NAME}')
+    with limits['orbit'], telemetry.span('orbit', scene=scene):
+        ORBIT_PATH = download_scene_orbits(
+            scene_zip,
+            main_config['precise_orbit_folder'],
+            main_config['restituted_orbit_folder'],
+            *earthdata_creds,
+            cache=cache,
+            index=index)
+
+    return {
+        'scene' : scene,
+        'asf_result' : asf_result,
+        'SCENE_NAME' : SCENE_NAME,
+        'POLARIZATION_TYPE' : POLARIZATION_TYPE,
+        'scene_zip' : scene_zip,
+        'ORIGINAL_SAFE_PATH' : ORIGINAL_SAFE_PATH,
+        'ETAD_SAFE_PATH' : ETAD_SAFE_PATH,
+        # set as the safe file for processing
+        'SAFE_PATH' : ETAD_SAFE_PATH if main_config['apply_ETAD'] else ORIGINAL_SAFE_PATH if main_config['unzip_scene'] else scene_zip,
+        'ORBIT_PATH' : ORBIT_PATH,
+    }
+
+class SceneAcquirer(object):
+    """Acquire scenes in the background with a bounded worker pool and hand them
+    back in order. Downloads start when the acquirer is made, so the scenes
+    further down the list download while earlier ones are processed. Each worker
+    runs the full acquisition for a scene (see acquire_scene) and requests to each
+    remote service are limited separately by service_limits.
+
+    Args:
+        scene_lookup (dict): scene name -> asf product. See search_scenes
+        main_config (dict): the run config
+        earthdata_creds (tuple): (username, password) for earthdata
+        copernicus_creds (tuple, optional): (username, password) for copernicus dataspace. Defaults to None.
+        max_workers (int, optional): number of scenes acquired at once. Defaults to 4.
+        service_limits (dict, optional): service name -> max concurrent requests. Defaults to None.
+        cache (ArtifactCache, optional): artifact cache checked before downloading. Defaults to None.
+        prefetch (int, optional): number of scenes acquired ahead of the scene being
+            processed. Limits the disk used by a long stack. Defaults to None (all scenes).
+        index (ProductIndex, optional): index of the local orbit and ETAD files. Orbits
+            missing for any scene are downloaded together before the scenes.
+            Defaults to None (an index of the configured folders).
+    """
+
+    def __init__(self, scene_lookup, main_config, earthdata_creds, copernicus_creds=None, max_workers=4,
+                 service_limits=None, cache=None, prefetch=None, index=None):
+        self.scene_lookup = scene_lookup
+        self.scenes = list(scene_lookup.keys())
+        self.main_config = main_config
+        self.earthdata_creds = earthdata_creds
+        self.copernicus_creds = copernicus_creds
+        self.limits = make_service_limits(service_limits)
+        self.cache = ArtifactCache() if cache is None else cache
+        self.prefetch = len(self.scenes) if prefetch is None else max(1, int(prefetch))
+        self.session = asf.ASFSession()
+        self.session.auth_with_creds(*earthdata_creds)
+        self.index = ProductIndex(
+            main_config.get('product_index_file'),
+            folders=[main_config['precise_orbit_folder'], main_config['restituted_orbit_folder'],
+                     main_config.get('ETAD_folder')]) if index is None else index
+        if self.scenes:
+            with self.limits['orbit']:
+                prefetch_orbits(self.scenes, self.index, main_config['precise_orbit_folder'],
+                                main_config['restituted_orbit_folder'], *earthdata_creds)
+        missing_etad = [s for s in self.scenes if self.index.find_etad(s) is None] if main_config['apply_ETAD'] else []
+        if missing_etad:
+            # find the ETAD products of every scene not held locally in one catalogue query
+            from utils.etad import get_etad_fetcher
+            try:
+                get_etad_fetcher(*copernicus_creds).search(missing_etad)
+            except Exception as e:
+                logger.error(f'ETAD search failed : {e}')
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+        self._futures = {}
+        for i in range(min(self.prefetch, len(self.scenes))):
+            self._submit(i)
+
+    def _acquire(self, scene):
+        t_start = time.time()
+        with telemetry.span('Download Scene', scene=scene):
+            result = acquire_scene(
+                scene, self.scene_lookup[scene], self.main_config, self.session,
+                self.earthdata_creds, self.copernicus_creds, self.limits, self.cache, index=self.index)
+        # time taken to acquire the scene, some of which may overlap other work
+        result['acquire_time'] = time.time() - t_start
+        return result
+
+    def _submit(self, i):
+        self._futures[i] = self._executor.submit(self._acquire, self.scenes[i])
+
+    def __iter__(self):
+        """Yield (scene, result) in the order of scene_lookup once each scene is
+        acquired. result is None if the scene failed.
+        """
+        try:
+            for i, scene in enumerate(self.scenes):
+                if i + self.prefetch < len(self.scenes):
+                    self._submit(i + self.prefetch)
+                result = None
+                try:
+                    result = self._futures.pop(i).result()
+                except Exception as e:
+                    logger.error(f'failed to acquire scene : {scene}')
+                    logger.error(e)
+                else:
+                    logger.info(f'acquired scene {i+1} of {len(self.scenes)} : {scene}')
+                yield scene, result
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
@@ -1,20 +1,231 @@
 
 import os
+import math
+import json
 import zipfile
 import tarfile
 import numpy as np
 from datetime import datetime
 import requests
-import re
 import time
 import shutil
 import s1etad
 import logging
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from s1etad import Sentinel1Etad, ECorrectionType
 from s1etad_tools.cli.slc_correct import s1etad_slc_correct_main
 
+from utils.safe import SAFE_FILE_PATTERN
+from utils.product_index import ProductIndex
+
 logger = logging.getLogger(__name__)
 
+CDSE_TOKEN_URL = 'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token'
+CDSE_CATALOGUE_URL = 'https://catalogue.dataspace.copernicus.eu/odata/v1/Products'
+CDSE_DOWNLOAD_URL = 'https://zipper.dataspace.copernicus.eu/odata/v1/Products({})/$value'
+
+class RangeNotSupported(RuntimeError):
+    """The server sent the whole product in reply to a range request"""
+
+class EtadFetcher(object):
+    """Search and download ETAD products from the Copernicus Dataspace with one
+    pooled session. The access token is cached and refreshed before it expires.
+    Products are found for many scenes in a single catalogue query and large
+    products are downloaded with parallel range requests. Interrupted downloads
+    resume from the parts already saved.
+        see - https://documentation.dataspace.copernicus.eu/APIs/OData.html
+
+    Args:
+        username (str): username for the copernicus dataspace
+        password (str): password for the copernicus dataspace
+        connections (int, optional): number of range requests at once. Defaults to 4.
+        part_size (int, optional): bytes in each range request. Defaults to 32MB.
+    """
+
+    def __init__(self, username, password, connections=4, part_size=32*1024**2):
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.username = username
+        self.password = password
+        self.connections = connections
+        self.part_size = part_size
+        self.products = {}
+        self._token = None
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, connections*2), max_retries=retries)
+        self.session.mount('https://', adapter)
+
+    def _request_token(self, data):
+        response = self.session.post(CDSE_TOKEN_URL, data={'client_id' : 'cdse-public', **data})
+        response.raise_for_status()
+        token = response.json()
+        now = time.time()
+        token['expires_at'] = now + token.get('expires_in', 600)
+        token['refresh_expires_at'] = now + token.get('refresh_expires_in', 0)
+        return token
+
+    def get_token(self):
+        """Get a valid access token, refreshing or requesting a new one if needed
+
+        Returns:
+            str: access token
+        """
+        with self._lock:
+            now = time.time()
+            # refresh a minute before expiry so a token does not expire mid request
+            if self._token is None or self._token['expires_at'] - 60 < now:
+                if self._token is not None and self._token.get('refresh_token') and self._token['refresh_expires_at'] - 60 > now:
+                    logger.info('refreshing copernicus access token')
+                    self._token = self._request_token(
+                        {'grant_type' : 'refresh_token', 'refresh_token' : self._token['refresh_token']})
+                else:
+                    logger.info('requesting copernicus access token')
+                    self._token = self._request_token(
+                        {'grant_type' : 'password', 'username' : self.username, 'password' : self.password})
+            return self._token['access_token']
+
+    def _get(self, url, headers=None, stream=False):
+        # follow redirects by hand, requests drops the authorization header when the host changes
+        headers = {'Authorization' : f'Bearer {self.get_token()}', **(headers or {})}
+        for _ in range(10):
+            response = self.session.get(url, headers=headers, stream=stream, allow_redirects=False)
+            if response.status_code not in (301, 302, 303, 307, 308):
+                break
+            url = response.headers['Location']
+        response.raise_for_status()
+        return response
+
+    def search(self, scenes, chunk_size=20):
+        """Find the ETAD product for each scene. Scenes are searched in chunks
+        with one catalogue query per chunk.
+
+        Args:
+            scenes (list): scene names
+            chunk_size (int, optional): scenes in each query. Defaults to 20.
+
+        Returns:
+            dict: scene -> catalogue product. Scenes without a single matching product are left out
+        """
+        todo = [scene for scene in scenes if scene not in self.products]
+        for i in range(0, len(todo), chunk_size):
+            chunk = todo[i:i + chunk_size]
+            times = [scene.split('_')[5:7] for scene in chunk]
+            clauses = ' or '.join(f"(contains(Name,'{start}') and contains(Name,'{finish}'))" for start, finish in times)
+            logger.info(f'Searching Copernicus Dataspace for ETAD files for {len(chunk)} scenes...')
+            response = self.session.get(CDSE_CATALOGUE_URL, params={
+                '$filter' : f"contains(Name,'ETA') and ({clauses})",
+                '$orderby' : 'ContentDate/Start',
+                '$top' : 1000,
+            })
+            response.raise_for_status()
+            results = response.json()['value']
+            for scene, (start, finish) in zip(chunk, times):
+                matches = [r for r in results if start in r['Name'] and finish in r['Name']]
+                logger.info(f'ETAD files found for {scene} : {[r["Name"] for r in matches]}')
+                if len(matches) == 1:
+                    self.products[scene] = matches[0]
+                else:
+                    logger.error(f"Error. {len(matches)} ETAD products found. 1 required. {scene}")
+        return {scene : self.products[scene] for scene in scenes if scene in self.products}
+
+    def download(self, product, etad_dir=''):
+        """Download an ETAD product. Products larger than a part are downloaded with
+        parallel range requests into a .part file. The completed parts are recorded
+        so an interrupted download carries on from where it stopped.
+
+        Args:
+            product (dict): catalogue product. See search
+            etad_dir (str, optional): where to save the product. Defaults to ''.
+
+        Returns:
+            str: path to the downloaded zip
+        """
+        etad_path = os.path.join(etad_dir, product['Name'] + '.zip')
+        url = CDSE_DOWNLOAD_URL.format(product['Id'])
+        if os.path.exists(etad_path):
+            logger.info(f'ETAD already downloaded : {etad_path}')
+            return etad_path
+        size = int(product.get('ContentLength') or 0)
+        part_path = etad_path + '.part'
+        done_path = etad_path + '.parts.json'
+        logger.info(f'Downloding ETAD to : {etad_path}')
+
+        if size <= self.part_size:
+            return self._download_stream(url, etad_path)
+
+        n_parts = math.ceil(size / self.part_size)
+        done = set()
+        if os.path.exists(part_path) and os.path.exists(done_path):
+            with open(done_path, 'r') as f:
+                done = set(json.load(f))
+            logger.info(f'resuming ETAD download, {len(done)} of {n_parts} parts saved')
+        else:
+            with open(part_path, 'wb') as f:
+                f.truncate(size)
+        done_lock = threading.Lock()
+        fd = os.open(part_path, os.O_WRONLY)
+
+        def _download_part(i):
+            start = i * self.part_size
+            end = min(start + self.part_size, size) - 1
+            with self._get(url, headers={'Range' : f'bytes={start}-{end}'}, stream=True) as response:
+                if response.status_code != 206:
+                    raise RangeNotSupported(f'range requests not supported, status {response.status_code}')
+                offset = start
+                for chunk in response.iter_content(chunk_size=1024**2):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+            if offset != end + 1:
+                raise RuntimeError(f'part {i} incomplete, {offset - start} of {end + 1 - start} bytes')
+            with done_lock:
+                done.add(i)
+                with open(done_path, 'w') as f:
+                    json.dump(sorted(done), f)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.connections) as executor:
+                list(executor.map(_download_part, [i for i in range(n_parts) if i not in done]))
+        except RangeNotSupported as e:
+            logger.warning(f'{e}, downloading ETAD in a single stream : {etad_path}')
+            os.close(fd)
+            if os.path.exists(done_path):
+                os.remove(done_path)
+            return self._download_stream(url, etad_path)
+        except Exception:
+            os.close(fd)
+            raise
+        os.close(fd)
+        os.replace(part_path, etad_path)
+        os.remove(done_path)
+        return etad_path
+
+    def _download_stream(self, url, etad_path):
+        # download the product in one request through a .part file
+        part_path = etad_path + '.part'
+        with self._get(url, stream=True) as response, open(part_path, 'wb') as file:
+            for chunk in response.iter_content(chunk_size=1024**2):
+                file.write(chunk)
+        os.replace(part_path, etad_path)
+        return etad_path
+
+@functools.lru_cache(maxsize=None)
+def get_etad_fetcher(username, password):
+    """ETAD fetcher shared by every download in the run. See EtadFetcher
+
+    Args:
+        username (str): username for the copernicus dataspace
+        password (str): password for the copernicus dataspace
+
+    Returns:
+        EtadFetcher: the fetcher
+    """
+    return EtadFetcher(username, password)
+
 def download_scene_etad(scene: str, username: str, password: str, etad_dir: str = '', unzip=False):
     """search and download an ETAD product for a corresponding scene. 
         see - https://documentation.dataspace.copernicus.eu/APIs/OData.html
@@ -27,46 +238,11 @@ def download_scene_etad(scene: str, username: str, password: str, etad_dir: str
     Returns:
         etad_path : path to the downloaded ETAD product. None if a product was not found.
     """
-
-    sat, mode, prod,_, pol, start, finish = scene.split('_')[:7]
-
-    logger.info(f'Searching Copernicus Dataspace for ETAD file...')
-    # find the ETAD using the start and end timestamps from the SLC
-    search_results = requests.get(
-        f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products?$filter=contains(Name,'ETA') and contains(Name,'{start}') and contains(Name,'{finish}')&$orderby=ContentDate/Start&$top=100"
-        ).json()['value']
-    files = [res['Name'] for res in search_results]
-    logger.info(f'ETAD files found {files}')
-    message = f"Error. {len(files)} ETAD products found. 1 required."
-    assert len(search_results) == 1, message
-    prod_id = search_results[0]['Id']
-    prod_name = search_results[0]['Name']
-    etad_filename = prod_name + '.zip'
-    
-    # get a token from copernicus hub to enable download
-    data = {
-        'grant_type': 'password',
-        'username': f'{username}',
-        'password': f'{password}',
-        'client_id': 'cdse-public',
-    }
-    response = requests.post(
-        'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token', data=data)
-    access_token = response.json()['access_token']
-
-    # download the ETAD product
-    url = f"https://zipper.dataspace.copernicus.eu/odata/v1/Products({prod_id})/$value"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    session = requests.Session()
-    session.headers.update(headers)
-    response = session.get(url, headers=headers, stream=True)
-    etad_path = os.path.join(etad_dir, etad_filename)
-    
-    logger.info(f'Downloding ETAD to : {etad_path}')
-    with open(f"{etad_path}", "wb") as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                file.write(chunk)
+    fetcher = get_etad_fetcher(username, password)
+    product = fetcher.search([scene]).get(scene)
+    message = f"Error. ETAD product not found. 1 required."
+    assert product is not None, message
+    etad_path = fetcher.download(product, etad_dir)
 
     if unzip:
         etad_safe = etad_path.replace('.zip', '')
@@ -78,28 +254,196 @@ def download_scene_etad(scene: str, username: str, password: str, etad_dir: str
 
     return etad_path if not unzip else etad_safe
 
-def find_etad_file(scene, ETAD_dir):
-    """_summary_
+def find_etad_file(scene, ETAD_dir, index=None):
+    """Find a local ETAD product covering a scene. See ProductIndex.find_etad
 
     Args:
         scene (str): scene. e.g. S1A_IW_SLC__1SSH_20231119T083317_20231119T083345_051283_062FEC_0B2C
         ETAD_dir (str): locally accessible directory containing downloaded ETAD products
+        index (ProductIndex, optional): index of the local ETAD products. Defaults to None
+            (a new index of ETAD_dir).
 
     Returns:
-        _type_: _description_
+        str: name of the ETAD product in ETAD_dir. None if not found
     """
-    # application of correction from https://github.com/SAR-ARD/S1_NRB/blob/main/S1_NRB/etad.py
-    ETAD_file = None
-    sat, mode, prod,_, pol, start, finish = scene.split('_')[:7]
+    index = ProductIndex(folders=[ETAD_dir]) if index is None else index
+    index.scan(ETAD_dir)
     logger.info(f'Searching local directory for ETAD product : {ETAD_dir}')
-    for f in os.listdir(ETAD_dir):
-        if all(substring in f for substring in [sat, mode, pol[-2:], start, finish]):
-            ETAD_file = f
-            logger.info(f'ETAD found : {ETAD_file}')
-            break
-    if ETAD_file is None:
+    ETAD_path = index.find_etad(scene)
+    if ETAD_path is None:
         logger.info('ETAD file not found')
-    return ETAD_file
+        return None
+    logger.info(f'ETAD found : {ETAD_path}')
+    return os.path.basename(ETAD_path)
+
+def safe_channels(safe_path):
+    """Get the swaths and polarisations in a SAFE from its measurement files
+
+    Args:
+        safe_path (str): path to the unzipped SAFE
+
+    Returns:
+        set: (swath, polarisation) pairs. e.g. {('iw1', 'vv'), ('iw1', 'vh'), ...}
+    """
+    channels = set()
+    for f in os.listdir(os.path.join(safe_path, 'measurement')):
+        match = SAFE_FILE_PATTERN.search(f)
+        if match:
+            channels.add((match.group(1).lower(), match.group(2).lower()))
+    return channels
+
+def link_safe(safe_path, out_safe, channels=None):
+    """Make a SAFE of symbolic links to the files of another SAFE. Files that already
+    exist in out_safe are kept.
+
+    Args:
+        safe_path (str): path to the unzipped SAFE
+        out_safe (str): path of the linked SAFE
+        channels (set, optional): (swath, polarisation) pairs to link the measurement and
+            annotation files of. Defaults to None (all).
+    """
+    for root, dirs, files in os.walk(safe_path):
+        rel_root = os.path.relpath(root, safe_path)
+        for f in files:
+            match = SAFE_FILE_PATTERN.search(f)
+            if channels is not None and match and (match.group(1).lower(), match.group(2).lower()) not in channels:
+                continue
+            dst = os.path.join(out_safe, rel_root, f)
+            if os.path.lexists(dst):
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.symlink(os.path.abspath(os.path.join(root, f)), dst)
+
+def _correct_channel(slc_path, etad, work_dir, channel, nthreads):
+    # correct a single swath and polarisation of the SLC in its own folder
+    slc_base = os.path.basename(slc_path)
+    subset_safe = os.path.join(work_dir, 'in', slc_base)
+    link_safe(slc_path, subset_safe, channels={channel})
+    out_dir = os.path.join(work_dir, 'out')
+    os.makedirs(out_dir, exist_ok=True)
+    s1etad_slc_correct_main(s1_product=subset_safe,
+                            etad_product=etad,
+                            outdir=out_dir,
+                            nthreads=nthreads,
+                            order=0)  # using the default 1 introduces a bias of about -0.5 dB.
+    return os.path.join(out_dir, slc_base)
+
+def _etad_product(ETAD_file):
+    # path to the unzipped ETAD SAFE, extracting the archive if needed
+    ext = os.path.splitext(ETAD_file)[1]
+    if ext in ['.tar', '.zip']:
+        if '.SAFE' in ETAD_file:
+            # remove the ext after the safe
+            etad_base = os.path.basename(ETAD_file).replace(ext, '')
+        else:
+            etad_base = os.path.basename(ETAD_file).replace(ext, '.SAFE')
+        etad_folder = os.path.dirname(ETAD_file)
+        etad = os.path.join(etad_folder, etad_base)
+        if not os.path.isdir(etad):
+            if ext == '.tar':
+                archive = tarfile.open(ETAD_file, 'r')
+            else:
+                archive = zipfile.ZipFile(ETAD_file, 'r')
+            archive.extractall(etad_folder)
+            archive.close()
+    elif ext == '.SAFE':
+        etad = ETAD_file
+    else:
+        raise RuntimeError('ETAD products are required to be .tar/.zip archives or .SAFE folders')
+    return etad
+
+def apply_etad_correction_subset(slc_path: str, ETAD_file: str, out_dir: str, nthreads: int=4,
+                                 swaths=None, polarizations=None, workers=1):
+    """
+    Apply ETAD correction to only the swaths and polarisations of a Sentinel-1 SLC
+    that will be processed. Each swath and polarisation is corrected in its own process.
+    The corrected SAFE only has the measurement and annotation files of the corrected
+    channels, and links to the original files of the whole scene such as the manifest.
+    The corrected channels are recorded next to the SAFE, so a later run that needs
+    more channels only corrects the missing ones.
+
+    Parameters
+    ----------
+    slc_path: str
+        The path to the unzipped Sentinel-1 SLC SAFE.
+    ETAD_file: str
+        The ETAD product. A .tar/.zip archive or .SAFE folder.
+    out_dir: str
+        The directory to store results.
+    nthreads: int
+        The number of threads shared by the workers. Defaults to 4.
+    swaths: list
+        The swaths to correct. e.g. ['iw2']. Defaults to None (all).
+    polarizations: list
+        The polarisations to correct. e.g. ['vv']. Defaults to None (all).
+    workers: int
+        The number of swaths and polarisations corrected at once. Defaults to 1.
+
+    Returns
+    -------
+    str
+        path to the corrected SLC SAFE product.
+    """
+    slc_base = os.path.basename(slc_path)
+    slc_corrected = os.path.join(out_dir, slc_base)
+    channels_file = slc_corrected + '.etad.json'
+    swaths = [s.lower() for s in swaths] if swaths else None
+    polarizations = [p.lower() for p in polarizations] if polarizations else None
+    channels = {(s, p) for s, p in safe_channels(slc_path)
+                if (swaths is None or s in swaths) and (polarizations is None or p in polarizations)}
+    done = set()
+    if os.path.isdir(slc_corrected) and os.path.exists(channels_file):
+        with open(channels_file, 'r') as f:
+            done = set(tuple(c) for c in json.load(f))
+    todo = sorted(channels - done)
+    if not todo:
+        logger.info(f'ETAD corrected product already exists: {slc_corrected}')
+        return slc_corrected
+
+    start_time = time.time()
+    logger.info(f'Correcting SLC with ETAD product for {todo}')
+    etad = _etad_product(ETAD_file)
+    work_root = os.path.join(out_dir, slc_base.replace('.SAFE', '_parts'))
+    workers = max(1, min(int(workers), len(todo)))
+    # spawned, as forking from a thread of the acquirer can copy a held lock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {
+            channel : executor.submit(
+                _correct_channel, slc_path, etad, os.path.join(work_root, '-'.join(channel)),
+                channel, max(1, nthreads // workers))
+            for channel in todo
+        }
+        for channel, future in futures.items():
+            corrected_safe = future.result()
+            # move the corrected files into place, replacing links to the original
+            for root, dirs, files in os.walk(corrected_safe):
+                for f in files:
+                    src = os.path.join(root, f)
+                    if os.path.islink(src):
+                        continue
+                    dst = os.path.join(slc_corrected, os.path.relpath(src, corrected_safe))
+                    if os.path.lexists(dst):
+                        os.remove(dst)
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    shutil.move(src, dst)
+            logger.info(f'ETAD corrected : {channel}')
+    shutil.rmtree(work_root)
+    corrected = done | set(todo)
+    # the files of the whole scene are read from the original SAFE. the files of
+    # channels that are not corrected are left out, so they can not be processed
+    # uncorrected by mistake
+    link_safe(slc_path, slc_corrected, channels=corrected)
+    for root, dirs, files in os.walk(slc_corrected):
+        for f in files:
+            path = os.path.join(root, f)
+            match = SAFE_FILE_PATTERN.search(f)
+            if os.path.islink(path) and match and (match.group(1).lower(), match.group(2).lower()) not in corrected:
+                os.remove(path)
+    with open(channels_file, 'w') as f:
+        json.dump(sorted(corrected), f)
+    t = round((time.time() - start_time), 2)
+    logger.info(f'Time taken: {t}')
+    return slc_corrected
 
 def apply_etad_correction(slc_path: str, ETAD_file: str, out_dir: str, nthreads: int=4):
     """
@@ -128,26 +472,7 @@ def apply_etad_correction(slc_path: str, ETAD_file: str, out_dir: str, nthreads:
     slc_corrected = os.path.join(slc_corrected_dir, slc_base)
     if not os.path.isdir(slc_corrected):
         start_time = time.time()
-        ext = os.path.splitext(ETAD_file)[1]
-        if ext in ['.tar', '.zip']:
-            if '.SAFE' in ETAD_file:
-                # remove the ext after the safe
-                etad_base = os.path.basename(ETAD_file).replace(ext, '')
-            else:
-                etad_base = os.path.basename(ETAD_file).replace(ext, '.SAFE')
-            etad_folder = os.path.dirname(ETAD_file)
-            etad = os.path.join(etad_folder, etad_base)
-            if not os.path.isdir(etad):
-                if ext == '.tar':
-                    archive = tarfile.open(ETAD_file, 'r')
-                else:
-                    archive = zipfile.ZipFile(ETAD_file, 'r')
-                archive.extractall(etad_folder)
-                archive.close()
-        elif ext == '.SAFE':
-            etad = ETAD_file
-        else:
-            raise RuntimeError('ETAD products are required to be .tar/.zip archives or .SAFE folders')
+        etad = _etad_product(ETAD_file)
         s1etad_slc_correct_main(s1_product=slc_path,
                                 etad_product=etad,
                                 outdir=slc_corrected_dir,
@@ -0,0 +1,202 @@
+import os
+import time
+import json
+import sqlite3
+import logging
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+# states of a job, in the order they are reached
+JOB_STATES = ['queued', 'downloading', 'processing', 'uploaded', 'failed']
+# states a job is left in if the driver stops while it is running
+RUNNING_STATES = ['downloading', 'processing']
+
+def make_job_id(scene, burst_ids=None):
+    """Make the id of a job from the scene and bursts it processes
+
+    Args:
+        scene (str): scene name
+        burst_ids (list, optional): burst ids. Defaults to None.
+
+    Returns:
+        str: job id. e.g. S1A_IW_SLC__1SDV_..._512B_t071_151218_iw2
+    """
+    return '_'.join([scene] + sorted(burst_ids or []))
+
+def read_manifest(manifest_path):
+    """Read a manifest of jobs. The manifest is a yaml list where each job is
+    either a scene name or a dict with a scene, optional burst_ids and any config
+    values to set for the job. Each scene can only be in the manifest once, as
+    jobs of the same scene would share the downloaded scene and DEM files.
+
+    e.g.
+    - S1A_IW_SLC__1SDV_20190716T135159_20190716T135226_028143_032DC3_512B
+    - scene: S1A_IW_SLC__1SDV_20190728T135200_20190728T135227_028318_033312_8B82
+      burst_ids: [t071_151218_iw2]
+      dem_type: glo_30
+
+    Args:
+        manifest_path (str): path to the manifest
+
+    Returns:
+        list(dict): jobs with job_id, scene, burst_ids and overrides
+
+    Raises:
+        ValueError: if a scene is in the manifest more than once
+    """
+    import yaml
+    with open(manifest_path, 'r', encoding='utf8') as f:
+        entries = yaml.safe_load(f.read()) or []
+    jobs = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {'scene' : entry}
+        entry = dict(entry)
+        scene = entry.pop('scene')
+        burst_ids = entry.pop('burst_ids', None) or []
+        job_id = entry.pop('job_id', None) or make_job_id(scene, burst_ids)
+        jobs.append({'job_id' : job_id, 'scene' : scene, 'burst_ids' : burst_ids, 'overrides' : entry})
+    scenes = [job['scene'] for job in jobs]
+    duplicates = sorted({scene for scene in scenes if scenes.count(scene) > 1})
+    if duplicates:
+        raise ValueError(f'scenes in the manifest more than once, combine their burst_ids into one job : {duplicates}')
+    return jobs
+
+class JobStore(object):
+    """Persistent state of batch jobs in a sqlite database. The store is shared
+    by the batch driver and the runs it starts, so the state survives a crash of
+    either and a restarted driver carries on where it stopped.
+
+    Args:
+        db_path (str): path to the sqlite database
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with closing(self._connect()) as con:
+            con.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'job_id TEXT PRIMARY KEY, scene TEXT, burst_ids TEXT, overrides TEXT, '
+                'state TEXT, attempts INTEGER, next_try REAL, error TEXT, updated REAL)')
+            con.execute('CREATE INDEX IF NOT EXISTS idx_state ON jobs (state, next_try)')
+
+    def _connect(self):
+        # isolation_level None so claim can take the write lock with BEGIN IMMEDIATE
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def add_jobs(self, jobs):
+        """Add jobs to the queue. Jobs already in the store keep their state.
+
+        Args:
+            jobs (list(dict)): jobs from read_manifest
+
+        Returns:
+            int: number of new jobs
+        """
+        with closing(self._connect()) as con:
+            before = con.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+            con.executemany(
+                'INSERT OR IGNORE INTO jobs VALUES (?,?,?,?,?,?,?,?,?)',
+                [(job['job_id'], job['scene'], json.dumps(job['burst_ids']), json.dumps(job['overrides']),
+                  'queued', 0, 0, None, time.time()) for job in jobs])
+            after = con.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+        return after - before
+
+    def reset_interrupted(self):
+        """Queue jobs left running by a driver that stopped
+
+        Returns:
+            int: number of jobs queued again
+        """
+        with closing(self._connect()) as con:
+            cur = con.execute(
+                f'UPDATE jobs SET state=?, updated=? WHERE state IN ({",".join("?"*len(RUNNING_STATES))})',
+                ('queued', time.time(), *RUNNING_STATES))
+        return cur.rowcount
+
+    def claim(self):
+        """Take the next queued job that is due to run and mark it as downloading
+
+        Returns:
+            dict: the job. None if no job is due
+        """
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            row = con.execute(
+                'SELECT job_id, scene, burst_ids, overrides, attempts FROM jobs '
+                'WHERE state=? AND next_try<=? ORDER BY next_try, rowid LIMIT 1',
+                ('queued', time.time())).fetchone()
+            if row is None:
+                con.execute('COMMIT')
+                return None
+            con.execute(
+                'UPDATE jobs SET state=?, attempts=attempts+1, updated=? WHERE job_id=?',
+                ('downloading', time.time(), row[0]))
+            con.execute('COMMIT')
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+        return {'job_id' : row[0], 'scene' : row[1], 'burst_ids' : json.loads(row[2]),
+                'overrides' : json.loads(row[3]), 'attempts' : row[4] + 1}
+
+    def set_state(self, job_id, state, error=None):
+        """Set the state of a job
+
+        Args:
+            job_id (str): job id
+            state (str): one of JOB_STATES
+            error (str, optional): reason the job failed. Defaults to None.
+        """
+        if state not in JOB_STATES:
+            raise ValueError(f'unknown job state {state}, expected one of {JOB_STATES}')
+        with closing(self._connect()) as con:
+            con.execute('UPDATE jobs SET state=?, error=?, updated=? WHERE job_id=?',
+                        (state, error, time.time(), job_id))
+
+    def retry_or_fail(self, job_id, error, max_attempts=3, backoff=60):
+        """Queue a failed job to run again after an exponential backoff, or mark
+        it as failed once it has run max_attempts times.
+
+        Args:
+            job_id (str): job id
+            error (str): reason the job failed
+            max_attempts (int, optional): number of times a job is run. Defaults to 3.
+            backoff (float, optional): seconds to wait before the first retry, doubled
+                for each retry after. Defaults to 60.
+
+        Returns:
+            str: new state of the job
+        """
+        with closing(self._connect()) as con:
+            attempts = con.execute('SELECT attempts FROM jobs WHERE job_id=?', (job_id,)).fetchone()[0]
+            if attempts >= max_attempts:
+                state, next_try = 'failed', 0
+            else:
+                state, next_try = 'queued', time.time() + backoff*2**(attempts - 1)
+            con.execute('UPDATE jobs SET state=?, next_try=?, error=?, updated=? WHERE job_id=?',
+                        (state, next_try, error, time.time(), job_id))
+        return state
+
+    def counts(self):
+        """Number of jobs in each state
+
+        Returns:
+            dict: state -> number of jobs
+        """
+        with closing(self._connect()) as con:
+            rows = con.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return {state : dict(rows).get(state, 0) for state in JOB_STATES}
+
+    def pending(self):
+        """Number of jobs that are queued or running
+
+        Returns:
+            int: number of jobs
+        """
+        counts = self.counts()
+        return counts['queued'] + sum(counts[s] for s in RUNNING_STATES)
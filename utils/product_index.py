@@ -0,0 +1,162 @@
+import os
+import sqlite3
+import logging
+import threading
+
+from utils.cache import orbit_validity
+
+logger = logging.getLogger(__name__)
+
+def scene_window(scene):
+    """Get the mission, mode, polarisation and time window from a scene name.
+    e.g. S1A_IW_SLC__1SDV_20190716T135159_20190716T135226_028143_032DC3_512B
+
+    Args:
+        scene (str): scene name or path to the scene zip
+
+    Returns:
+        tuple: (mission, mode, polarisation, start, stop) e.g. ('S1A', 'IW', 'DV', ...)
+    """
+    parts = os.path.basename(scene).split('_')
+    return parts[0], parts[1], parts[4][-2:], parts[5], parts[6]
+
+def product_record(path):
+    """Get the index record of an orbit or ETAD file from its name
+
+    Args:
+        path (str): path to the file
+
+    Returns:
+        tuple: (kind, mission, label, start, stop). None if the file is not an
+            orbit or ETAD product
+    """
+    name = os.path.basename(path)
+    if name.endswith('.EOF'):
+        try:
+            mission, orbit_type, start, stop = orbit_validity(name)
+        except AttributeError:
+            return None
+        return 'orbit', mission, orbit_type, start, stop
+    parts = name.split('.')[0].split('_')
+    if len(parts) >= 7 and parts[2] == 'ETA':
+        mission, mode, pol, start, stop = scene_window(name)
+        return 'etad', mission, f'{mode}_{pol}', start, stop
+    return None
+
+class ProductIndex(object):
+    """Persistent sqlite index of the orbit and ETAD files kept locally, with the
+    time window each is valid for. The orbit or ETAD product for a scene is found
+    with an interval query instead of listing a folder of thousands of files or
+    asking the orbit server.
+
+    A folder is only listed again if its modification time has changed, which
+    happens when files are added or removed. If index_path is None the index is
+    kept in memory for the run.
+
+    Args:
+        index_path (str, optional): path to the sqlite index. Defaults to None.
+        folders (list, optional): folders of orbit and ETAD files to index. Defaults to None.
+    """
+
+    def __init__(self, index_path=None, folders=None):
+        self.index_path = index_path
+        self.folders = [os.path.abspath(f) for f in (folders or []) if f]
+        self._lock = threading.Lock()
+        if index_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        self._con = sqlite3.connect(index_path or ':memory:', timeout=60, check_same_thread=False)
+        with self._lock, self._con:
+            self._con.execute(
+                'CREATE TABLE IF NOT EXISTS products ('
+                'path TEXT PRIMARY KEY, folder TEXT, kind TEXT, mission TEXT, label TEXT, '
+                'start TEXT, stop TEXT)')
+            self._con.execute('CREATE INDEX IF NOT EXISTS idx_window ON products (kind, mission, label, start, stop)')
+            self._con.execute('CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, mtime_ns INTEGER)')
+
+    def scan(self, folder):
+        """Index the orbit and ETAD files in a folder if it has changed since
+        it was last indexed
+
+        Args:
+            folder (str): folder of orbit or ETAD files
+
+        Returns:
+            int: number of files added to the index
+        """
+        folder = os.path.abspath(folder)
+        if not os.path.isdir(folder):
+            return 0
+        mtime_ns = os.stat(folder).st_mtime_ns
+        with self._lock, self._con:
+            row = self._con.execute('SELECT mtime_ns FROM folders WHERE folder=?', (folder,)).fetchone()
+            if row is not None and row[0] == mtime_ns:
+                return 0
+            indexed = {r[0] for r in self._con.execute('SELECT path FROM products WHERE folder=?', (folder,))}
+            paths = {os.path.join(folder, name) for name in os.listdir(folder)}
+            new = []
+            for path in paths - indexed:
+                record = product_record(path)
+                if record is not None:
+                    new.append((path, folder, *record))
+            self._con.executemany('INSERT OR REPLACE INTO products VALUES (?,?,?,?,?,?,?)', new)
+            self._con.executemany('DELETE FROM products WHERE path=?', [(p,) for p in indexed - paths])
+            self._con.execute('INSERT OR REPLACE INTO folders VALUES (?,?)', (folder, mtime_ns))
+        if new:
+            logger.info(f'indexed {len(new)} orbit and ETAD files in {folder}')
+        return len(new)
+
+    def add(self, path):
+        """Add a downloaded orbit or ETAD file to the index
+
+        Args:
+            path (str): path to the file
+
+        Returns:
+            str: path to the file
+        """
+        record = product_record(path)
+        if record is not None:
+            path = os.path.abspath(path)
+            with self._lock, self._con:
+                self._con.execute('INSERT OR REPLACE INTO products VALUES (?,?,?,?,?,?,?)',
+                                  (path, os.path.dirname(path), *record))
+        return path
+
+    def _find(self, kind, mission, label, start, stop):
+        for folder in self.folders:
+            self.scan(folder)
+        with self._lock, self._con:
+            rows = self._con.execute(
+                'SELECT path FROM products WHERE kind=? AND mission=? AND label=? AND start<=? AND stop>=? '
+                'ORDER BY start DESC', (kind, mission, label, start, stop)).fetchall()
+            for (path,) in rows:
+                if os.path.exists(path):
+                    return path
+                # removed since the folder was indexed
+                self._con.execute('DELETE FROM products WHERE path=?', (path,))
+        return None
+
+    def find_orbit(self, scene, orbit_type='POEORB'):
+        """Find a local orbit file valid for the whole of a scene
+
+        Args:
+            scene (str): scene name or path to the scene zip
+            orbit_type (str, optional): POEORB or RESORB. Defaults to 'POEORB'.
+
+        Returns:
+            str: path to the orbit file. None if there is no local orbit file
+        """
+        mission, mode, pol, start, stop = scene_window(scene)
+        return self._find('orbit', mission, orbit_type, start, stop)
+
+    def find_etad(self, scene):
+        """Find a local ETAD product covering a scene
+
+        Args:
+            scene (str): scene name or path to the scene zip
+
+        Returns:
+            str: path to the ETAD product. None if there is no local product
+        """
+        mission, mode, pol, start, stop = scene_window(scene)
+        return self._find('etad', mission, f'{mode}_{pol}', start, stop)
@@ -7,6 +7,7 @@ import os
 import rasterio
 from rasterio.transform import from_origin
 from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.vrt import WarpedVRT
 from shapely.geometry import Polygon
 import numpy as np
 import zipfile
@@ -14,28 +15,103 @@ from urllib.request import urlretrieve
 import tarfile
 import pyproj
 import time
+import math
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import rasterio.shutil
+import rasterio.windows
+import rasterio.errors
+from xml.sax.saxutils import escape
 
-def transform_polygon(src_crs, dst_crs, geometry, always_xy=True):
+@functools.lru_cache(maxsize=64)
+def get_transformer(src_crs, dst_crs, always_xy=True):
+    """Get a transformer between two EPSG codes. Transformers are cached
+    so repeated transforms do not rebuild the PROJ pipeline.
+
+    Args:
+        src_crs (int): source EPSG. e.g. 4326
+        dst_crs (int): destination EPSG. e.g. 3031
+        always_xy (bool, optional): use x, y (lon, lat) order. Defaults to True.
+
+    Returns:
+        pyproj.Transformer: transformer from src_crs to dst_crs
+    """
     src_crs = pyproj.CRS(f"EPSG:{src_crs}")
-    dst_crs = pyproj.CRS(f"EPSG:{dst_crs}") 
-    transformer = pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=always_xy)
-     # Transform the polygon's coordinates
-    transformed_exterior = [
-        transformer.transform(x, y) for x, y in geometry.exterior.coords
-    ]
+    dst_crs = pyproj.CRS(f"EPSG:{dst_crs}")
+    return pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=always_xy)
+
+def transform_coords(src_crs, dst_crs, xs, ys, always_xy=True):
+    """Transform arrays of coordinates in a single call.
+
+    Args:
+        src_crs (int): source EPSG. e.g. 4326
+        dst_crs (int): destination EPSG. e.g. 3031
+        xs (array-like): x coordinates
+        ys (array-like): y coordinates
+        always_xy (bool, optional): use x, y (lon, lat) order. Defaults to True.
+
+    Returns:
+        tuple(np.ndarray): transformed x and y coordinates
+    """
+    transformer = get_transformer(src_crs, dst_crs, always_xy)
+    return transformer.transform(np.asarray(xs, dtype=float), np.asarray(ys, dtype=float))
+
+def transform_polygon(src_crs, dst_crs, geometry, always_xy=True):
+    # Transform the polygon's coordinates as arrays
+    coords = np.asarray(geometry.exterior.coords)
+    xs, ys = transform_coords(src_crs, dst_crs, coords[:, 0], coords[:, 1], always_xy)
     # Create a new Shapely polygon with the transformed coordinates
-    transformed_polygon = Polygon(transformed_exterior)
+    transformed_polygon = Polygon(np.column_stack([xs, ys]))
     return transformed_polygon
 
-def expand_raster_with_bounds(input_raster, output_raster, old_bounds, new_bounds, fill_value=None):
+def densify_bounds(bbox, delta=0.1):
+    """Make points along the sides of a bounding box, clockwise from the top left.
+
+    Args:
+        bbox (tuple): (x_min, y_min, x_max, y_max)
+        delta (float, optional): distance between points along the sides. Defaults to 0.1.
+
+    Returns:
+        tuple(np.ndarray): x and y coordinates of the points
+    """
+    x_min, y_min, x_max, y_max = bbox
+    xs_top = np.append(np.arange(x_min, x_max, delta), x_max)
+    ys_right = np.append(np.arange(y_max - delta, y_min - delta, -delta), y_min)
+    xs_bottom = np.append(np.arange(x_max - delta, x_min - delta, -delta), x_min)
+    ys_left = np.append(np.arange(y_min + delta, y_max, delta), y_max)
+    xs = np.concatenate([xs_top, np.full(ys_right.size, x_max), xs_bottom, np.full(ys_left.size, x_min)])
+    ys = np.concatenate([np.full(xs_top.size, y_max), ys_right, np.full(xs_bottom.size, y_min), ys_left])
+    return xs, ys
+
+def densify_and_transform_bounds(bbox, src_crs, dst_crs, delta=0.1):
+    """Transform bounds to another crs using points along the sides of the box
+    so the result covers the curved edges of the transformed box.
+
+    Args:
+        bbox (tuple): (x_min, y_min, x_max, y_max) in src_crs
+        src_crs (int): source EPSG. e.g. 4326
+        dst_crs (int): destination EPSG. e.g. 3031
+        delta (float, optional): distance between points along the sides in src_crs. Defaults to 0.1.
+
+    Returns:
+        tuple: (x_min, y_min, x_max, y_max) in dst_crs
+    """
+    xs, ys = transform_coords(src_crs, dst_crs, *densify_bounds(bbox, delta))
+    return (float(np.min(xs)), float(np.min(ys)), float(np.max(xs)), float(np.max(ys)))
+
+def expand_raster_with_bounds(input_raster, output_raster, old_bounds, new_bounds, fill_value=None, blocksize=512):
     """Expand the raster to the desired bounds. Resolution and Location are preserved.
+    The output is written one block at a time by copying the source into its offset
+    window, so the expanded raster is never held in memory. If output_raster is a
+    .vrt no pixels are copied and the vrt references the input.
 
     Args:
-        input_raster (str): input raster path
-        output_raster (str): out raster path
+        input_raster (str): input raster path. Can be a vrt
+        output_raster (str): out raster path. A .vrt path makes a virtual raster
         old_bounds (tuple): current bounds
         new_bounds (tuple): new bounds
         fill_value (float, int, optional): Fill value to pad with. Defaults to None and nodata is used.
+        blocksize (int, optional): size of the blocks written. Defaults to 512.
     """
     # Open the raster dataset
     with rasterio.open(input_raster, 'r') as src:
@@ -51,53 +127,136 @@ def expand_raster_with_bounds(input_raster, output_raster, old_bounds, new_bound
         new_bottom = old_bottom - int(abs(new_bottom-old_bottom)/src.res[1])*src.res[1]
         new_top = old_top + int(abs(new_top-old_top)/src.res[1])*src.res[1]
         logging.info(f'New raster bounds: {(new_left, new_bottom, new_right, new_top)}')
+
+        if output_raster.endswith('.vrt'):
+            # padded pixels in a vrt take the nodata value
+            if fill_value is not None and fill_value != src.nodata:
+                raise ValueError(f'fill_value must be the nodata value ({src.nodata}) to expand to a vrt')
+            logging.info(f'Making vrt: {output_raster}')
+            build_vrt([input_raster], output_raster,
+                      bounds=(new_left, new_bottom, new_right, new_top), res=src.res)
+            return
+
         # Calculate the new width and height, should be integer values
-        new_width = int((new_right - new_left) / src.res[0])
-        new_height = int((new_top - new_bottom) / src.res[1])
+        new_width = int(round((new_right - new_left) / src.res[0]))
+        new_height = int(round((new_top - new_bottom) / src.res[1]))
+        # offset of the source in the new raster
+        col_off = int(round((src.bounds.left - new_left) / src.res[0]))
+        row_off = int(round((new_top - src.bounds.top) / src.res[1]))
         # Define the new transformation matrix
         transform = from_origin(new_left, new_top, src.res[0], src.res[1])
         # Create a new raster dataset with expanded bounds
         profile = src.profile
         profile.update({
+            'driver': 'GTiff',
             'width': new_width,
             'height': new_height,
-            'transform': transform
+            'transform': transform,
+            'tiled': True,
+            'blockxsize': blocksize,
+            'blockysize': blocksize,
         })
-        # make a temp file
-        tmp = output_raster.replace('.tif','_tmp.tif')
-        logging.info(f'Making temp file: {tmp}')
-        with rasterio.open(tmp, 'w', **profile) as dst:
-            # Read the data from the source and write it to the destination
-            fill_value = profile['nodata'] if fill_value is None else fill_value
-            logging.info(f'Padding new raster extent with value: {fill_value}')
-            data = np.full((new_height, new_width), fill_value=fill_value, dtype=profile['dtype'])
-            dst.write(data, 1)
-        # merge the old raster into the new raster with expanded bounds 
-        logging.info(f'Merging original raster and expanding bounds...')
-    del data
-    rasterio.merge.merge(
-        datasets=[tmp, input_raster],
-        method='max',
-        dst_path=output_raster)
-    os.remove(tmp)
-
-def reproject_raster(in_path: str, out_path: str, crs: int):
-    """Reproject a raster to the desired crs
+        fill_value = profile['nodata'] if fill_value is None else fill_value
+        logging.info(f'Padding new raster extent with value: {fill_value}')
+        src_window = rasterio.windows.Window(col_off, row_off, src.width, src.height)
+        with rasterio.open(output_raster, 'w', **profile) as dst:
+            for band in range(1, src.count + 1):
+                for _, window in dst.block_windows(band):
+                    data = np.full((window.height, window.width), fill_value=fill_value, dtype=profile['dtype'])
+                    try:
+                        overlap = window.intersection(src_window)
+                    except rasterio.errors.WindowError:
+                        # block is entirely in the padded area
+                        dst.write(data, band, window=window)
+                        continue
+                    # read the overlap from the source in its own pixel offsets
+                    src_data = src.read(band, window=rasterio.windows.Window(
+                        overlap.col_off - col_off, overlap.row_off - row_off,
+                        overlap.width, overlap.height))
+                    if src.nodata is not None:
+                        src_data = np.where(src_data == src.nodata, fill_value, src_data)
+                    r0 = int(overlap.row_off - window.row_off)
+                    c0 = int(overlap.col_off - window.col_off)
+                    data[r0:r0 + src_data.shape[0], c0:c0 + src_data.shape[1]] = src_data
+                    dst.write(data, band, window=window)
+            dst.update_tags(**src.tags())
+
+def _warp_options(src, crs, transform, width, height, native_transform, resampling, num_threads, warp_mem_limit):
+    # one warp of the whole output grid, read window by window. GDAL picks the
+    # transform approximation and the resampling kernel scale for each chunk it
+    # warps, so both are fixed here to make a window the same as the full raster
+    return {
+        'crs': crs,
+        'transform': transform,
+        'width': width,
+        'height': height,
+        'src_nodata': src.nodata,
+        'nodata': src.nodata,
+        'resampling': resampling,
+        # transform every pixel exactly, rasterio does not accept a tolerance of 0
+        'tolerance': 1e-9,
+        'num_threads': num_threads,
+        'warp_mem_limit': warp_mem_limit,
+        # output pixels per source pixel
+        'XSCALE': native_transform.a / transform.a,
+        'YSCALE': native_transform.e / transform.e,
+    }
+
+def _reproject_window(in_path, warp_options, lock, dst, window, band):
+    # warp a single output window. each worker opens its own source handle
+    with rasterio.open(in_path) as src, WarpedVRT(src, **warp_options) as vrt:
+        data = vrt.read(band, window=window)
+    with lock:
+        dst.write(data, band, window=window)
+
+def reproject_raster(
+        in_path: str,
+        out_path: str,
+        crs: int,
+        resampling: str = 'nearest',
+        num_threads: int = 1,
+        warp_mem_limit: int = 0,
+        workers: int = 1,
+        compress: str = 'DEFLATE',
+        blocksize: int = 512,
+        dst_bounds: tuple = None,
+        dst_res: float = None):
+    """Reproject a raster to the desired crs. The output is a tiled and compressed
+    GeoTIFF. The output tiles are read from a warped VRT of the full output grid,
+    with workers > 1 across a thread pool, so the output is the same for any
+    number of workers.
 
     Args:
         in_path (str): path to src raster
         out_path (str): save path of reproj raster
         crs (int): crs e.g. 3031
+        resampling (str, optional): resampling method. e.g. nearest, bilinear, cubic. Defaults to 'nearest'.
+        num_threads (int, optional): number of GDAL warping threads. Defaults to 1.
+        warp_mem_limit (int, optional): GDAL warp memory limit in MB. Defaults to 0 (GDAL default).
+        workers (int, optional): number of output tiles warped at once. Defaults to 1.
+        compress (str, optional): compression of the output. Defaults to 'DEFLATE'.
+        blocksize (int, optional): size of the output tiles. Defaults to 512.
+        dst_bounds (tuple, optional): (left, bottom, right, top) of the output in crs.
+            Used to put several rasters on the same grid. Defaults to None.
+        dst_res (float, optional): resolution of the output in crs. Defaults to None.
 
     Returns:
         str: save path of reproj raster
     """
+    resampling = Resampling[resampling] if isinstance(resampling, str) else resampling
     # reproject raster to project crs
     with rasterio.open(in_path) as src:
         src_crs = src.crs
+        native_transform, _, _ = calculate_default_transform(src_crs, crs, src.width, src.height, *src.bounds)
         transform, width, height = calculate_default_transform(
-            src_crs, crs, src.width, src.height, *src.bounds)
-        kwargs = src.meta.copy()
+            src_crs, crs, src.width, src.height, *src.bounds, resolution=dst_res)
+        if dst_bounds is not None:
+            # output on a fixed grid
+            res = transform.a if dst_res is None else dst_res
+            transform = from_origin(dst_bounds[0], dst_bounds[3], res, res)
+            width = int(math.ceil(round((dst_bounds[2] - dst_bounds[0]) / res, 6)))
+            height = int(math.ceil(round((dst_bounds[3] - dst_bounds[1]) / res, 6)))
+        kwargs = tiled_profile(src.meta.copy(), compress=compress, blocksize=blocksize)
 
         # get crs proj 
         crs = pyproj.CRS(f"EPSG:{crs}")
@@ -108,23 +267,221 @@ def reproject_raster(in_path: str, out_path: str, crs: int):
             'width': width,
             'height': height})
 
+        warp_options = _warp_options(
+            src, crs, transform, width, height, native_transform, resampling, num_threads, warp_mem_limit)
         with rasterio.open(out_path, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=crs,
-                    resampling=Resampling.nearest)
+            windows = [(i, window) for i in range(1, src.count + 1) for _, window in dst.block_windows(i)]
+            if workers > 1:
+                lock = threading.Lock()
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(_reproject_window, in_path, warp_options, lock, dst, window, i)
+                        for i, window in windows
+                    ]
+                    for future in futures:
+                        future.result()
+            else:
+                with WarpedVRT(src, **warp_options) as vrt:
+                    for i, window in windows:
+                        dst.write(vrt.read(i, window=window), i, window=window)
+            dst.update_tags(**src.tags())
+    return out_path
+
+GDAL_DTYPES = {
+    'uint8' : 'Byte',
+    'int8' : 'Int8',
+    'uint16' : 'UInt16',
+    'int16' : 'Int16',
+    'uint32' : 'UInt32',
+    'int32' : 'Int32',
+    'float32' : 'Float32',
+    'float64' : 'Float64',
+}
+
+def tiled_profile(profile, compress='DEFLATE', blocksize=512, predictor=None):
+    """Update a raster profile to write a tiled and compressed GeoTIFF.
+
+    Args:
+        profile (dict): rasterio profile of the raster
+        compress (str, optional): compression. e.g. DEFLATE, ZSTD, LZW. Defaults to 'DEFLATE'.
+        blocksize (int, optional): size of the internal tiles, a multiple of 16. Defaults to 512.
+        predictor (int, optional): compression predictor. Defaults to None where
+            3 (floating point) is used for float data and 2 (horizontal) otherwise.
+
+    Returns:
+        dict: updated profile
+    """
+    profile = dict(profile)
+    if predictor is None:
+        predictor = 3 if np.dtype(profile['dtype']).kind == 'f' else 2
+    profile.update({
+        'driver' : 'GTiff',
+        'tiled' : True,
+        'blockxsize' : blocksize,
+        'blockysize' : blocksize,
+        'compress' : compress,
+        'predictor' : predictor,
+        'BIGTIFF' : 'IF_SAFER',
+    })
+    return profile
+
+def build_vrt(paths, vrt_path, bounds=None, res=None):
+    """Make a VRT mosaic of rasters with the same crs. No pixels are copied.
+    Where rasters overlap the last in paths is used.
+
+    Args:
+        paths (list): paths of the rasters
+        vrt_path (str): path to save the vrt
+        bounds (tuple, optional): (left, bottom, right, top) of the mosaic.
+            Defaults to None and the union of the rasters is used.
+        res (tuple, optional): (x, y) resolution of the mosaic. Defaults to None
+            and the resolution of the first raster is used.
+
+    Returns:
+        str: path to the vrt
+    """
+    sources = []
+    for path in paths:
+        with rasterio.open(path) as src:
+            sources.append((os.path.abspath(path), src.bounds, src.res, src.width, src.height, src.count))
+            if len(sources) == 1:
+                crs, dtype, nodata = src.crs, src.dtypes[0], src.nodata
+                res = src.res if res is None else res
+    if bounds is None:
+        bounds = (
+            min(s[1].left for s in sources), min(s[1].bottom for s in sources),
+            max(s[1].right for s in sources), max(s[1].top for s in sources))
+    left, bottom, right, top = bounds
+    width = int(math.ceil(round((right - left) / res[0], 6)))
+    height = int(math.ceil(round((top - bottom) / res[1], 6)))
+    count = sources[0][5]
+    nodata_xml = f'<NoDataValue>{nodata}</NoDataValue>' if nodata is not None else ''
+
+    bands = []
+    for band in range(1, count + 1):
+        band_sources = []
+        for path, src_bounds, src_res, src_width, src_height, _ in sources:
+            # position of the source in the pixels of the vrt
+            x_off = (src_bounds.left - left) / res[0]
+            y_off = (top - src_bounds.top) / res[1]
+            x_size = src_width * src_res[0] / res[0]
+            y_size = src_height * src_res[1] / res[1]
+            band_sources.append(
+                f'<ComplexSource>'
+                f'<SourceFilename relativeToVRT="0">{escape(path)}</SourceFilename>'
+                f'<SourceBand>{band}</SourceBand>'
+                f'<SrcRect xOff="0" yOff="0" xSize="{src_width}" ySize="{src_height}"/>'
+                f'<DstRect xOff="{x_off}" yOff="{y_off}" xSize="{x_size}" ySize="{y_size}"/>'
+                f'{f"<NODATA>{nodata}</NODATA>" if nodata is not None else ""}'
+                f'</ComplexSource>')
+        bands.append(
+            f'<VRTRasterBand dataType="{GDAL_DTYPES[dtype]}" band="{band}">'
+            f'{nodata_xml}{"".join(band_sources)}</VRTRasterBand>')
+
+    vrt = (
+        f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">'
+        f'<SRS>{escape(crs.to_wkt())}</SRS>'
+        f'<GeoTransform>{left}, {res[0]}, 0, {top}, 0, {-res[1]}</GeoTransform>'
+        f'{"".join(bands)}</VRTDataset>')
+    with open(vrt_path, 'w') as f:
+        f.write(vrt)
+    return vrt_path
+
+def copy_raster_blocks(in_path, out_path, profile=None, fill=None):
+    """Copy a raster (e.g. a VRT) to a new file one block at a time so the
+    full raster is never held in memory.
+
+    Args:
+        in_path (str): path of the raster to copy
+        out_path (str): path to save the copy
+        profile (dict, optional): profile updates for the output, e.g. from
+            tiled_profile. Defaults to None.
+        fill (callable, optional): called with each block, its window and the output
+            dataset and returns the block to write. e.g. to fill nodata. Defaults to None.
+
+    Returns:
+        str: path of the copy
+    """
+    with rasterio.open(in_path) as src:
+        out_profile = src.profile
+        out_profile.update(profile or {})
+        with rasterio.open(out_path, 'w', **out_profile) as dst:
+            for band in range(1, src.count + 1):
+                for _, window in dst.block_windows(band):
+                    data = src.read(band, window=window)
+                    if fill is not None:
+                        data = fill(data, window, dst)
+                    dst.write(data, band, window=window)
+            dst.update_tags(**src.tags())
     return out_path
 
-def get_REMA_index_file(save_folder):
+def add_overviews(path, min_size=256, resampling=Resampling.average):
+    """Build internal overviews for a raster
+
+    Args:
+        path (str): path to the raster
+        min_size (int, optional): smallest overview size in pixels. Defaults to 256.
+        resampling (Resampling, optional): resampling method. Defaults to Resampling.average.
+    """
+    with rasterio.open(path, 'r+') as ds:
+        factors = []
+        factor = 2
+        while max(ds.width, ds.height) / factor >= min_size:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            ds.build_overviews(factors, resampling)
+            ds.update_tags(ns='rio_overview', resampling=resampling.name)
+
+def to_cog(in_path, out_path, compress='DEFLATE', blocksize=512, predictor=None):
+    """Convert a raster to a cloud optimised GeoTIFF with overviews.
+
+    Args:
+        in_path (str): path of the raster
+        out_path (str): path to save the COG
+        compress (str, optional): compression. Defaults to 'DEFLATE'.
+        blocksize (int, optional): size of the internal tiles. Defaults to 512.
+        predictor (str, optional): predictor. e.g. YES, STANDARD or FLOATING_POINT.
+            Defaults to None and FLOATING_POINT is used for float data
+
+    Returns:
+        str: path to the COG
+    """
+    with rasterio.open(in_path) as src:
+        if predictor is None:
+            predictor = 'FLOATING_POINT' if np.dtype(src.dtypes[0]).kind == 'f' else 'YES'
+        rasterio.shutil.copy(
+            src, out_path,
+            driver='COG',
+            COMPRESS=compress,
+            PREDICTOR=predictor,
+            BLOCKSIZE=blocksize,
+            OVERVIEWS='AUTO',
+            BIGTIFF='IF_SAFER')
+    return out_path
+
+def get_REMA_index_file(save_folder, overwrite=False):
+    """Get the REMA mosaic index. The index is only downloaded if it is not
+    already in save_folder.
+
+    Args:
+        save_folder (str): folder to save the index
+        overwrite (bool, optional): download the latest index again. Defaults to False.
+
+    Returns:
+        str: path to the REMA index gdb
+    """
+    os.makedirs(save_folder, exist_ok=True)
+    existing = [f for f in os.listdir(save_folder) if f.startswith('REMA_Mosaic_Index') and f.endswith('.gdb')]
+    if existing and not overwrite:
+        rema_index_path = os.path.join(save_folder, sorted(existing)[-1])
+        logging.info(f'Using existing REMA index : {rema_index_path}')
+        return rema_index_path
     rema_index_url = 'https://data.pgc.umn.edu/elev/dem/setsm/REMA/indexes/REMA_Mosaic_Index_latest_gdb.zip'
     filename = 'REMA_Mosaic_Index_latest_gdb.zip'
     # download and store locally
     zip_save_path = os.path.join(save_folder, filename)
+    logging.info(f'Downloading REMA index : {rema_index_url}')
     urlretrieve(rema_index_url, zip_save_path)
     #unzip 
     with zipfile.ZipFile(zip_save_path, 'r') as zip_ref:
@@ -152,22 +509,8 @@ def adjust_scene_poly_at_extreme_lat(bbox, src_crs, ref_crs, delta=0.1):
     Returns:
     - A polygon bounding box expanded to the true min max
     """
-    x_min, y_min, x_max, y_max = bbox
-    # Generate points along the top side
-    top_side = [(x, y_max) for x in list(np.arange(x_min, x_max, delta)) + [x_max]]    
-    # Generate points along the right side
-    right_side = [(x_max, y) for y in list(np.arange(y_max - delta, y_min-delta, -delta)) + [y_min]]
-    # Generate points along the bottom side
-    bottom_side = [(x, y_min) for x in list(np.arange(x_max - delta, x_min-delta, -delta)) + [x_min]]
-    list(np.arange(y_min + delta, y_max, delta)) + [y_max]
-    # Generate points along the left side
-    left_side = [(x_min, y) for y in list(np.arange(y_min + delta, y_max, delta)) + [y_max]]
-    # Combine all sides' points
-    all_points = top_side + right_side + bottom_side + left_side
-    # convert to a polygon 
-    polygon = Polygon(all_points)
-    # convert polygon to desired crs and get bounds in those coordinates
-    trans_bounds = transform_polygon(src_crs, ref_crs, polygon).bounds
+    # convert the densified box to desired crs and get bounds in those coordinates
+    trans_bounds = densify_and_transform_bounds(bbox, src_crs, ref_crs, delta)
     trans_poly = Polygon(
         [(trans_bounds[0], trans_bounds[1]), 
          (trans_bounds[2], trans_bounds[1]), 
@@ -0,0 +1,121 @@
+import os
+import re
+import zipfile
+import logging
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# swath and polarisation in the names of the SAFE measurement and annotation files
+# e.g. measurement/s1a-iw2-slc-vv-20190716t135159-20190716t135224-028143-032dc3-005.tiff
+SAFE_FILE_PATTERN = re.compile(r's1[a-d]-(iw[1-3]|ew[1-5]|s[1-6]|wv[12])-slc-(vv|vh|hh|hv)-', re.IGNORECASE)
+
+def member_channel(name):
+    """Get the swath and polarisation of a SAFE file from its name
+
+    Args:
+        name (str): name or path of the file
+
+    Returns:
+        tuple: (swath, polarisation) e.g. ('iw1', 'vv'). None for files of the whole
+            scene such as the manifest
+    """
+    match = SAFE_FILE_PATTERN.search(os.path.basename(name))
+    if match is None:
+        return None
+    return match.group(1).lower(), match.group(2).lower()
+
+def safe_polarizations(safe_path):
+    """Get the polarisations of a scene from the manifest of its SAFE
+
+    Args:
+        safe_path (str): path to the SAFE folder or the scene zip
+
+    Returns:
+        list: polarisations e.g. ['vv', 'vh']
+    """
+    if os.path.isdir(safe_path):
+        with open(os.path.join(safe_path, 'manifest.safe'), 'rb') as f:
+            root = ET.fromstring(f.read())
+    else:
+        with zipfile.ZipFile(safe_path, 'r') as zip_ref:
+            name = next(n for n in zip_ref.namelist() if n.endswith('/manifest.safe'))
+            root = ET.fromstring(zip_ref.read(name))
+    return [el.text.strip().lower() for el in root.iter()
+            if el.tag.endswith('}transmitterReceiverPolarisation') and el.text]
+
+def safe_members(scene_zip, swaths=None, polarizations=None):
+    """List the members of a zipped SAFE needed for the given swaths and polarisations.
+    Files of the whole scene (manifest, support, preview) are always included, the
+    measurement and annotation files only if their swath and polarisation are needed.
+
+    Args:
+        scene_zip (str): path to the scene zip
+        swaths (list, optional): swaths needed e.g. ['iw1']. Defaults to None (all).
+        polarizations (list, optional): polarisations needed e.g. ['vv']. Defaults to None (all).
+
+    Returns:
+        list: zipfile.ZipInfo of the needed files
+    """
+    swaths = {s.lower() for s in swaths} if swaths else None
+    polarizations = {p.lower() for p in polarizations} if polarizations else None
+    members = []
+    with zipfile.ZipFile(scene_zip, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            channel = member_channel(info.filename)
+            if channel is not None:
+                if swaths is not None and channel[0] not in swaths:
+                    continue
+                if polarizations is not None and channel[1] not in polarizations:
+                    continue
+            members.append(info)
+    return members
+
+def _extract_member(scene_zip, info, out_dir):
+    # each thread opens its own handle so members are read at the same time
+    dst = os.path.join(out_dir, info.filename)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + '.tmp'
+    with zipfile.ZipFile(scene_zip, 'r') as zip_ref, zip_ref.open(info) as src, open(tmp, 'wb') as f:
+        while True:
+            chunk = src.read(8*1024*1024)
+            if not chunk:
+                break
+            f.write(chunk)
+    # a partly extracted file is never left with the final name
+    os.replace(tmp, dst)
+
+def extract_safe(scene_zip, out_dir, swaths=None, polarizations=None, workers=4):
+    """Extract the SAFE of a scene zip, only the files needed for the given swaths and
+    polarisations. The measurement files make up most of the scene, so a single
+    swath needs about a third of the disk and time of a full unzip. Files are
+    extracted in parallel and files already extracted with the right size are
+    kept, so a SAFE extracted for other swaths is completed rather than replaced.
+
+    Args:
+        scene_zip (str): path to the scene zip
+        out_dir (str): folder to extract the SAFE to
+        swaths (list, optional): swaths needed e.g. ['iw1']. Defaults to None (all).
+        polarizations (list, optional): polarisations needed e.g. ['vv']. Defaults to None (all).
+        workers (int, optional): number of files extracted at once. Defaults to 4.
+
+    Returns:
+        str: path to the SAFE
+    """
+    members = safe_members(scene_zip, swaths=swaths, polarizations=polarizations)
+    if not members:
+        raise ValueError(f'no files for swaths {swaths} and polarisations {polarizations} in {scene_zip}')
+    safe_path = os.path.join(out_dir, members[0].filename.split('/')[0])
+    missing = [info for info in members
+               if not (os.path.isfile(os.path.join(out_dir, info.filename))
+                       and os.path.getsize(os.path.join(out_dir, info.filename)) == info.file_size)]
+    if not missing:
+        logger.info(f'SAFE already extracted : {safe_path}')
+        return safe_path
+    logger.info(f'extracting {len(missing)} of {len(members)} needed files to {safe_path}')
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(lambda info: _extract_member(scene_zip, info, out_dir), missing))
+    return safe_path
@@ -0,0 +1,233 @@
+import os
+import csv
+import time
+import logging
+import threading
+
+try:
+    import psutil
+except ImportError:
+    # the process tree is read from /proc instead
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_FIELDS = ['time', 'elapsed', 'processes', 'threads', 'cpu_percent', 'rss_mb', 'read_mb', 'write_mb']
+
+def _proc_children():
+    # parent pid -> child pids for every process in /proc
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'r') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name can contain spaces, the fields after it can not
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    return children
+
+def _proc_usage(pid):
+    # (cpu seconds, rss bytes, read bytes, write bytes, threads) of a process from /proc
+    with open(f'/proc/{pid}/stat', 'r') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    threads = int(fields[17])
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    read_bytes = write_bytes = 0
+    try:
+        with open(f'/proc/{pid}/io', 'r') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        read_bytes, write_bytes = int(io['read_bytes']), int(io['write_bytes'])
+    except (OSError, KeyError):
+        pass
+    return cpu, rss, read_bytes, write_bytes, threads
+
+def tree_usage(root_pid, include_root=False):
+    """Resource usage summed over the descendants of a process
+
+    Args:
+        root_pid (int): pid of the root process
+        include_root (bool, optional): include the root process. Defaults to False.
+
+    Returns:
+        dict: processes, threads, cpu (seconds), rss, read_bytes and write_bytes
+    """
+    usage = {'processes' : 0, 'threads' : 0, 'cpu' : 0.0, 'rss' : 0, 'read_bytes' : 0, 'write_bytes' : 0}
+    if psutil is not None:
+        try:
+            root = psutil.Process(root_pid)
+            procs = root.children(recursive=True) + ([root] if include_root else [])
+        except psutil.NoSuchProcess:
+            return usage
+        for proc in procs:
+            try:
+                with proc.oneshot():
+                    cpu = proc.cpu_times()
+                    io = proc.io_counters() if hasattr(proc, 'io_counters') else None
+                    usage['cpu'] += cpu.user + cpu.system
+                    usage['rss'] += proc.memory_info().rss
+                    usage['threads'] += proc.num_threads()
+                    if io is not None:
+                        usage['read_bytes'] += io.read_bytes
+                        usage['write_bytes'] += io.write_bytes
+                usage['processes'] += 1
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return usage
+
+    children = _proc_children()
+    pids = [root_pid] if include_root else []
+    stack = list(children.get(root_pid, []))
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+    for pid in pids:
+        try:
+            cpu, rss, read_bytes, write_bytes, threads = _proc_usage(pid)
+        except (OSError, IndexError, ValueError):
+            # the process finished
+            continue
+        usage['processes'] += 1
+        usage['threads'] += threads
+        usage['cpu'] += cpu
+        usage['rss'] += rss
+        usage['read_bytes'] += read_bytes
+        usage['write_bytes'] += write_bytes
+    return usage
+
+class ResourceSampler(threading.Thread):
+    """Sample the CPU, memory, IO and thread count of processes (e.g. the COMPASS
+    runs) at an interval. Processes are added with track as they start and are
+    sampled with their children until they finish, so other work of this process
+    such as downloads running at the same time is not counted. psutil is used if
+    it is installed, otherwise /proc is read directly.
+
+    CPU time and IO of processes that finish between samples are not counted, so
+    the CPU percent is for the processes running at each sample.
+
+    Args:
+        interval (float, optional): seconds between samples. Defaults to 5.
+        root_pid (int, optional): pid of a process whose tree is also sampled.
+            Defaults to None (only the tracked processes).
+        include_root (bool, optional): include the root process. Defaults to False.
+    """
+
+    def __init__(self, interval=5, root_pid=None, include_root=False):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.root_pid = root_pid
+        self.include_root = include_root
+        self.samples = []
+        self._processes = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._last = None
+
+    def track(self, process):
+        """Sample a process and its children until it finishes. Can be passed as
+        the on_start callback of run_command.
+
+        Args:
+            process (subprocess.Popen): the process
+        """
+        with self._lock:
+            self._processes.append(process)
+
+    def _usage(self):
+        # usage summed over the root tree and the tracked processes still running
+        with self._lock:
+            # returncode is set once the process is reaped, after which its pid can be reused
+            self._processes = [p for p in self._processes if p.returncode is None]
+            trees = [(p.pid, True) for p in self._processes]
+        if self.root_pid is not None:
+            trees.append((self.root_pid, self.include_root))
+        usage = {'processes' : 0, 'threads' : 0, 'cpu' : 0.0, 'rss' : 0, 'read_bytes' : 0, 'write_bytes' : 0}
+        for pid, include_root in trees:
+            for key, value in tree_usage(pid, include_root=include_root).items():
+                usage[key] += value
+        return usage
+
+    def sample(self):
+        """Take a sample of the processes
+
+        Returns:
+            dict: the sample. See SAMPLE_FIELDS
+        """
+        now = time.time()
+        usage = self._usage()
+        cpu_percent = 0.0
+        if self._last is not None:
+            last_time, last_cpu = self._last
+            # processes that finish take their cpu time with them
+            cpu_percent = max(0.0, usage['cpu'] - last_cpu) / max(now - last_time, 1e-6) * 100
+        self._last = (now, usage['cpu'])
+        record = {
+            'time' : now,
+            'elapsed' : now - self.samples[0]['time'] if self.samples else 0.0,
+            'processes' : usage['processes'],
+            'threads' : usage['threads'],
+            'cpu_percent' : cpu_percent,
+            'rss_mb' : usage['rss'] / 1024**2,
+            'read_mb' : usage['read_bytes'] / 1024**2,
+            'write_mb' : usage['write_bytes'] / 1024**2,
+        }
+        self.samples.append(record)
+        return record
+
+    def run(self):
+        self.sample()
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """Stop sampling
+
+        Returns:
+            dict: summary of the samples. See summary
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        return self.summary()
+
+    def summary(self):
+        """Peaks of the samples
+
+        Returns:
+            dict: peak and mean CPU percent, peak RSS, peak threads and processes,
+                and the most read and written
+        """
+        if not self.samples:
+            return {}
+        return {
+            'samples' : len(self.samples),
+            'peak_cpu_percent' : max(s['cpu_percent'] for s in self.samples),
+            'mean_cpu_percent' : sum(s['cpu_percent'] for s in self.samples) / len(self.samples),
+            'peak_rss_mb' : max(s['rss_mb'] for s in self.samples),
+            'peak_threads' : max(s['threads'] for s in self.samples),
+            'peak_processes' : max(s['processes'] for s in self.samples),
+            'max_read_mb' : max(s['read_mb'] for s in self.samples),
+            'max_write_mb' : max(s['write_mb'] for s in self.samples),
+            'cpu_count' : os.cpu_count(),
+        }
+
+    def save(self, path):
+        """Save the samples as a csv time series
+
+        Args:
+            path (str): path to the csv
+
+        Returns:
+            str: path to the csv
+        """
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SAMPLE_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.samples)
+        return path
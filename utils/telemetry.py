@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+def cpu_time():
+    """CPU seconds used by this process and its finished child processes
+
+    Returns:
+        float: user + system time in seconds
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its largest finished child
+
+    Returns:
+        tuple: (process peak MB, child peak MB)
+    """
+    # ru_maxrss is in KB on linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+class Telemetry(object):
+    """In memory collector of timed spans. A span is recorded for each step of a run
+    with its start, duration, CPU time and any attributes (e.g. the scene or number
+    of bytes moved). The spans are written once at the end of the run as JSON lines
+    or as a Chrome trace (chrome://tracing, perfetto).
+
+    CPU time is for the whole process, so spans that run at the same time in
+    different threads share it. Peak memory is only known for the whole process,
+    so it is recorded once for the run when the spans are written. See
+    ResourceSampler for memory over time.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.t0 = time.time()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time a step. Attributes can be added to the yielded dict while the step
+        runs. If a bytes attribute is set the throughput is added.
+
+        e.g.
+        with telemetry.span('download', scene=scene) as s:
+            ...
+            s['bytes'] = os.path.getsize(scene_zip)
+
+        Args:
+            name (str): name of the step
+            attrs : attributes of the span
+
+        Yields:
+            dict: attributes of the span
+        """
+        record = dict(attrs)
+        start = time.time()
+        cpu_start = cpu_time()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            self.add(name, start, time.time() - start, cpu_time=cpu_time() - cpu_start, **record)
+
+    def add(self, name, start, duration, **attrs):
+        """Record a span that was timed elsewhere
+
+        Args:
+            name (str): name of the step
+            start (float): start time in seconds since the epoch
+            duration (float): duration in seconds
+            attrs : attributes of the span
+        """
+        record = {
+            'name' : name,
+            'start' : start,
+            'duration' : duration,
+            'thread' : threading.current_thread().name,
+            **attrs,
+        }
+        if record.get('bytes') and duration > 0:
+            record['MB/s'] = (record['bytes'] / 1024**2) / duration
+        with self._lock:
+            self.spans.append(record)
+
+    def summary(self, **match):
+        """Total seconds of each step, for the spans with matching attributes
+
+        e.g. summary(scene=scene)
+
+        Args:
+            match : attributes the spans must have
+
+        Returns:
+            dict: step name -> seconds, with the Total from the first start to the last end
+        """
+        with self._lock:
+            spans = [s for s in self.spans if all(s.get(k) == v for k, v in match.items())]
+        timing = {}
+        for s in spans:
+            timing[s['name']] = timing.get(s['name'], 0) + s['duration']
+        timing['Total'] = (max(s['start'] + s['duration'] for s in spans) - min(s['start'] for s in spans)) if spans else 0
+        return timing
+
+    def run_summary(self):
+        """Values for the whole run
+
+        Returns:
+            dict: start, duration, CPU time, peak memory of the process and of its
+                largest finished child process, and number of spans
+        """
+        rss, child_rss = peak_rss_mb()
+        with self._lock:
+            n_spans = len(self.spans)
+        return {
+            'start' : self.t0,
+            'duration' : time.time() - self.t0,
+            'cpu_time' : cpu_time(),
+            'peak_rss_mb' : rss,
+            'peak_child_rss_mb' : child_rss,
+            'spans' : n_spans,
+        }
+
+    def flush(self, path, format='jsonl'):
+        """Write the spans to a file, with the run summary as the last line
+        of the JSON lines or as the metadata of the Chrome trace
+
+        Args:
+            path (str): path to the file
+            format (str, optional): jsonl for one span per line or chrome for a
+                Chrome trace. Defaults to 'jsonl'.
+
+        Returns:
+            str: path to the file
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s['start'])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if format == 'chrome':
+            threads = {}
+            events = []
+            for s in spans:
+                tid = threads.setdefault(s['thread'], len(threads))
+                events.append({
+                    'name' : s['name'],
+                    'ph' : 'X',
+                    'ts' : (s['start'] - self.t0) * 1e6,
+                    'dur' : s['duration'] * 1e6,
+                    'pid' : os.getpid(),
+                    'tid' : tid,
+                    'args' : {k : v for k, v in s.items() if k not in ('name', 'start', 'duration', 'thread')},
+                })
+            events += [{'name' : 'thread_name', 'ph' : 'M', 'pid' : os.getpid(), 'tid' : tid,
+                        'args' : {'name' : name}} for name, tid in threads.items()]
+            with open(path, 'w') as f:
+                json.dump({'traceEvents' : events, 'otherData' : self.run_summary()}, f, default=str)
+        elif format == 'jsonl':
+            with open(path, 'w') as f:
+                for s in spans:
+                    f.write(json.dumps(s, default=str) + '\n')
+                f.write(json.dumps({'name' : 'run', **self.run_summary()}, default=str) + '\n')
+        else:
+            raise ValueError(f'unknown telemetry format {format}, expected jsonl or chrome')
+        logger.info(f'{len(spans)} telemetry spans saved to {path}')
+        return path
+
+# collector shared by the modules of a run
+telemetry = Telemetry()
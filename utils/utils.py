@@ -1,24 +1,92 @@
 import os
-import json
+import time
+import queue
+import signal
+import logging
+import threading
+import subprocess
 
-def update_timing_file(key, time, path, replace=False):
-    """Update the timing json at specified path. Creates if doesn't exists
+def _read_stream(stream, name, lines):
+    # put each line of the stream on the queue, then None once it is closed
+    for line in iter(stream.readline, ''):
+        lines.put((name, line))
+    stream.close()
+    lines.put((name, None))
+
+def stop_process(process, grace=10):
+    """Stop a process and its children, killing them if they do not stop
+    within the grace period
 
     Args:
-        key (str): key for the timing dict
-        time (floar): time in seconds
-        path (str): path to the timing file
-        replace (bool, optional): Replace a value in the file if it already exists. Defaults to False.
+        process (subprocess.Popen): process started in its own session
+        grace (float, optional): seconds to wait after SIGTERM before SIGKILL. Defaults to 10.
     """
-    if os.path.exists(path):
-        with open(path, 'r') as fp:
-            timing = json.load(fp)
-    else:
-        timing = {}
-    if ((key not in timing) or replace):
-        timing[key] = time
-    # update total
-    total_t = sum([timing[k] for k in timing.keys() if k != 'Total'])
-    timing['Total'] = total_t
-    with open(path, 'w') as fp:
-        json.dump(timing, fp)
\ No newline at end of file
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def run_command(command, env=None, prefix='', on_line=None, timeout=None, watchdog=None, poll=1,
+                stderr_level=logging.ERROR, on_start=None):
+    """Run a shell command and log its stdout and stderr as it runs. Both streams
+    are read by their own thread so the command never blocks on a full pipe.
+
+    Args:
+        command (str): command to run
+        env (dict, optional): environment variables for the command. Defaults to None.
+        prefix (str, optional): prefix added to each logged line. Defaults to ''.
+        on_line (callable, optional): called with the stream name (stdout or stderr)
+            and each line. Defaults to None.
+        timeout (float, optional): seconds before the command is stopped. Defaults to None.
+        watchdog (callable, optional): called every poll seconds, the command is stopped
+            if it returns a reason (str). Defaults to None.
+        poll (float, optional): seconds between timeout and watchdog checks. Defaults to 1.
+        stderr_level (int, optional): level stderr is logged at. Defaults to logging.ERROR.
+        on_start (callable, optional): called with the subprocess.Popen of the command
+            once it has started. Defaults to None.
+
+    Returns:
+        int: return code of the command. Negative if stopped by a signal
+    """
+    t_start = time.time()
+    # a new session so the command and its children can be stopped together
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, env=env, start_new_session=True)
+    if on_start is not None:
+        on_start(process)
+    lines = queue.Queue()
+    readers = [threading.Thread(target=_read_stream, args=(stream, name, lines), daemon=True)
+               for stream, name in [(process.stdout, 'stdout'), (process.stderr, 'stderr')]]
+    for reader in readers:
+        reader.start()
+
+    open_streams = len(readers)
+    while open_streams:
+        try:
+            name, line = lines.get(timeout=poll)
+        except queue.Empty:
+            name, line = None, None
+        if name is not None:
+            if line is None:
+                open_streams -= 1
+                continue
+            if name == 'stdout':
+                logging.info(prefix + line.strip())
+            else:
+                logging.log(stderr_level, prefix + line.strip())
+            if on_line is not None:
+                on_line(name, line)
+        reason = None
+        if timeout is not None and time.time() - t_start > timeout:
+            reason = f'timed out after {timeout}s'
+        elif watchdog is not None:
+            reason = watchdog()
+        if reason:
+            logging.error(f'{prefix}stopping command, {reason} : {command}')
+            stop_process(process)
+            # the readers finish once the streams close
+            timeout, watchdog = None, None
+    return process.wait()